@@ -0,0 +1,108 @@
+"""Compile lists of BNF code patterns into a single SQL predicate.
+
+Views are given lists of BNF codes, which they turn into LIKE patterns
+(eg `0202010B0%` for everything under a chemical, or
+`0202010B0____AB` for all presentations equivalent to a generic).
+Chaining one `LIKE` clause per pattern with `OR` produces plans that
+Postgres cannot satisfy with a single index range scan, so instead we:
+
+  * drop patterns which are already covered by a shorter prefix;
+  * match patterns without wildcards with a single `= ANY(%s)`;
+  * turn the literal prefix of every other pattern into a range, using
+    the `varchar_pattern_ops` operators so that the existing indexes on
+    the code columns can be used;
+  * only keep a `LIKE` for patterns with wildcards after their prefix.
+
+"""
+
+
+def code_filter(column, patterns):
+    """Return a predicate (as SQL and a list of parameters) which matches
+    values of `column` that match any of the given LIKE `patterns`.
+
+    """
+    exact_codes = set()
+    prefixes = set()
+    partial_patterns = set()
+
+    for pattern in patterns:
+        prefix, rest = _split_pattern(pattern)
+        if rest is None:
+            exact_codes.add(prefix)
+        elif rest == '%':
+            prefixes.add(prefix)
+        else:
+            partial_patterns.add((prefix, pattern))
+
+    prefixes = collapse_prefixes(prefixes)
+    if '' in prefixes:
+        return '{} IS NOT NULL'.format(column), []
+
+    exact_codes = sorted(
+        code for code in exact_codes if not _covered(code, prefixes))
+    partial_patterns = sorted(
+        (prefix, pattern) for prefix, pattern in partial_patterns
+        if not _covered(prefix, prefixes))
+
+    clauses = []
+    params = []
+    if exact_codes:
+        clauses.append('{} = ANY(%s)'.format(column))
+        params.append(exact_codes)
+    for prefix in prefixes:
+        clauses.append(_range_sql(column))
+        params.extend(prefix_range(prefix))
+    for prefix, pattern in partial_patterns:
+        if prefix:
+            clauses.append(
+                '({} AND {} LIKE %s)'.format(_range_sql(column), column))
+            params.extend(prefix_range(prefix))
+        else:
+            clauses.append('{} LIKE %s'.format(column))
+        params.append(pattern)
+
+    if not clauses:
+        return 'FALSE', []
+    return '({})'.format(' OR '.join(clauses)), params
+
+
+def _split_pattern(pattern):
+    """Split a LIKE pattern into its literal prefix and the remainder,
+    which is None if the pattern has no wildcards.
+
+    """
+    for ix, char in enumerate(pattern):
+        if char in '%_':
+            return pattern[:ix], pattern[ix:]
+    return pattern, None
+
+
+def collapse_prefixes(prefixes):
+    """Return sorted prefixes, omitting any that are covered by a shorter
+    prefix.
+
+    """
+    collapsed = []
+    for prefix in sorted(prefixes):
+        # After sorting, any prefix covering this one is the last one kept
+        if collapsed and prefix.startswith(collapsed[-1]):
+            continue
+        collapsed.append(prefix)
+    return collapsed
+
+
+def _covered(code, prefixes):
+    return any(code.startswith(prefix) for prefix in prefixes)
+
+
+def _range_sql(column):
+    return '({0} ~>=~ %s AND {0} ~<~ %s)'.format(column)
+
+
+def prefix_range(prefix):
+    """Return the bounds of the half-open range of strings starting with
+    `prefix`, under bytewise ordering.
+
+    """
+    upper = prefix[:-1] + chr(ord(prefix[-1]) + 1)
+    return [prefix, upper]
@@ -0,0 +1,27 @@
+import json
+
+from rest_framework.renderers import BaseRenderer
+from rest_framework.utils.encoders import JSONEncoder
+
+
+class JSONLinesRenderer(BaseRenderer):
+    """Renders a list of rows as line-delimited JSON, with one JSON object
+    per line.  Views that stream their results (see
+    `view_utils.streaming_response`) produce the same format
+    incrementally.
+
+    """
+    media_type = 'application/x-ndjson'
+    format = 'jsonl'
+    charset = None
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if data is None:
+            return ''
+        if not isinstance(data, list):
+            data = [data]
+        return ''.join(json_line(row) for row in data)
+
+
+def json_line(row):
+    return json.dumps(row, cls=JSONEncoder) + '\n'
@@ -0,0 +1,285 @@
+"""A read-only, memory-mapped store of spending by CCG and chemical.
+
+At the end of `create_views` we write the contents of
+`vw__chemical_summary_by_ccg` to a set of `.npy` files, one per
+measure (items, quantity and actual_cost), each indexed by (chemical,
+CCG, month).  Along the chemical axis they hold cumulative sums over
+chemicals in code order, so since every BNF section is a contiguous
+range of chemical codes, the spending for any section or chemical is
+the difference between two (CCG x month) slices.  National totals
+(which include organisations that are not CCGs) are held in the same
+way in (chemical, month) arrays.
+
+The files are opened with `numpy.load(..., mmap_mode='r')`, so their
+pages are shared between all the web workers on a machine via the OS
+page cache.
+
+Each build is written to its own directory, and the `current` symlink
+is then switched to point at it, so workers never see a partly
+written store.  A store is only used if it was built for the latest
+prescribing data; otherwise callers should fall back to Postgres.
+
+"""
+
+from bisect import bisect_left
+import datetime
+import json
+import os
+import shutil
+import tempfile
+
+import numpy as np
+from dateutil.relativedelta import relativedelta
+from django.conf import settings
+from django.db import connection
+
+from code_filters import collapse_prefixes, prefix_range
+from view_utils import execute_query_in_batches
+
+
+MEASURES = ['items', 'quantity', 'actual_cost']
+
+# Chemical codes are the longest codes the store can answer queries for
+MAX_CODE_LENGTH = 9
+
+# The number of months covered by the vw__ tables
+NUM_MONTHS = 60
+
+# The process-wide store, reloaded whenever `current` is repointed
+_cube = None
+
+
+def get_cube():
+    """Return the current SpendingCube, or None if there is no store for
+    the latest prescribing data.
+
+    """
+    global _cube
+    from frontend.models import ImportLog
+
+    base_dir = getattr(settings, 'SPENDING_CUBE_DIR', None)
+    if not base_dir:
+        return None
+    path = os.path.realpath(os.path.join(base_dir, 'current'))
+    if not os.path.exists(os.path.join(path, 'meta.json')):
+        return None
+    if _cube is None or _cube.path != path:
+        try:
+            _cube = SpendingCube(path)
+        except (IOError, OSError):
+            # The store was replaced while we were opening it
+            return None
+    latest = ImportLog.objects.latest_in_category('prescribing')
+    if latest is None or latest.current_at != _cube.prescribing_date:
+        return None
+    return _cube
+
+
+class SpendingCube(object):
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, 'meta.json')) as f:
+            meta = json.load(f)
+        self.prescribing_date = _parse_date(meta['prescribing_date'])
+        self.months = [_parse_date(month) for month in meta['months']]
+        self.codes = meta['codes']
+        self.ccgs = [tuple(ccg) for ccg in meta['ccgs']]
+        self.ccg_ixs = dict((code, ix) for ix, (code, _) in
+                            enumerate(self.ccgs))
+        self.totals = {}
+        self.by_ccg = {}
+        for measure in MEASURES:
+            self.totals[measure] = np.load(
+                os.path.join(path, '%s.npy' % measure), mmap_mode='r')
+            self.by_ccg[measure] = np.load(
+                os.path.join(path, '%s_by_ccg.npy' % measure),
+                mmap_mode='r')
+
+    def covers(self, codes):
+        return all(len(code) <= MAX_CODE_LENGTH for code in codes)
+
+    def total_spending(self, codes):
+        """Return spending on the given codes for every month, in the same
+        form as the `total_spending` API.
+
+        """
+        sums = self._sums(self.totals, codes)
+        rows = []
+        for month_ix, month in enumerate(self.months):
+            rows.append(self._row(sums, month_ix, date=month))
+        return rows
+
+    def spending_by_ccg(self, codes, orgs):
+        """Return spending on the given codes by each CCG (or by each of
+        `orgs`, if given) for every month in which it prescribed any
+        of them, in the same form as the `spending_by_ccg` API.
+
+        """
+        sums = self._sums(self.by_ccg, codes)
+        if orgs:
+            ccg_ixs = sorted(
+                self.ccg_ixs[org] for org in set(orgs) if org in self.ccg_ixs)
+        else:
+            ccg_ixs = range(len(self.ccgs))
+        rows = []
+        for month_ix, month in enumerate(self.months):
+            for ccg_ix in ccg_ixs:
+                if not sums['items'][ccg_ix, month_ix]:
+                    continue
+                code, name = self.ccgs[ccg_ix]
+                rows.append(self._row(
+                    sums, (ccg_ix, month_ix),
+                    row_id=code, row_name=name, date=month))
+        return rows
+
+    def _sums(self, arrays, codes):
+        ranges = self._code_ranges(codes)
+        sums = {}
+        for measure in MEASURES:
+            array = arrays[measure]
+            sums[measure] = sum(array[hi] - array[lo] for lo, hi in ranges)
+        return sums
+
+    def _code_ranges(self, codes):
+        """Return the (start, end) indexes of the ranges of chemicals
+        covered by the given codes.
+
+        """
+        if not codes:
+            return [(0, len(self.codes))]
+        ranges = []
+        for prefix in collapse_prefixes(codes):
+            lower, upper = prefix_range(prefix)
+            ranges.append((
+                bisect_left(self.codes, lower),
+                bisect_left(self.codes, upper)))
+        return ranges
+
+    def _row(self, sums, ix, **extra):
+        row = {
+            'items': int(round(sums['items'][ix])),
+            'quantity': int(round(sums['quantity'][ix])),
+            'actual_cost': round(float(sums['actual_cost'][ix]), 2),
+        }
+        row.update(extra)
+        return row
+
+
+def build(prescribing_date):
+    """Write a new store from `vw__chemical_summary_by_ccg`, and make it
+    the current one.
+
+    """
+    from frontend.models import PCT
+
+    base_dir = settings.SPENDING_CUBE_DIR
+    if not os.path.exists(base_dir):
+        os.makedirs(base_dir)
+
+    with connection.cursor() as cursor:
+        cursor.execute(
+            "SELECT DISTINCT chemical_id FROM vw__chemical_summary_by_ccg "
+            "WHERE chemical_id IS NOT NULL")
+        codes = [row[0] for row in cursor.fetchall()]
+    ccgs = PCT.objects.filter(org_type='CCG').values_list('code', 'name')
+    batches = execute_query_in_batches(
+        "SELECT processing_date, pct_id, chemical_id, items, quantity, "
+        "cost AS actual_cost FROM vw__chemical_summary_by_ccg", None)
+
+    path = tempfile.mkdtemp(
+        prefix=prescribing_date.strftime('%Y_%m_'), dir=base_dir)
+    os.chmod(path, 0o755)
+    write(path, prescribing_date, codes, ccgs, batches)
+
+    # Repoint `current` atomically, by renaming a new symlink over it
+    link = os.path.join(base_dir, 'current')
+    new_link = link + '.new'
+    if os.path.lexists(new_link):
+        os.remove(new_link)
+    os.symlink(path, new_link)
+    os.rename(new_link, link)
+
+    # Workers still using an old store keep their mappings after its
+    # files are removed
+    for name in os.listdir(base_dir):
+        old_path = os.path.join(base_dir, name)
+        if old_path != path and os.path.isdir(old_path) and \
+           not os.path.islink(old_path):
+            shutil.rmtree(old_path)
+    return path
+
+
+def write(path, prescribing_date, codes, ccgs, batches):
+    """Write a store to the directory at `path`.
+
+    `codes` are the chemical codes to include, `ccgs` is a sequence of
+    (code, name) pairs, and `batches` yields lists of dicts with keys
+    processing_date, pct_id, chemical_id and one for each measure.
+
+    """
+    codes = sorted(codes)
+    ccgs = sorted(ccgs)
+    months = [prescribing_date - relativedelta(months=n)
+              for n in reversed(range(NUM_MONTHS))]
+    code_ixs = dict((code, ix) for ix, code in enumerate(codes))
+    ccg_ixs = dict((code, ix) for ix, (code, _) in enumerate(ccgs))
+    month_ixs = dict((month, ix) for ix, month in enumerate(months))
+
+    # Each array has an extra leading row of zeros so that the sum over
+    # chemicals [lo, hi) is always array[hi] - array[lo]
+    totals = {}
+    by_ccg = {}
+    for measure in MEASURES:
+        totals[measure] = np.lib.format.open_memmap(
+            os.path.join(path, '%s.npy' % measure), mode='w+',
+            dtype=np.float64, shape=(len(codes) + 1, len(months)))
+        by_ccg[measure] = np.lib.format.open_memmap(
+            os.path.join(path, '%s_by_ccg.npy' % measure), mode='w+',
+            dtype=np.float64, shape=(len(codes) + 1, len(ccgs), len(months)))
+
+    for batch in batches:
+        batch = [row for row in batch
+                 if row['chemical_id'] in code_ixs and
+                 _to_date(row['processing_date']) in month_ixs]
+        if not batch:
+            continue
+        code_ix = np.array([code_ixs[row['chemical_id']] + 1
+                            for row in batch])
+        month_ix = np.array([month_ixs[_to_date(row['processing_date'])]
+                             for row in batch])
+        ccg_ix = np.array([ccg_ixs.get(row['pct_id'], -1) for row in batch])
+        is_ccg = ccg_ix >= 0
+        for measure in MEASURES:
+            values = np.array(
+                [row[measure] or 0 for row in batch], dtype=np.float64)
+            np.add.at(totals[measure], (code_ix, month_ix), values)
+            np.add.at(
+                by_ccg[measure],
+                (code_ix[is_ccg], ccg_ix[is_ccg], month_ix[is_ccg]),
+                values[is_ccg])
+
+    for measure in MEASURES:
+        for array in [totals[measure], by_ccg[measure]]:
+            np.cumsum(array, axis=0, out=array)
+            array.flush()
+
+    # Readers treat the presence of meta.json as meaning the store is
+    # complete, so it is written last
+    meta = {
+        'prescribing_date': prescribing_date.strftime('%Y-%m-%d'),
+        'months': [month.strftime('%Y-%m-%d') for month in months],
+        'codes': codes,
+        'ccgs': ccgs,
+    }
+    with open(os.path.join(path, 'meta.json'), 'w') as f:
+        json.dump(meta, f)
+
+
+def _to_date(value):
+    if isinstance(value, datetime.datetime):
+        return value.date()
+    return value
+
+
+def _parse_date(value):
+    return datetime.datetime.strptime(value, '%Y-%m-%d').date()
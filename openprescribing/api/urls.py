@@ -38,4 +38,4 @@ urlpatterns = [
 ]
 
 urlpatterns = format_suffix_patterns(urlpatterns,
-                                     allowed=['json', 'csv'])
+                                     allowed=['json', 'csv', 'jsonl'])
@@ -1,8 +1,22 @@
+import csv
+import hashlib
 import itertools
+import struct
+import uuid
+from django.core.cache import caches
 from django.db import connection
+from django.db import transaction
+from django.db.models import Max
+from django.http import StreamingHttpResponse
 from django.shortcuts import get_object_or_404
 from functools import wraps
 
+from api.renderers import json_line
+
+
+# Number of rows fetched from the server at a time by streaming queries
+STREAMING_BATCH_SIZE = 5000
+
 
 def db_timeout(timeout):
     """A decorator that applies a timeout to the current database
@@ -24,6 +38,121 @@ def db_timeout(timeout):
     return timeout_decorator
 
 
+def cache_until_import(*categories):
+    """A decorator that caches the rendered response of an API view
+    until there is a new import in any of the given `ImportLog`
+    categories.
+
+    The cache key is made from the request path (which includes any
+    format suffix), the normalised query string, and the latest
+    `ImportLog` entry for each category, so a new import invalidates
+    previously cached responses without any manual purge.
+
+    This should be the outermost decorator, so that cache hits skip
+    any work (such as setting statement timeouts) done by the
+    decorators beneath it.
+
+    """
+    def cache_decorator(func):
+        @wraps(func)
+        def func_wrapper(request, *args, **kwargs):
+            cache = caches['api']
+            key = _cache_key(request, categories)
+            response = cache.get(key)
+            if response is not None:
+                return response
+            response = func(request, *args, **kwargs)
+            if response.status_code == 200 and not response.streaming:
+                # DRF responses are rendered after the view returns,
+                # and can only be pickled once they have been
+                response.add_post_render_callback(
+                    lambda r: cache.set(key, r))
+            return response
+        return func_wrapper
+    return cache_decorator
+
+
+def _cache_key(request, categories):
+    from frontend.models import ImportLog
+    query = sorted(request.GET.lists())
+    versions = []
+    for category in categories:
+        log = ImportLog.objects.latest_in_category(category)
+        if log is None:
+            versions.append('%s:none' % category)
+        else:
+            versions.append('%s:%s:%s' % (
+                category, log.current_at, log.imported_at.isoformat()))
+    raw_key = repr((request.path, query, versions))
+    return 'api:%s' % hashlib.md5(raw_key).hexdigest()
+
+
+def single_flight(key, func):
+    """Return the result of calling `func`, unless a call with the same
+    `key` is already in progress in another process, in which case wait
+    for it to finish and return its result instead.
+
+    Calls are coordinated with a Postgres advisory lock derived from
+    `key`, and results are passed to waiting processes through the
+    `single_flight` cache.  A waiting process reads the result of the
+    call that was in progress when it arrived, which may have started
+    before the latest data was imported, so the time of the latest
+    import is included in the key: calls made after an import never
+    share results with calls made before it.
+
+    Waiting processes also hold a shared advisory lock on a second key
+    while they wait, so that results are only written to the cache when
+    another process is waiting for them.
+
+    """
+    from frontend.models import ImportLog
+    cache = caches['single_flight']
+    latest_import = ImportLog.objects.aggregate(
+        Max('imported_at'))['imported_at__max']
+    digest = hashlib.md5(repr((key, latest_import))).digest()
+    lock_id, waiter_lock_id = struct.unpack('<qq', digest)
+    result_key = 'single_flight:%s' % digest.encode('hex')
+    cursor = connection.cursor()
+    try:
+        cursor.execute("SELECT pg_try_advisory_lock(%s)", [lock_id])
+        if cursor.fetchone()[0]:
+            cache.delete(result_key)
+        else:
+            cursor.execute(
+                "SELECT pg_advisory_lock_shared(%s)", [waiter_lock_id])
+            try:
+                cursor.execute("SELECT pg_advisory_lock(%s)", [lock_id])
+            finally:
+                cursor.execute(
+                    "SELECT pg_advisory_unlock_shared(%s)", [waiter_lock_id])
+            result = cache.get(result_key, _NO_RESULT)
+            if result is not _NO_RESULT:
+                return result
+            # The call we were waiting on failed, so try it ourselves
+        result = func()
+        cursor.execute("SELECT pg_try_advisory_lock(%s)", [waiter_lock_id])
+        if cursor.fetchone()[0]:
+            # Nobody is waiting
+            cursor.execute("SELECT pg_advisory_unlock(%s)", [waiter_lock_id])
+        else:
+            cache.set(result_key, result)
+        return result
+    finally:
+        cursor.execute("SELECT pg_advisory_unlock(%s)", [lock_id])
+        cursor.close()
+
+
+_NO_RESULT = object()
+
+
+def queryset_key(qs):
+    """Return a key identifying the SQL that a queryset will run, for use
+    with `single_flight`.
+
+    """
+    return repr(qs.query.sql_with_params())
+
+
 def param_to_list(str):
     params = []
     if str:
@@ -40,19 +169,122 @@ def dictfetchall(cursor):
     ]
 
 
-def execute_query(query, params):
-    cursor = connection.cursor()
+def _execute(cursor, query, params):
     if isinstance(params, dict):
         cursor.execute(query, params)
     elif params:
         cursor.execute(query, tuple(itertools.chain.from_iterable(params)))
     else:
         cursor.execute(query)
+
+
+def execute_query(query, params, coalesce=False):
+    """Run a query and return its rows as dicts.
+
+    Expensive queries which are likely to be requested by many users
+    at once should pass `coalesce=True`, so that identical concurrent
+    queries are only run once (see `single_flight`).
+
+    """
+    if coalesce:
+        return single_flight(
+            repr((query, params)), lambda: execute_query(query, params))
+    cursor = connection.cursor()
+    _execute(cursor, query, params)
     data = dictfetchall(cursor)
     cursor.close()
     return data
 
 
+def execute_query_in_batches(query, params,
+                             batch_size=STREAMING_BATCH_SIZE,
+                             with_columns=False):
+    """Execute a query using a server-side cursor, and yield its results
+    as lists of up to `batch_size` dicts.
+
+    Unlike `execute_query`, the full result set is never held in
+    memory.  Server-side cursors only exist inside a transaction, so
+    one is held open until the generator is exhausted or closed.
+
+    With `with_columns=True`, the query's column names are yielded
+    before any rows.  They are only available once the first batch has
+    been fetched, so retrieving them with `next()` runs the query, and
+    raises any error from it, straight away.
+
+    """
+    with transaction.atomic():
+        connection.ensure_connection()
+        cursor = connection.connection.cursor(
+            name='stream_%s' % uuid.uuid4().hex)
+        try:
+            cursor.itersize = batch_size
+            _execute(cursor, query, params)
+            # A named cursor only runs its query on the first fetch
+            rows = cursor.fetchmany(batch_size)
+            cols = [col[0] for col in cursor.description]
+            if with_columns:
+                yield cols
+            while rows:
+                yield [dict(zip(cols, row)) for row in rows]
+                rows = cursor.fetchmany(batch_size)
+        finally:
+            cursor.close()
+
+
+class _Echo(object):
+    """A file-like object that returns what is written to it, so that a
+    csv.writer can be used to render a single line at a time.
+
+    """
+    def write(self, value):
+        return value
+
+
+def _csv_lines(columns, batches):
+    writer = csv.writer(_Echo())
+    # Sorted to match the column order of the CSVRenderer
+    header = sorted(columns)
+    yield writer.writerow(header)
+    for batch in batches:
+        for row in batch:
+            yield writer.writerow([
+                v.encode('utf-8') if isinstance(v, unicode) else v
+                for v in (row[k] for k in header)
+            ])
+
+
+def _json_lines(batches):
+    for batch in batches:
+        for row in batch:
+            yield json_line(row)
+
+
+def streaming_response(query, params, format, filename=None):
+    """Return a StreamingHttpResponse which renders the results of a
+    query incrementally, as either CSV or line-delimited JSON, so that
+    memory use does not grow with the size of the result set.
+
+    The query is run, and its first batch of rows fetched, before the
+    response is returned, so that errors (including statement
+    timeouts) give an error response rather than a truncated one.
+
+    """
+    if format not in ['csv', 'jsonl']:
+        raise ValueError("Cannot stream format %s" % format)
+    batches = execute_query_in_batches(query, params, with_columns=True)
+    columns = next(batches)
+    if format == 'csv':
+        response = StreamingHttpResponse(
+            _csv_lines(columns, batches), content_type='text/csv')
+    else:
+        response = StreamingHttpResponse(
+            _json_lines(batches), content_type='application/x-ndjson')
+    if filename:
+        response['content-disposition'] = (
+            "attachment; filename=%s" % filename)
+    return response
+
+
 def get_practice_ids_from_org(org_codes):
     # Convert CCG codes to lists of practices.
     from frontend.models import Practice
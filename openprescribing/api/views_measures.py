@@ -17,6 +17,7 @@ class MissingParameter(APIException):
     default_detail = 'You are missing a required parameter.'
 
 
+@utils.cache_until_import('measures')
 @api_view(['GET'])
 def measure_global(request, format=None):
     measure = request.query_params.get('measure', None)
@@ -69,6 +70,7 @@ def measure_global(request, format=None):
     return Response(d)
 
 
+@utils.cache_until_import('prescribing', 'measures')
 @api_view(['GET'])
 def measure_numerators_by_org(request, format=None):
     measure = request.query_params.get('measure', None)
@@ -148,7 +150,7 @@ def measure_numerators_by_org(request, format=None):
             'org': org,
             'three_months_ago': three_months_ago,
         }
-        data = utils.execute_query(query, params)
+        data = utils.execute_query(query, params, coalesce=True)
     else:
         data = []
     response = Response(data)
@@ -158,6 +160,7 @@ def measure_numerators_by_org(request, format=None):
     return response
 
 
+@utils.cache_until_import('measures')
 @api_view(['GET'])
 def measure_by_ccg(request, format=None):
     measure_id = request.query_params.get('measure', None)
@@ -168,11 +171,14 @@ def measure_by_ccg(request, format=None):
     measure_values = MeasureValue.objects.by_ccg(org_ids, measure_id, tags)
 
     rsp_data = {
-        'measures': _roll_up_measure_values(measure_values, 'ccg')
+        'measures': utils.single_flight(
+            utils.queryset_key(measure_values),
+            lambda: _roll_up_measure_values(measure_values, 'ccg'))
     }
     return Response(rsp_data)
 
 
+@utils.cache_until_import('measures')
 @api_view(['GET'])
 def measure_by_practice(request, format=None):
     measure_id = request.query_params.get('measure', None)
@@ -185,7 +191,9 @@ def measure_by_practice(request, format=None):
                                                       tags)
 
     rsp_data = {
-        'measures': _roll_up_measure_values(measure_values, 'practice')
+        'measures': utils.single_flight(
+            utils.queryset_key(measure_values),
+            lambda: _roll_up_measure_values(measure_values, 'practice'))
     }
     return Response(rsp_data)
 
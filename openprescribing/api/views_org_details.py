@@ -17,6 +17,7 @@ class KeysNotValid(APIException):
     default_detail = 'The keys you provided are not supported'
 
 
+@utils.cache_until_import('patient_list_size', 'views')
 @api_view(['GET'])
 def org_details(request, format=None):
     '''
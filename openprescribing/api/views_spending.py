@@ -13,14 +13,18 @@ from rest_framework.decorators import api_view
 from rest_framework.response import Response
 from rest_framework.exceptions import APIException
 
+from code_filters import code_filter, collapse_prefixes
 from common.utils import namedtuplefetchall, nhs_titlecase
 from dmd.models import DMDProduct, DMDVmpp, NCSOConcession
 from frontend.models import GenericCodeMapping
 from frontend.models import ImportLog
+from frontend.models import PPUBin
 from frontend.models import PPUSaving
 from frontend.models import Presentation
 from frontend.models import Practice, PCT
+import spending_cube
 import view_utils as utils
+from view_utils import cache_until_import
 from view_utils import db_timeout
 
 
@@ -34,6 +38,11 @@ CODE_LENGTH_ERROR = (
     'for you')
 
 
+# The lengths of codes for each level of the BNF hierarchy that has its
+# own rows in vw__bnf_rollup
+BNF_ROLLUP_CODE_LENGTHS = [2, 4, 6, 7, 9, 11, 15]
+
+
 class NotValid(APIException):
     status_code = 400
     default_detail = 'The code you provided is not valid'
@@ -50,7 +59,7 @@ def _valid_or_latest_date(date):
     return date
 
 
-def _build_conditions_and_patterns(code, focus):
+def _build_conditions_and_params(code, focus):
     if not re.match(r'[A-Z0-9]{15}', code):
         raise NotValid("%s is not a valid code" % code)
     extra_codes = GenericCodeMapping.objects.filter(
@@ -65,17 +74,18 @@ def _build_conditions_and_patterns(code, focus):
         else:
             pattern = "%s____%s" % (extra_code[:9], extra_code[13:15])
         patterns.append(pattern)
-    conditions = " OR ".join(["presentation_code LIKE %s "] * len(patterns))
-    conditions = "AND (%s) " % conditions
+    conditions, params = code_filter('presentation_code', patterns)
+    conditions = "AND %s " % conditions
     if focus:
         if len(focus) == 3:
             conditions += "AND (pct_id = %s)"
         else:
             conditions += "AND (practice_id = %s)"
-        patterns.append(focus)
-    return conditions, patterns
+        params.append(focus)
+    return conditions, params
 
 
+@cache_until_import('prescribing')
 @api_view(['GET'])
 def bubble(request, format=None):
     """Returns data relating to price-per-unit, in a format suitable for
@@ -87,23 +97,11 @@ def bubble(request, format=None):
     date = _valid_or_latest_date(request.query_params.get('date', None))
     highlight = request.query_params.get('highlight', None)
     focus = request.query_params.get('focus', None) and highlight
-    conditions, patterns = _build_conditions_and_patterns(code, focus)
-    rounded_ppus_cte_sql = (
-        "WITH rounded_ppus AS (SELECT presentation_code, "
-        "COALESCE(frontend_presentation.name, 'unknown') "
-        "AS presentation_name, "
-        "quantity, net_cost, practice_id, pct_id, "
-        "ROUND(CAST(net_cost/NULLIF(quantity, 0) AS numeric), 2) AS ppu "
-        "FROM frontend_prescription "
-        "LEFT JOIN frontend_presentation "
-        "ON frontend_prescription.presentation_code = "
-        "frontend_presentation.bnf_code "
-        "LEFT JOIN frontend_practice ON frontend_practice.code = practice_id "
-        "WHERE processing_date = %s "
-        "AND setting = 4 " +
-        conditions +
-        ") "
-    )
+    conditions, condition_params = _build_conditions_and_params(code, focus)
+    # Bins are aggregated by CCG, so can't be focused on a practice
+    use_bins = (not focus or len(focus) == 3) and \
+        PPUBin.objects.filter(date=date).exists()
+    rounded_ppus_cte_sql = _rounded_ppus_cte_sql(conditions, use_bins)
     binned_ppus_sql = rounded_ppus_cte_sql + (
         ", binned_ppus AS (SELECT presentation_code, presentation_name, ppu, "
         "SUM(quantity) AS quantity "
@@ -136,10 +134,14 @@ def bubble(request, format=None):
             "FROM binned_ppus "
             "ORDER BY mean_ppu, presentation_name, ppu"
         )
-    mean_ppu_for_entity_sql = rounded_ppus_cte_sql + (
+    if highlight and len(highlight) != 3:
+        mean_ppu_for_entity_sql = _rounded_ppus_cte_sql(conditions, False)
+    else:
+        mean_ppu_for_entity_sql = rounded_ppus_cte_sql
+    mean_ppu_for_entity_sql += (
         "SELECT SUM(net_cost)/SUM(quantity) FROM rounded_ppus "
     )
-    params = [date] + patterns
+    params = [date] + condition_params
     with connection.cursor() as cursor:
         cursor.execute(ordered_ppus_sql, params)
         series = []
@@ -176,6 +178,46 @@ def bubble(request, format=None):
             {'plotline': plotline, 'series': series, 'categories': categories})
 
 
+def _rounded_ppus_cte_sql(conditions, use_bins):
+    """Return a CTE giving the quantity, net cost and rounded price per
+    unit of prescriptions by standard practices in a month, either
+    from the prescriptions themselves or from their precomputed
+    aggregates in PPUBin (which have no practice_id).
+
+    """
+    if use_bins:
+        return (
+            "WITH rounded_ppus AS (SELECT presentation_code, "
+            "COALESCE(frontend_presentation.name, 'unknown') "
+            "AS presentation_name, "
+            "quantity, net_cost, pct_id, price_per_unit AS ppu "
+            "FROM frontend_ppubin "
+            "LEFT JOIN frontend_presentation "
+            "ON frontend_ppubin.presentation_code = "
+            "frontend_presentation.bnf_code "
+            "WHERE date = %s " +
+            conditions +
+            ") "
+        )
+    return (
+        "WITH rounded_ppus AS (SELECT presentation_code, "
+        "COALESCE(frontend_presentation.name, 'unknown') "
+        "AS presentation_name, "
+        "quantity, net_cost, practice_id, pct_id, "
+        "ROUND(CAST(net_cost/NULLIF(quantity, 0) AS numeric), 2) AS ppu "
+        "FROM frontend_prescription "
+        "LEFT JOIN frontend_presentation "
+        "ON frontend_prescription.presentation_code = "
+        "frontend_presentation.bnf_code "
+        "LEFT JOIN frontend_practice ON frontend_practice.code = practice_id "
+        "WHERE processing_date = %s "
+        "AND setting = 4 " +
+        conditions +
+        ") "
+    )
+
+
+@cache_until_import('ppu', 'ncso_concessions')
 @api_view(['GET'])
 def price_per_unit(request, format=None):
     """Returns price per unit data for presentations and practices or
@@ -291,6 +333,7 @@ def price_per_unit(request, format=None):
     return response
 
 
+@cache_until_import('prescribing', 'views')
 @db_timeout(58000)
 @api_view(['GET'])
 def total_spending(request, format=None):
@@ -302,15 +345,17 @@ def total_spending(request, format=None):
         err = CODE_LENGTH_ERROR
         return Response(err, status=400)
 
-    query = _get_query_for_total_spending(codes)
+    cube = spending_cube.get_cube()
+    if cube and cube.covers(codes):
+        return Response(cube.total_spending(codes))
 
-    if spending_type != 'presentation':
-        codes = [c + '%' for c in codes]
+    query, code_params = _get_query_for_total_spending(codes, spending_type)
 
-    data = utils.execute_query(query, [codes])
+    data = utils.execute_query(query, [code_params], coalesce=True)
     return Response(data)
 
 
+@cache_until_import('tariff', 'ncso_concessions')
 @api_view(['GET'])
 def tariff(request, format=None):
     # This view uses raw SQL as we cannot produce the LEFT OUTER JOIN using the
@@ -354,6 +399,7 @@ def tariff(request, format=None):
     return response
 
 
+@cache_until_import('prescribing', 'views')
 @db_timeout(58000)
 @api_view(['GET'])
 def spending_by_ccg(request, format=None):
@@ -366,20 +412,25 @@ def spending_by_ccg(request, format=None):
         err = CODE_LENGTH_ERROR
         return Response(err, status=400)
 
-    if not spending_type or spending_type == 'bnf-section' \
-       or spending_type == 'chemical':
-        query = _get_query_for_chemicals_or_sections_by_ccg(codes, orgs,
-                                                            spending_type)
-    else:
-        query = _get_query_for_presentations_by_ccg(codes, orgs)
+    cube = spending_cube.get_cube()
+    if cube and cube.covers(codes):
+        return Response(cube.spending_by_ccg(codes, orgs))
 
     if spending_type == 'bnf-section' or spending_type == 'product':
         codes = [c + '%' for c in codes]
 
-    data = utils.execute_query(query, [codes, orgs])
+    if not spending_type or spending_type == 'bnf-section' \
+       or spending_type == 'chemical':
+        query, code_params = _get_query_for_chemicals_or_sections_by_ccg(
+            codes, orgs, spending_type)
+    else:
+        query, code_params = _get_query_for_presentations_by_ccg(codes, orgs)
+
+    data = utils.execute_query(query, [code_params, orgs], coalesce=True)
     return Response(data)
 
 
+@cache_until_import('prescribing', 'views')
 @db_timeout(58000)
 @api_view(['GET'])
 def spending_by_practice(request, format=None):
@@ -401,31 +452,27 @@ def spending_by_practice(request, format=None):
         err += 'date=2015-04-01'
         return Response(err, status=400)
 
-    org_for_param = None
+    code_params = []
     if not spending_type or spending_type == 'bnf-section' \
        or spending_type == 'chemical':
-        # We can do presentation queries indexed by PCT ID, which is faster.
-        # We have yet to update the *_by_practice matviews with PCT ID.
-        # So for these queries, expand the CCG ID to a list of practice IDs.
-        expanded_orgs = utils.get_practice_ids_from_org(orgs)
         if codes:
-            query = _get_chemicals_or_sections_by_practice(codes,
-                                                           expanded_orgs,
-                                                           spending_type,
-                                                           date)
-            org_for_param = expanded_orgs
+            query, code_params = _get_chemicals_or_sections_by_practice(
+                codes, orgs, spending_type, date)
         else:
-            query = _get_total_spending_by_practice(expanded_orgs, date)
-            org_for_param = expanded_orgs
+            query = _get_total_spending_by_practice(orgs, date)
     else:
-        query = _get_presentations_by_practice(codes, orgs, date)
-        org_for_param = orgs
-    data = utils.execute_query(
-        query, [codes, org_for_param, [date] if date else []])
+        query, code_params = _get_presentations_by_practice(codes, orgs, date)
+    params = [code_params, orgs, [date] if date else []]
+    if request.accepted_renderer.format in ['csv', 'jsonl']:
+        # These can be very large, so we stream them rather than
+        # building the whole result set in memory
+        return utils.streaming_response(
+            query, params, request.accepted_renderer.format)
+    data = utils.execute_query(query, params, coalesce=True)
     return Response(data)
 
 
-def _get_query_for_total_spending(codes):
+def _get_query_for_total_spending(codes, spending_type):
     # The CTE at the start ensures we return rows for every month in
     # the last five years, even if that's zeros
     query = """WITH all_dates AS (
@@ -448,26 +495,32 @@ def _get_query_for_total_spending(codes):
                  COALESCE(SUM(quantity), 0) AS quantity,
                  all_dates.date::date AS date
                FROM (
-                 SELECT *
-                 FROM
-                   vw__presentation_summary
                  %s
                ) pr
                RIGHT OUTER JOIN all_dates
                ON all_dates.date = pr.processing_date
                GROUP BY date
                ORDER BY date;"""
-    if codes:
-        condition = " WHERE ("
-        for i, c in enumerate(codes):
-            condition += "presentation_code LIKE %s "
-            if (i != len(codes) - 1):
-                condition += ' OR '
-        condition += ") "
+    if codes and all(len(c) in BNF_ROLLUP_CODE_LENGTHS for c in codes):
+        # Every code is a node in the BNF hierarchy, so we can look up
+        # its totals directly
+        source = """SELECT
+                     processing_date, items, quantity, actual_cost AS cost
+                   FROM
+                     vw__bnf_rollup
+                   WHERE
+                     bnf_code = ANY(%s)"""
+        params = [collapse_prefixes(codes)]
     else:
-        condition = ""
+        source = "SELECT * FROM vw__presentation_summary"
+        params = []
+        if codes:
+            if spending_type != 'presentation':
+                codes = [c + '%' for c in codes]
+            condition, params = code_filter('presentation_code', codes)
+            source += " WHERE %s" % condition
 
-    return query % condition
+    return query % source, params
 
 
 def _get_query_for_chemicals_or_sections_by_ccg(codes, orgs, spending_type):
@@ -480,20 +533,10 @@ def _get_query_for_chemicals_or_sections_by_ccg(codes, orgs, spending_type):
     query += "FROM vw__chemical_summary_by_ccg pr "
     query += "JOIN frontend_pct pc ON pr.pct_id=pc.code "
     query += "AND pc.org_type='CCG' "
+    code_params = []
     if spending_type:
-        query += " WHERE ("
-        if spending_type == 'bnf-section':
-            for i, c in enumerate(codes):
-                query += "pr.chemical_id LIKE %s "
-                if (i != len(codes) - 1):
-                    query += ' OR '
-            codes = [c + '%' for c in codes]
-        else:
-            for i, c in enumerate(codes):
-                query += "pr.chemical_id=%s "
-                if (i != len(codes) - 1):
-                    query += ' OR '
-        query += ") "
+        condition, code_params = code_filter('pr.chemical_id', codes)
+        query += " WHERE %s " % condition
     if orgs:
         query += "AND ("
         for i, org in enumerate(orgs):
@@ -503,7 +546,7 @@ def _get_query_for_chemicals_or_sections_by_ccg(codes, orgs, spending_type):
         query += ") "
     query += "GROUP BY pc.code, pc.name, date "
     query += "ORDER BY date, pc.code "
-    return query
+    return query, code_params
 
 
 def _get_query_for_presentations_by_ccg(codes, orgs):
@@ -516,20 +559,18 @@ def _get_query_for_presentations_by_ccg(codes, orgs):
     query += "FROM vw__presentation_summary_by_ccg pr "
     query += "JOIN frontend_pct pc ON pr.pct_id=pc.code "
     query += "AND pc.org_type='CCG' "
-    query += " WHERE ("
-    for i, c in enumerate(codes):
-        query += "pr.presentation_code LIKE %s "
-        if (i != len(codes) - 1):
-            query += ' OR '
+    condition, code_params = code_filter('pr.presentation_code', codes)
+    query += " WHERE %s " % condition
     if orgs:
-        query += ") AND ("
+        query += "AND ("
         for i, org in enumerate(orgs):
             query += "pr.pct_id=%s "
             if (i != len(orgs) - 1):
                 query += ' OR '
-    query += ") GROUP BY pc.code, pc.name, date "
+        query += ") "
+    query += "GROUP BY pc.code, pc.name, date "
     query += "ORDER BY date, pc.code"
-    return query
+    return query, code_params
 
 
 def _get_total_spending_by_practice(orgs, date):
@@ -538,28 +579,29 @@ def _get_total_spending_by_practice(orgs, date):
     query += "pc.setting AS setting, "
     query += "pc.ccg_id AS ccg, "
     query += 'pr.processing_date AS date, '
-    query += 'pr.cost AS actual_cost, '
-    query += 'pr.items AS items, '
-    query += 'pr.quantity AS quantity '
+    query += 'SUM(pr.cost) AS actual_cost, '
+    query += 'SUM(pr.items) AS items, '
+    query += 'SUM(pr.quantity) AS quantity '
     query += "FROM vw__practice_summary pr "
     query += "JOIN frontend_practice pc ON pr.practice_id=pc.code "
     if orgs or date:
         query += "WHERE "
-    if date:
-        query += "pr.processing_date=%s "
     if orgs:
-        if date:
-            query += "AND "
         query += "("
         for i, org in enumerate(orgs):
-            query += "pr.practice_id=%s "
-            # if len(org) == 3:
-            #     query += "pr.pct_id=%s "
-            # else:
-            #     query += "pr.practice_id=%s "
+            if len(org) == 3:
+                query += "pr.pct_id=%s "
+            else:
+                query += "pr.practice_id=%s "
             if (i != len(orgs) - 1):
                 query += ' OR '
         query += ") "
+    if date:
+        if orgs:
+            query += "AND "
+        query += "pr.processing_date=%s "
+    # A practice may be recorded against more than one CCG in a month
+    query += "GROUP BY pr.practice_id, pc.name, pc.setting, pc.ccg_id, date "
     query += "ORDER BY date, pr.practice_id "
     return query
 
@@ -577,32 +619,21 @@ def _get_chemicals_or_sections_by_practice(codes, orgs, spending_type,
     query += "FROM vw__chemical_summary_by_practice pr "
     query += "JOIN frontend_practice pc ON pr.practice_id=pc.code "
     has_preceding = False
+    code_params = []
     if spending_type:
         has_preceding = True
-        query += " WHERE ("
-        if spending_type == 'bnf-section':
-            for i, c in enumerate(codes):
-                query += "pr.chemical_id LIKE %s "
-                if (i != len(codes) - 1):
-                    query += ' OR '
-            codes = [c + '%' for c in codes]
-        else:
-            for i, c in enumerate(codes):
-                query += "pr.chemical_id=%s "
-                if (i != len(codes) - 1):
-                    query += ' OR '
-        query += ") "
+        condition, code_params = code_filter('pr.chemical_id', codes)
+        query += " WHERE %s " % condition
     if orgs:
         if has_preceding:
             query += " AND ("
         else:
             query += " WHERE ("
         for i, org in enumerate(orgs):
-            query += "pr.practice_id=%s "
-            # if len(org) == 3:
-            #     query += "pr.pct_id=%s "
-            # else:
-            #     query += "pr.practice_id=%s "
+            if len(org) == 3:
+                query += "pr.pct_id=%s "
+            else:
+                query += "pr.practice_id=%s "
             if (i != len(orgs) - 1):
                 query += ' OR '
         query += ") "
@@ -615,7 +646,7 @@ def _get_chemicals_or_sections_by_practice(codes, orgs, spending_type,
         query += "pr.processing_date=%s) "
     query += "GROUP BY pc.code, pc.name, date "
     query += "ORDER BY date, pc.code"
-    return query
+    return query, code_params
 
 
 def _get_presentations_by_practice(codes, orgs, date):
@@ -629,13 +660,10 @@ def _get_presentations_by_practice(codes, orgs, date):
     query += 'CAST(SUM(pr.quantity) AS bigint) AS quantity '
     query += "FROM frontend_prescription pr "
     query += "JOIN frontend_practice pc ON pr.practice_id=pc.code "
-    query += "WHERE ("
-    for i, c in enumerate(codes):
-        query += "pr.presentation_code LIKE %s "
-        if (i != len(codes) - 1):
-            query += ' OR '
+    condition, code_params = code_filter('pr.presentation_code', codes)
+    query += "WHERE %s " % condition
     if orgs:
-        query += ") AND ("
+        query += "AND ("
         for i, c in enumerate(orgs):
             if len(c) == 3:
                 query += "pr.pct_id=%s "
@@ -643,8 +671,9 @@ def _get_presentations_by_practice(codes, orgs, date):
                 query += "pr.practice_id=%s "
             if (i != len(orgs) - 1):
                 query += ' OR '
+        query += ") "
     if date:
         query += "AND pr.processing_date=%s "
-    query += ") GROUP BY pc.code, pc.name, date "
+    query += "GROUP BY pc.code, pc.name, date "
     query += "ORDER BY date, pc.code"
-    return query
+    return query, code_params
@@ -0,0 +1,160 @@
+"""Sort CSV data that is too big to sort in memory.
+
+We sort CSVs before COPYing them into Postgres, so that rows are
+loaded in roughly the order they are queried in, which is like
+CLUSTERing the table but much cheaper.
+
+Rows are read into runs of up to `memory_mb / (workers + 1)`
+megabytes.  Each run is sorted by a pool of worker processes and
+written to a temporary file.  The parent process holds only the run it
+is reading, while each worker holds the run it is sorting, so no more
+than about `memory_mb` is used for rows at once.  The sorted runs are then merged as they are read
+from a file-like object, which can be passed straight to
+`cursor.copy_expert()`.  Input that fits in a single run is sorted in
+memory.
+
+Unlike `sort -t,`, fields are parsed with the csv module, so quoted
+fields that contain commas are handled correctly.  Values are compared
+as strings.
+
+"""
+
+from multiprocessing.pool import Pool
+from operator import itemgetter
+import csv
+import heapq
+import itertools
+import logging
+import os
+import shutil
+import tempfile
+import time
+
+from common.utils import ChunkReader
+from common.utils import csv_chunks
+
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_MEMORY_MB = 1024
+DEFAULT_WORKERS = 4
+
+# A rough estimate of the memory used by each field of a row, other
+# than its contents
+FIELD_OVERHEAD = 50
+
+
+def sort_csv(f_in, field_names, sort_keys, memory_mb=DEFAULT_MEMORY_MB,
+             workers=DEFAULT_WORKERS, tmp_dir=None):
+    """Return a file-like object from which the rows of the CSV in `f_in`
+    can be read, sorted by the columns named in `sort_keys`.
+
+    `field_names` gives the names of the columns of `f_in`, which should
+    not have a header line.  Temporary files are written to `tmp_dir`.
+
+    All of `f_in` is read and the runs are sorted before this returns;
+    the runs are merged as the result is read.
+
+    """
+    key_ixs = [field_names.index(key) for key in sort_keys]
+    run_size = memory_mb * 1024 * 1024 / (workers + 1)
+    start = time.time()
+
+    runs = _read_runs(csv.reader(f_in), run_size)
+    first_run = next(runs, [])
+    second_run = next(runs, None)
+    if second_run is None:
+        first_run.sort(key=itemgetter(*key_ixs))
+        logger.info('Sorted %s rows in memory in %.1fs',
+                    len(first_run), time.time() - start)
+        return ChunkReader(csv_chunks(first_run))
+
+    run_dir = tempfile.mkdtemp(dir=tmp_dir)
+    try:
+        runs = itertools.chain(
+            _pop_all([first_run, second_run]), runs)
+        del first_run, second_run
+        paths = _sort_runs(runs, key_ixs, workers, run_dir)
+        logger.info('Sorted %s runs in %.1fs', len(paths),
+                    time.time() - start)
+        # The runs stay readable through these open files once their
+        # directory has been removed, so nothing is left behind however
+        # much of the result is read
+        files = [open(path, 'rb') for path in paths]
+    finally:
+        shutil.rmtree(run_dir)
+    return ChunkReader(_merge_runs(files, key_ixs))
+
+
+def _sort_runs(runs, key_ixs, workers, run_dir):
+    """Sort each run in a pool of worker processes, and return the paths
+    of the files the sorted runs were written to."""
+    pool = Pool(workers)
+    try:
+        # Only hand a worker a run once one is free, so that runs aren't
+        # queued up waiting to be sorted
+        pending = []
+        paths = []
+        for ix, run in enumerate(runs):
+            path = os.path.join(run_dir, 'run_{:06d}.csv'.format(ix))
+            pending.append(pool.apply_async(_sort_run, [run, key_ixs, path]))
+            del run
+            if len(pending) == workers:
+                paths.append(pending.pop(0).get())
+        paths.extend(result.get() for result in pending)
+    finally:
+        pool.terminate()
+    return paths
+
+
+def _pop_all(items):
+    """Yield the items of a list, removing each one as it is yielded
+    so that the list doesn't keep it alive."""
+    while items:
+        yield items.pop(0)
+
+
+def _merge_runs(files, key_ixs):
+    start = time.time()
+    try:
+        merged = heapq.merge(*[
+            _keyed_rows(csv.reader(f), key_ixs) for f in files])
+        for chunk in csv_chunks(row for _, row in merged):
+            yield chunk
+    finally:
+        for f in files:
+            f.close()
+    logger.info('Merged %s runs in %.1fs', len(files), time.time() - start)
+
+
+def _read_runs(reader, run_size):
+    """Yield lists of rows whose total estimated size is about
+    `run_size` bytes."""
+    run = []
+    size = 0
+    for row in reader:
+        run.append(row)
+        size += sum(len(value) for value in row) + FIELD_OVERHEAD * len(row)
+        if size >= run_size:
+            yield run
+            run = []
+            size = 0
+    if run:
+        yield run
+
+
+def _sort_run(rows, key_ixs, path):
+    """Sort a run and write it to `path`.  Run in a worker process."""
+    rows.sort(key=itemgetter(*key_ixs))
+    with open(path, 'wb') as f:
+        writer = csv.writer(f, lineterminator='\n')
+        writer.writerows(rows)
+    return path
+
+
+def _keyed_rows(reader, key_ixs):
+    """Yield (key, row) pairs, so that rows from several runs can be
+    merged with heapq.merge."""
+    key = itemgetter(*key_ixs)
+    for row in reader:
+        yield key(row), row
@@ -4,6 +4,7 @@ from datetime import datetime
 from os import environ
 from titlecase import titlecase
 import argparse
+import csv
 import hashlib
 import html2text
 import logging
@@ -185,3 +186,86 @@ def namedtuplefetchall(cursor):
     desc = cursor.description
     nt_result = namedtuple('Result', [col[0] for col in desc])
     return [nt_result(*row) for row in cursor.fetchall()]
+
+
+class ChunkReader(object):
+    '''A read-only file-like object over an iterator of strings.'''
+
+    def __init__(self, chunks):
+        self._chunks = iter(chunks)
+        self._chunk = ''
+        self._pos = 0
+
+    def _next_chunk(self):
+        '''Move on to the next non-empty chunk, returning False if there
+        are none left.'''
+        while self._pos >= len(self._chunk):
+            try:
+                self._chunk = next(self._chunks)
+            except StopIteration:
+                return False
+            self._pos = 0
+        return True
+
+    def read(self, size=-1):
+        parts = []
+        while size != 0 and self._next_chunk():
+            if size < 0:
+                end = len(self._chunk)
+            else:
+                end = min(len(self._chunk), self._pos + size)
+                size -= end - self._pos
+            parts.append(self._chunk[self._pos:end])
+            self._pos = end
+        return ''.join(parts)
+
+    def readline(self):
+        parts = []
+        while self._next_chunk():
+            end = self._chunk.find('\n', self._pos) + 1 or len(self._chunk)
+            parts.append(self._chunk[self._pos:end])
+            self._pos = end
+            if parts[-1].endswith('\n'):
+                break
+        return ''.join(parts)
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        line = self.readline()
+        if not line:
+            raise StopIteration
+        return line
+
+
+def csv_chunks(rows, chunk_size=1024 * 1024):
+    '''Yield the given rows as CSV, in blocks of about chunk_size bytes.
+
+    Together with ChunkReader, this lets rows be streamed into
+    `cursor.copy_expert()` without writing them to a file first.
+    '''
+    buf = _Buffer()
+    writer = csv.writer(buf, lineterminator='\n')
+    for row in rows:
+        writer.writerow(row)
+        if buf.size >= chunk_size:
+            yield buf.pop()
+    if buf.size:
+        yield buf.pop()
+
+
+class _Buffer(object):
+    def __init__(self):
+        self.parts = []
+        self.size = 0
+
+    def write(self, data):
+        self.parts.append(data)
+        self.size += len(data)
+
+    def pop(self):
+        data = ''.join(self.parts)
+        self.parts = []
+        self.size = 0
+        return data
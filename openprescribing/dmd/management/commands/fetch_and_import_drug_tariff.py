@@ -2,6 +2,7 @@
 Fetches Drug Tariff from NHSBSA website, and saves to CSV
 """
 from cStringIO import StringIO
+import csv
 import datetime
 from urlparse import urljoin
 import logging
@@ -15,6 +16,7 @@ import calendar
 from openpyxl import load_workbook
 
 from django.core.management import BaseCommand
+from django.db import connection
 from django.db import transaction
 
 from gcutils.bigquery import Client
@@ -93,21 +95,25 @@ def import_month(xls_file, date):
         'basic price'
     ]
 
-    with transaction.atomic():
-        for row in rows[3:]:
-            values = [c.value for c in row]
-            if all(v is None for v in values):
-                continue
+    product_ids = ProductIds()
+    prices = []
+    for row in rows[3:]:
+        values = [c.value for c in row]
+        if all(v is None for v in values):
+            continue
+
+        d = dict(zip(headers, values))
 
-            d = dict(zip(headers, values))
+        prices.append((
+            date,
+            d['vmpp snomed code'],
+            product_ids.get(d['vmpp snomed code']),
+            get_tariff_cat_id(d['drug tariff category']),
+            int(d['basic price'])
+        ))
 
-            TariffPrice.objects.get_or_create(
-                date=date,
-                vmpp_id=d['vmpp snomed code'],
-                product_id=get_product_id(d['vmpp snomed code']),
-                tariff_category_id=get_tariff_cat_id(d['drug tariff category']),
-                price_pence=int(d['basic price'])
-            )
+    with transaction.atomic():
+        upsert_tariff_prices(prices)
 
         ImportLog.objects.create(
             category='tariff',
@@ -127,17 +133,68 @@ def get_tariff_cat_id(cat):
         assert False, 'Unknown category: {}'.format(cat)
 
 
-def get_product_id(vmpp):
-    try:
-        vpid = DMDVmpp.objects.get(pk=vmpp).vpid
-    except DMDVmpp.DoesNotExist:
-        logger.exception("Could not find VMPP with id %s", vmpp)
-        raise
-
-    try:
-        product = DMDProduct.objects.get(vpid=vpid, concept_class=1)
-    except DMDProduct.DoesNotExist:
-        logger.exception("Could not find DMD product with VPID %s", vpid)
-        raise
-
-    return product.pk
+class ProductIds(object):
+    """Map VMPP ids to the ids of their VMPs' DMDProducts.
+
+    All VMPPs and VMPs are loaded up front, rather than being queried for
+    each row of the tariff.
+    """
+
+    def __init__(self):
+        self.vpids = dict(DMDVmpp.objects.values_list('vppid', 'vpid'))
+        self.product_ids = dict(
+            DMDProduct.objects.filter(concept_class=1)
+            .values_list('vpid', 'dmdid'))
+
+    def get(self, vmpp):
+        try:
+            vpid = self.vpids[int(vmpp)]
+        except KeyError:
+            logger.error("Could not find VMPP with id %s", vmpp)
+            raise DMDVmpp.DoesNotExist(vmpp)
+
+        try:
+            return self.product_ids[vpid]
+        except KeyError:
+            logger.error("Could not find DMD product with VPID %s", vpid)
+            raise DMDProduct.DoesNotExist(vpid)
+
+
+def upsert_tariff_prices(prices):
+    """Insert or update TariffPrices for the given (date, vmpp_id,
+    product_id, tariff_category_id, price_pence) tuples.
+
+    The prices are COPYed into a temporary table, from which they are
+    upserted with a single statement.  Should be called in a
+    transaction.
+    """
+    columns = [
+        'date', 'vmpp_id', 'product_id', 'tariff_category_id', 'price_pence']
+    buf = StringIO()
+    writer = csv.writer(buf)
+    for ix, price in enumerate(prices):
+        writer.writerow((ix,) + tuple(price))
+    buf.seek(0)
+
+    with connection.cursor() as cursor:
+        cursor.execute(
+            "CREATE TEMPORARY TABLE tariffprice_staging ("
+            "ix integer, date date, vmpp_id bigint, product_id bigint, "
+            "tariff_category_id integer, price_pence integer)")
+        cursor.copy_expert(
+            "COPY tariffprice_staging FROM STDIN WITH CSV", buf)
+        # A row can only be upserted once per statement, so if a VMPP
+        # appears more than once for a date, the last price wins
+        cursor.execute("""
+            INSERT INTO {table} ({columns})
+            SELECT DISTINCT ON (date, vmpp_id) {columns}
+            FROM tariffprice_staging
+            ORDER BY date, vmpp_id, ix DESC
+            ON CONFLICT (date, vmpp_id) DO UPDATE SET
+              product_id = EXCLUDED.product_id,
+              tariff_category_id = EXCLUDED.tariff_category_id,
+              price_pence = EXCLUDED.price_pence
+        """.format(table=TariffPrice._meta.db_table,
+                   columns=', '.join(columns)))
+        logger.info("Upserted %s tariff prices", cursor.rowcount)
+        cursor.execute("DROP TABLE tariffprice_staging")
@@ -11,6 +11,7 @@ import requests
 from django.core.management import BaseCommand
 
 from dmd.models import NCSOConcession, DMDVmpp
+from frontend.models import ImportLog
 from gcutils.bigquery import Client
 from openprescribing.slack import notify_slack
 
@@ -19,7 +20,7 @@ logger = logging.getLogger(__file__)
 
 class Command(BaseCommand):
     def handle(self, *args, **kwargs):
-        self.vmpps = DMDVmpp.objects.values('nm', 'vppid')
+        self.matcher = VmppMatcher()
         self.counter = {
             'new-and-matched': 0,
             'new-and-unmatched': 0,
@@ -36,6 +37,13 @@ class Command(BaseCommand):
 
         Client('dmd').upload_model(NCSOConcession)
 
+        latest = NCSOConcession.objects.order_by('-date').first()
+        if latest is not None:
+            ImportLog.objects.create(
+                current_at=latest.date,
+                category='ncso_concessions'
+            )
+
         msg = '\n'.join([
             'Imported NCSO concessions',
             'New and matched: %s' % self.counter['new-and-matched'],
@@ -144,29 +152,65 @@ class Command(BaseCommand):
         self.counter[status] += 1
 
     def get_matching_vmpp_id(self, concession):
-        previous_concession = NCSOConcession.objects.filter(
-            drug=concession.drug,
-            pack_size=concession.pack_size,
-        ).exclude(
-            date=concession.date
-        ).first()
-
-        if previous_concession is not None:
+        return self.matcher.match(concession)
+
+
+class VmppMatcher(object):
+    """Match NCSO concessions to VMPPs.
+
+    The names of all VMPPs, and the VMPPs matched to all previous
+    concessions, are loaded once, so that each concession can be matched
+    with a couple of dictionary lookups.
+    """
+
+    def __init__(self):
+        # Maps normalised VMPP names to VMPP ids, and also maps each
+        # prefix of a name that ends at a word boundary, so that names
+        # with extra words at the end can be matched
+        self.vmpps_by_name = {}
+        self.vmpps_by_prefix = {}
+        for vppid, nm in DMDVmpp.objects.values_list('vppid', 'nm'):
+            name = re.sub(' */ *', '/', nm.lower())
+            self.vmpps_by_name.setdefault(name, vppid)
+            for match in re.finditer(' ', name):
+                self.vmpps_by_prefix.setdefault(name[:match.start()], vppid)
+
+        # Maps (drug, pack size) to the VMPP id of a previous concession
+        self.previous_matches = {}
+        for drug, pack_size, vmpp_id in NCSOConcession.objects.values_list(
+                'drug', 'pack_size', 'vmpp_id'):
+            self.remember(drug, pack_size, vmpp_id)
+
+    def match(self, concession):
+        """Return the id of the VMPP matching the given concession, or None
+        if there is no match.
+
+        The concession is remembered, so that later concessions for the
+        same drug and pack size are given the same VMPP.
+        """
+        key = (concession.drug, concession.pack_size)
+        if key in self.previous_matches:
             logger.info('Found previous matching concession')
-            return previous_concession.vmpp_id
+            return self.previous_matches[key]
 
         ncso_name_raw = u'{} {}'.format(concession.drug, concession.pack_size)
         ncso_name = self.regularise_ncso_name(ncso_name_raw)
 
-        for vmpp in self.vmpps:
-            vpmm_name = re.sub(' */ *', '/', vmpp['nm'].lower())
-
-            if vpmm_name == ncso_name or vpmm_name.startswith(ncso_name + ' '):
-                logger.info('Found match')
-                return vmpp['vppid']
+        vppid = self.vmpps_by_name.get(ncso_name)
+        if vppid is None:
+            vppid = self.vmpps_by_prefix.get(ncso_name)
 
-        logger.info('No match found')
-        return None
+        if vppid is not None:
+            logger.info('Found match')
+        else:
+            logger.info('No match found')
+        self.remember(concession.drug, concession.pack_size, vppid)
+        return vppid
+
+    def remember(self, drug, pack_size, vmpp_id):
+        # Prefer previous concessions that were matched to a VMPP
+        if self.previous_matches.get((drug, pack_size)) is None:
+            self.previous_matches[(drug, pack_size)] = vmpp_id
 
     def regularise_ncso_name(self, name):
         # Some NCSO records have non-breaking spaces
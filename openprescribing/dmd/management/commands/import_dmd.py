@@ -39,6 +39,7 @@ communication.
 
 """
 
+from cStringIO import StringIO
 from lxml import etree
 import logging
 import glob
@@ -70,6 +71,19 @@ EXTRA_INDEXES = [
     'nurse_f'
 ]
 
+GTIN_TABLE_INFO = {
+    'table_name': 'dmd_gtin',
+    'columns': (
+        ('appid', 'bigint'),
+        ('startdt', 'date'),
+        ('enddt', 'date'),
+        ('gtin', 'text'),
+    )
+}
+
+# Number of rows to buffer for each table before COPYing them
+COPY_BATCH_SIZE = 10000
+
 PG_TYPE_MAP = {
     'xs:date': 'date',
     'xs:string': 'text',
@@ -79,39 +93,114 @@ PG_TYPE_MAP = {
 
 
 def create_table(info):
+    """Create a table without any indexes, which are added by
+    `create_indexes()` once the data has been loaded.
+
+    """
     sql = 'DROP TABLE IF EXISTS "%s" CASCADE' % info['table_name']
     with connection.cursor() as cursor:
         cursor.execute(sql.lower())
         sql = 'CREATE TABLE "%s" (' % info['table_name']
         cols = []
-        indexes = []
         for name, coltype in info['columns']:
-            row_sql = '"%s" %s' % (name, coltype)
-            if name == PRIMARY_KEYS.get(info['table_name'], ''):
-                row_sql += " PRIMARY KEY"
-            elif any([name in x
-                      for x in PRIMARY_KEYS.values() + EXTRA_INDEXES]):
-                indexes.append(name)
-            cols.append(row_sql)
+            cols.append('"%s" %s' % (name, coltype))
         sql += ', '.join(cols)
         sql += ");"
         cursor.execute(sql.lower())
-        for i in indexes:
-            sql = 'CREATE INDEX IF NOT EXISTS i_%s_%s ON "%s"("%s");' % (
-                info['table_name'], i, info['table_name'], i)
+
+
+def create_indexes(info):
+    table_name = info['table_name']
+    with connection.cursor() as cursor:
+        for name, coltype in info['columns']:
+            if name == PRIMARY_KEYS.get(table_name, ''):
+                sql = 'ALTER TABLE "%s" ADD PRIMARY KEY ("%s");' % (
+                    table_name, name)
+            elif any([name in x
+                      for x in PRIMARY_KEYS.values() + EXTRA_INDEXES]):
+                sql = 'CREATE INDEX IF NOT EXISTS i_%s_%s ON "%s"("%s");' % (
+                    table_name, name, table_name, name)
+            else:
+                continue
             cursor.execute(sql.lower())
 
 
-def insert_row(cursor, table_info, row_data):
-    sql = 'INSERT INTO %s (%s) VALUES (%s)'
-    table_name = table_info['table_name']
-    cols = []
-    vals = []
-    for col, val in row_data:
-        cols.append('"%s"' % col)
-        vals.append(val)
-    sql = sql % (table_name, ','.join(cols), ','.join(['%s'] * len(vals)))
-    cursor.execute(sql.lower(), vals)
+class CopyWriter(object):
+    """Buffer rows for a table, and write them with COPY in batches of
+    COPY_BATCH_SIZE rows.
+
+    """
+    def __init__(self, cursor, table_info):
+        self.cursor = cursor
+        self.table_name = table_info['table_name']
+        self.columns = [name for name, coltype in table_info['columns']]
+        self.buf = StringIO()
+        self.row_count = 0
+
+    def write(self, values):
+        self.buf.write(
+            '\t'.join(_copy_value(value) for value in values) + '\n')
+        self.row_count += 1
+        if self.row_count % COPY_BATCH_SIZE == 0:
+            self.flush()
+
+    def flush(self):
+        if self.buf.tell() == 0:
+            return
+        sql = 'COPY "%s" (%s) FROM STDIN' % (
+            self.table_name,
+            ', '.join('"%s"' % column for column in self.columns))
+        self.buf.seek(0)
+        self.cursor.copy_expert(sql.lower(), self.buf)
+        self.buf = StringIO()
+
+
+def _copy_value(value):
+    """Format a value for COPY's text format."""
+    if value is None:
+        return '\\N'
+    if isinstance(value, unicode):
+        value = value.encode('utf8')
+    return (value.replace('\\', '\\\\').replace('\t', '\\t')
+            .replace('\n', '\\n').replace('\r', '\\r'))
+
+
+def iter_elements(path):
+    """Parse the XML at `path` incrementally, yielding the root element
+    and each of its children and grandchildren as they are completed.
+
+    Table rows are either the children of the root element (e.g. `VTM`
+    in `VIRTUAL_THERAPEUTIC_MOIETIES/VTM`) or its grandchildren
+    (e.g. `VMPP` in `VIRTUAL_MED_PRODUCT_PACK/VMPPS/VMPP`).  Elements
+    should be passed to `release()` once they have been processed, so
+    that memory use doesn't grow with the size of the file.
+
+    """
+    root = None
+    depth = 0
+    for event, element in etree.iterparse(path, events=('start', 'end')):
+        if event == 'start':
+            if root is None:
+                root = element
+            depth += 1
+            continue
+        depth -= 1
+        if depth in (1, 2):
+            yield root, element
+
+
+def release(element):
+    """Free the memory used by an element, and by any of its preceding
+    siblings."""
+    element.clear()
+    while element.getprevious() is not None:
+        del element.getparent()[0]
+
+
+def _text(element):
+    if element is None:
+        return None
+    return element.text
 
 
 def get_table_info(source_directory, schema_names):
@@ -125,15 +214,7 @@ def get_table_info(source_directory, schema_names):
         # We manually set up GTIN, but programmatically do the others
         # based on parsing the XSD files.
         if 'gtin' in schema_name:
-            all_tables['dmd_gtin'] = {
-                'table_name': 'dmd_gtin',
-                'columns': (
-                    ('appid', 'bigint'),
-                    ('startdt', 'date'),
-                    ('enddt', 'date'),
-                    ('gtin', 'text'),
-                )
-            }
+            all_tables['dmd_gtin'] = GTIN_TABLE_INFO
             continue
         xmlschema_doc = etree.parse("%s/%s" % (source_directory, schema_name))
         ns = {"xs": "http://www.w3.org/2001/XMLSchema"}
@@ -200,6 +281,7 @@ def create_all_tables(source_directory):
     table_info = get_table_info(source_directory, files)
     for name, info in table_info.items():
         create_table(info)
+    return table_info
 
 
 def create_dmd_product():
@@ -214,24 +296,49 @@ def create_dmd_product():
 
 
 def process_gtin(cursor, f):
-    doc = etree.parse(f)
-    root = doc.getroot()
-    rows = root.findall(".//AMPP")
-    table_info = {'table_name': 'dmd_gtin'}
-    for row in rows:
-        appid = row.find('AMPPID').text
-        start_date = row.find('GTINDATA/STARTDT').text
-        end_date = row.find('GTINDATA/ENDDT')
-        if end_date is not None:
-            end_date = end_date.text
-        gtin = row.find('GTINDATA/GTIN').text
-        row_data = [
-            ('appid', appid),
-            ('startdt', start_date),
-            ('enddt', end_date),
-            ('gtin', gtin)
-        ]
-        insert_row(cursor, table_info, row_data)
+    writer = CopyWriter(cursor, GTIN_TABLE_INFO)
+    for _, element in iter_elements(f):
+        if element.tag == 'AMPP':
+            writer.write([
+                _text(element.find('AMPPID')),
+                _text(element.find('GTINDATA/STARTDT')),
+                _text(element.find('GTINDATA/ENDDT')),
+                _text(element.find('GTINDATA/GTIN')),
+            ])
+            release(element)
+        elif element.getparent().getparent() is None:
+            release(element)
+    writer.flush()
+
+
+def process_datafile(cursor, source_directory, f):
+    writers = None
+    for root, element in iter_elements(f):
+        if writers is None:
+            # Set up a writer for each table described by the schema
+            # that the file refers to, keyed by the path to its rows
+            ns = ('{http://www.w3.org/2001/XMLSchema-instance}'
+                  'noNamespaceSchemaLocation')
+            schema = root.attrib[ns]
+            table_info = get_table_info(source_directory, [schema])
+            writers = {}
+            for table_name, info in table_info.items():
+                writers[info['node_name']] = (
+                    info, CopyWriter(cursor, info))
+        parent = element.getparent()
+        match = (writers.get('%s/%s' % (parent.tag, element.tag)) or
+                 writers.get(element.tag))
+        if match is not None:
+            info, writer = match
+            writer.write([
+                _text(element.find(name))
+                for name, col_type in info['columns']])
+            release(element)
+        elif parent is root:
+            # A group of rows, all of which have now been processed
+            release(element)
+    for info, writer in (writers or {}).values():
+        writer.flush()
 
 
 def extract_test(source_directory):
@@ -272,7 +379,7 @@ def extract_test(source_directory):
 
 
 def process_datafiles(source_directory):
-    create_all_tables(source_directory)
+    table_info = create_all_tables(source_directory)
     to_process = glob.glob("%s/*xml" % source_directory)
     with connection.cursor() as cursor:
         for f in to_process:
@@ -280,22 +387,9 @@ def process_datafiles(source_directory):
             if 'gtin' in f:
                 process_gtin(cursor, f)
             else:
-                doc = etree.parse(f)
-                root = doc.getroot()
-                ns = ('{http://www.w3.org/2001/XMLSchema-instance}'
-                      'noNamespaceSchemaLocation')
-                schema = root.attrib[ns]
-                table_info = get_table_info(source_directory, [schema])
-                for table_name, info in table_info.items():
-                    rows = root.findall(".//%s" % info['node_name'])
-                    for row in rows:
-                        row_data = []
-                        for name, col_type in info['columns']:
-                            val = row.find(name)
-                            if val is not None:
-                                val = val.text
-                            row_data.append((name, val))
-                        insert_row(cursor, info, row_data)
+                process_datafile(cursor, source_directory, f)
+    for name, info in table_info.items():
+        create_indexes(info)
 
 
 class Command(BaseCommand):
@@ -1,6 +1,7 @@
 # coding=utf8
 
 import os
+import tempfile
 from mock import call, patch
 
 import bs4
@@ -10,7 +11,7 @@ from django.core.management import call_command
 from django.db import connection
 from django.test import TestCase
 
-from dmd.models import DMDProduct, DMDVmpp, NCSOConcession
+from dmd.models import DMDProduct, DMDVmpp, NCSOConcession, TariffPrice
 
 
 class CommandsTestCase(TestCase):
@@ -164,6 +165,75 @@ class CommandsTestCase(TestCase):
             self.assertEqual(concession.price_concession_pence, pcp)
             self.assertEqual(concession.vmpp, vmpp)
 
+    def test_bulk_import_drug_tariff(self):
+        DMDProduct.objects.create(
+            dmdid=327368008,
+            vpid=327368008,
+            name='Bicalutamide 150mg tablets',
+            concept_class=1,
+        )
+        DMDVmpp.objects.create(
+            vppid=1206011000001108,
+            nm='Bicalutamide 150mg tablets 28 tablet',
+            vpid=327368008,
+        )
+        TariffPrice.objects.create(
+            vmpp_id=1206011000001108,
+            product_id=327368008,
+            price_pence=400,
+            tariff_category_id=11,
+            date='2017-10-01',
+        )
+
+        with tempfile.NamedTemporaryFile() as f:
+            f.write('Month,VMPP,DT Cat,DT Price\n'
+                    '01/10/2017,1206011000001108,Part VIIIA Category M,422\n'
+                    '01/11/2017,1206011000001108,Part VIIIA Category A,450\n'
+                    '01/11/2017,1111111111111111,Part VIIIA Category A,100\n')
+            f.flush()
+            call_command('bulk_import_drug_tariff', '--csv', f.name)
+
+        prices = TariffPrice.objects.order_by('date')
+        self.assertEqual(
+            [(str(p.date), p.tariff_category_id, p.price_pence)
+             for p in prices],
+            [('2017-10-01', 11, 422), ('2017-11-01', 1, 450)])
+
+    def test_vmpp_matcher(self):
+        from dmd.management.commands.fetch_and_import_ncso_concessions \
+            import VmppMatcher
+
+        vmpp1 = DMDVmpp.objects.create(
+            vppid=1191111000001100,
+            nm='Amiloride 5mg tablets 28 tablet',
+        )
+        vmpp2 = DMDVmpp.objects.create(
+            vppid=975211000001100,
+            nm='Abacavir 20mg/ml oral solution sugar free 240 ml',
+        )
+        NCSOConcession.objects.create(
+            date='2017-10-1',
+            drug='Anastrozole 1mg tablets',
+            pack_size='28',
+            price_concession_pence=1335,
+            vmpp_id=vmpp1.vppid,
+        )
+
+        matcher = VmppMatcher()
+        for drug, pack_size, vppid in [
+            # Prefix of a VMPP's name
+            ['Amiloride 5mg tablets', '28', vmpp1.vppid],
+            # Exact match after regularising the name
+            ['Abacavir 20mg / ml oral solution sugar free', '240ml',
+             vmpp2.vppid],
+            # Matched by a previous concession
+            ['Anastrozole 1mg tablets', '28', vmpp1.vppid],
+            ['Amlodipine 5mg tablets', '28', None],
+        ]:
+            concession = NCSOConcession(
+                date='2017-11-1', drug=drug, pack_size=pack_size)
+            self.assertEqual(matcher.match(concession), vppid)
+
     def test_reconcile_ncso_concessions(self):
         vmpp = DMDVmpp.objects.create(
             vppid=8049011000001108,
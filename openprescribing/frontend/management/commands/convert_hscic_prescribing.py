@@ -1,12 +1,12 @@
 import datetime
 import logging
 import os
-import subprocess
-import tempfile
+import shutil
 
 from django.core.management.base import BaseCommand
 from django.core.management.base import CommandError
 
+from common.external_sort import sort_csv
 from gcutils.bigquery import Client, TableExporter, NotFound
 
 logger = logging.getLogger(__name__)
@@ -159,15 +159,21 @@ class Command(BaseCommand):
         exporter = TableExporter(fmtd_data_table, gcs_path + '_formatted-')
         exporter.export_to_storage(print_header=False)
 
-        with tempfile.NamedTemporaryFile(dir=head) as f:
-            exporter.download_from_storage_and_unzip(f)
-
-            # Sort the output.
-            #
-            # Why? Because this is equivalent to CLUSTERing the table on
-            # loading, but less resource-intensive than doing it in
-            # Postgres. And the table is too big to sort within BigQuery.
-            subprocess.call(
-                "ionice -c 2 nice -n 10 sort -k3,3 -k1,1 -k2,2 -t, %s > %s" % (
-                    f.name, converted_path),
-                shell=True)
+        field_names = [
+            'pct_id', 'practice_code', 'presentation_code', 'total_items',
+            'net_cost', 'actual_cost', 'quantity', 'processing_date',
+        ]
+
+        # Sort the output.
+        #
+        # Why? Because this is equivalent to CLUSTERing the table on
+        # loading, but less resource-intensive than doing it in
+        # Postgres. And the table is too big to sort within BigQuery.
+        sorted_rows = sort_csv(
+            exporter.stream_from_storage(has_headers=False),
+            field_names,
+            ['presentation_code', 'pct_id', 'practice_code'],
+            tmp_dir=head,
+        )
+        with open(converted_path, 'w') as f:
+            shutil.copyfileobj(sorted_rows, f)
@@ -2,15 +2,17 @@ from multiprocessing.pool import Pool
 import glob
 import logging
 import os
-import subprocess
-import tempfile
 import traceback
 
+from dateutil.relativedelta import relativedelta
 from django.conf import settings
 from django.core.management.base import BaseCommand
 from django.db import connection
+from django.db import transaction
 
+from api import spending_cube
 from common import utils
+from common.external_sort import sort_csv
 from gcutils.bigquery import Client, TableExporter
 from frontend.models import ImportLog
 
@@ -29,12 +31,23 @@ class Command(BaseCommand):
     were created using the SQL at
     frontend/management/commands/replace_matviews.sql (also used by the tests).
 
+    With --incremental, only the months of prescribing imported since
+    the views were last refreshed (normally just the new month, but
+    also any months that have been restated) are generated.  Their
+    rows, and those of months which have fallen out of the five-year
+    window, are deleted from each table, and the new rows are copied
+    in with the indexes kept in place.  Views which aren't built from
+    prescribing (see `full_refresh_views`) are always fully refreshed.
+
     """
     def add_arguments(self, parser):
         parser.add_argument(
             '--view', help='view to update (default is to update all)')
         parser.add_argument(
             '--list-views', help='list available views', action='store_true')
+        parser.add_argument(
+            '--incremental', action='store_true',
+            help='only refresh months imported since the last refresh')
 
     def handle(self, *args, **options):
         self.IS_VERBOSE = False
@@ -50,38 +63,90 @@ class Command(BaseCommand):
         )
 
         if options['view'] is not None:
-            path = os.path.join(base_path), options['view'] + '.sql'
+            path = os.path.join(base_path, options['view'] + '.sql')
             self.view_paths = [path]
         else:
             self.view_paths = glob.glob(os.path.join(base_path, '*.sql'))
+        self.all_views = options['view'] is None
 
         if options['list_views']:
             self.list_views()
         else:
-            self.fill_views()
+            self.fill_views(options['incremental'])
 
     def list_views(self):
         for view in self.view_paths:
             print os.path.basename(view).replace('.sql', '')
 
-    def fill_views(self):
+    def fill_views(self, incremental=False):
         client = Client('hscic')
 
-        pool = Pool(processes=len(self.view_paths))
-        tables = []
-
-        prescribing_date = ImportLog.objects.latest_in_category(
-            'prescribing').current_at.strftime('%Y-%m-%d')
+        prescribing_at = ImportLog.objects.latest_in_category(
+            'prescribing').current_at
+        prescribing_date = prescribing_at.strftime('%Y-%m-%d')
+
+        months = None
+        if incremental:
+            months = months_to_refresh(prescribing_at)
+            if months is None:
+                self.log("Views have not been built yet, refreshing all "
+                         "months")
+            elif not months:
+                self.log("No prescribing imported since the views were "
+                         "last refreshed, only refreshing views not built "
+                         "from prescribing")
+            else:
+                self.log("Refreshing views for %s" % ', '.join(
+                    month.strftime('%Y-%m-%d') for month in months))
 
+        tables = []
+        paths = []
+        table_months = {}
         for path in self.view_paths:
             table_name = "vw__%s" % os.path.basename(path).replace('.sql', '')
-            table = client.get_table(table_name)
-            tables.append(table)
+            if table_name in full_refresh_views:
+                table_months[table_name] = None
+            elif months == []:
+                continue
+            else:
+                table_months[table_name] = months
+            tables.append(client.get_table(table_name))
+            paths.append(path)
+
+        if tables:
+            self.generate_and_import(
+                tables, paths, table_months, prescribing_at)
+
+        # API responses built from the vw__ tables are cached until
+        # this is logged.  Incremental refreshes start from the last
+        # time it was logged, so it is only logged once every view is
+        # up to date.
+        if self.all_views:
+            ImportLog.objects.create(
+                current_at=prescribing_date,
+                category='views'
+            )
+
+    def generate_and_import(self, tables, paths, table_months,
+                            prescribing_at):
+        """Generate each table in BigQuery from the SQL at the matching
+        path, for the months given for it in `table_months` (or all
+        months, where that is None), and import it.
+
+        """
+        prescribing_date = prescribing_at.strftime('%Y-%m-%d')
+        pool = Pool(processes=len(tables))
+
+        for table, path in zip(tables, paths):
+            months = table_months[table.table_id]
 
             with open(path) as f:
                 sql = f.read()
 
-            substitutions = {'this_month': prescribing_date}
+            substitutions = {
+                'this_month': prescribing_date,
+                'months_filter': months_filter_sql(months),
+            }
             args = [table.table_id, sql, substitutions]
             pool.apply_async(query_and_export, args)
 
@@ -89,49 +154,66 @@ class Command(BaseCommand):
         pool.join()  # wait for all worker processes to exit
 
         for table in tables:
-            self.download_and_import(table)
+            months = table_months[table.table_id]
+            if months is None:
+                self.download_and_import(table)
+            else:
+                self.download_and_import(
+                    table, months, window_start(prescribing_at))
             self.log("-------------")
 
-    def download_and_import(self, table):
+        if settings.SPENDING_CUBE_DIR and 'vw__chemical_summary_by_ccg' in [
+                table.table_id for table in tables]:
+            self.log("Writing spending store...")
+            path = spending_cube.build(prescribing_at)
+            self.log("Spending store written to %s" % path)
+
+    def download_and_import(self, table, months=None, window_start=None):
         '''Download table from storage and import into local database.
 
-        We sort the downloaded file with `sort` rather than in BigQuery,
+        We sort the downloaded rows locally rather than in BigQuery,
         because we hit resource limits when we try to do so.  See #698 and #711
-        for discussion.
+        for discussion.  The shards are decompressed as they are
+        downloaded, and the sorted rows are streamed straight into COPY.
+
+        If `months` is given, the table in storage holds only those
+        months, so we replace just their rows (and delete any rows from
+        before `window_start`), leaving the indexes in place.  Otherwise
+        we replace the whole table.
         '''
         table_id = table.table_id
         storage_prefix = 'hscic/views/{}-'.format(table_id)
         exporter = TableExporter(table, storage_prefix)
 
-        raw_file = tempfile.NamedTemporaryFile()
-        raw_path = raw_file.name
-        sorted_file = tempfile.NamedTemporaryFile()
-        sorted_path = sorted_file.name
-
-        self.log('Downloading {} to {}'.format(table_id, raw_path))
-        exporter.download_from_storage_and_unzip(raw_file)
-
-        self.log('Sorting {} to {}'.format(table_id, sorted_path))
-        cmd = 'head -1 {} > {}'.format(raw_path, sorted_path)
-        subprocess.check_call(cmd, shell=True)
+        stream = exporter.stream_from_storage()
+        field_names = stream.readline().strip().split(',')
 
-        field_names = sorted_file.readline().strip().split(',')
-
-        cmd = generate_sort_cmd(table_id, field_names, raw_path, sorted_path)
-        subprocess.check_call(cmd, shell=True)
+        self.log('Downloading and sorting {}'.format(table_id))
+        sorted_rows = sort_csv(stream, field_names, sort_keys[table_id])
 
         copy_sql = "COPY {}({}) FROM STDIN WITH (FORMAT CSV)".format(
             table_id, ','.join(field_names))
 
-        with connection.cursor() as cursor:
-            with utils.constraint_and_index_reconstructor(table_id):
-                self.log("Deleting from table %s..." % table_id)
-                cursor.execute("DELETE FROM %s" % table_id)
-                self.log("Copying CSV to %s..." % table_id)
-                cursor.copy_expert(copy_sql, sorted_file)
-
-        raw_file.close()
-        sorted_file.close()
+        if months is None:
+            with connection.cursor() as cursor:
+                with utils.constraint_and_index_reconstructor(table_id):
+                    self.log("Deleting from table %s..." % table_id)
+                    cursor.execute("DELETE FROM %s" % table_id)
+                    self.log("Copying CSV to %s..." % table_id)
+                    cursor.copy_expert(copy_sql, sorted_rows)
+        else:
+            date_column = date_columns.get(table_id, 'processing_date')
+            delete_sql = "DELETE FROM {0} WHERE {1} = ANY(%s) OR {1} <= %s"\
+                .format(table_id, date_column)
+            with transaction.atomic():
+                with connection.cursor() as cursor:
+                    self.log("Deleting refreshed and expired months from "
+                             "table %s..." % table_id)
+                    cursor.execute(delete_sql, [months, window_start])
+                    self.log("Copying CSV to %s..." % table_id)
+                    cursor.copy_expert(copy_sql, sorted_rows)
+            with connection.cursor() as cursor:
+                cursor.execute("ANALYZE %s" % table_id)
 
     def log(self, message):
         if self.IS_VERBOSE:
@@ -140,6 +222,67 @@ class Command(BaseCommand):
             logger.info(message)
 
 
+# The columns each table is sorted on before it is loaded, so that rows
+# which are queried together are stored together
+sort_keys = {
+    'vw__bnf_rollup': ['bnf_code', 'processing_date'],
+    'vw__ccgstatistics': ['pct_id'],
+    'vw__chemical_summary_by_ccg': ['chemical_id', 'pct_id'],
+    'vw__chemical_summary_by_practice': [
+        'chemical_id', 'pct_id', 'practice_id'],
+    'vw__practice_summary': ['pct_id', 'practice_id', 'processing_date'],
+    'vw__presentation_summary': ['presentation_code', 'processing_date'],
+    'vw__presentation_summary_by_ccg': ['presentation_code', 'pct_id'],
+}
+
+# Tables which aren't built from prescribing, so can't be refreshed
+# just for the months of prescribing imported since the last refresh.
+# They are small enough to rebuild in full every time.
+full_refresh_views = {
+    'vw__ccgstatistics',
+}
+
+# The column holding the month in each table, where it isn't
+# processing_date
+date_columns = {
+    'vw__ccgstatistics': 'date',
+}
+
+
+def months_to_refresh(prescribing_at):
+    """Return the months of prescribing that have been imported since
+    the views were last refreshed, or None if they never have been.
+
+    """
+    last_refresh = ImportLog.objects.filter(
+        category='views').order_by('-imported_at').first()
+    if last_refresh is None:
+        return None
+    months = ImportLog.objects.filter(
+        category='prescribing',
+        imported_at__gt=last_refresh.imported_at,
+        current_at__gt=window_start(prescribing_at),
+    ).values_list('current_at', flat=True).distinct()
+    return sorted(set(months))
+
+
+def window_start(prescribing_at):
+    """Return the latest month that is too old to be in the views."""
+    return prescribing_at - relativedelta(years=5)
+
+
+def months_filter_sql(months):
+    """Return a BigQuery predicate restricting `month` to the given
+    months, or to any month if `months` is None.
+
+    """
+    if months is None:
+        return 'TRUE'
+    return 'month IN ({})'.format(', '.join(
+        'TIMESTAMP("{}")'.format(month.strftime('%Y-%m-%d'))
+        for month in months))
+
+
 def query_and_export(table_name, sql, substitutions):
     try:
         client = Client('hscic')
@@ -167,19 +310,3 @@ def query_and_export(table_name, sql, substitutions):
         # traceback)
         logger.error(traceback.format_exc())
         raise
-
-
-def generate_sort_cmd(table_name, field_names, raw_path, sorted_path):
-    sort_keys = {
-        'vw__ccgstatistics': ['pct_id'],
-        'vw__chemical_summary_by_ccg': ['chemical_id', 'pct_id'],
-        'vw__chemical_summary_by_practice': ['chemical_id', 'practice_id'],
-        'vw__practice_summary': ['practice_id', 'processing_date'],
-        'vw__presentation_summary': ['presentation_code', 'processing_date'],
-        'vw__presentation_summary_by_ccg': ['presentation_code', 'pct_id'],
-    }[table_name]
-    sort_key_ixs = [field_names.index(k) + 1 for k in sort_keys]
-    sort_opts = ' '.join('-k{},{}'.format(ix, ix) for ix in sort_key_ixs)
-    # This won't work on OSX since no ionice is available.
-    return 'tail -n +2 {} | ionice -c 2 nice -n 10 sort {} -t, >> {}'.format(
-        raw_path, sort_opts, sorted_path)
@@ -0,0 +1,62 @@
+import logging
+
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.db import transaction
+
+from common.utils import valid_date
+from frontend.models import ImportLog
+from frontend.models import PPUBin
+
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    """Aggregate a month's prescriptions into the per-CCG price-per-unit
+    bins used to draw the bubble chart (see `api.views_spending.bubble`).
+
+    """
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--date', type=valid_date,
+            help='Month to generate bins for (default is the latest month '
+            'of prescribing)')
+
+    def handle(self, *args, **options):
+        if options['date']:
+            date = options['date'].date()
+        else:
+            date = ImportLog.objects.latest_in_category(
+                'prescribing').current_at
+        generate_ppu_bins(date)
+
+
+def generate_ppu_bins(date):
+    """Replace any bins for the given month with bins generated from its
+    prescriptions.
+
+    """
+    sql = """
+    INSERT INTO {bins_table}
+      (date, presentation_code, pct_id, price_per_unit, quantity, net_cost)
+    SELECT
+      processing_date,
+      presentation_code,
+      pct_id,
+      ROUND(CAST(net_cost/NULLIF(quantity, 0) AS numeric), 2) AS ppu,
+      SUM(quantity),
+      SUM(net_cost)
+    FROM frontend_prescription
+    JOIN frontend_practice ON frontend_practice.code = practice_id
+    WHERE processing_date = %s
+      AND setting = 4
+    GROUP BY processing_date, presentation_code, pct_id, ppu
+    """.format(bins_table=PPUBin._meta.db_table)
+
+    logger.info("Generating PPU bins for %s" % date)
+    with transaction.atomic():
+        PPUBin.objects.filter(date=date).delete()
+        with connection.cursor() as cursor:
+            cursor.execute(sql, [date])
+            logger.info("Created %s PPU bins" % cursor.rowcount)
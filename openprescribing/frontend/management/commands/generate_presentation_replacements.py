@@ -62,6 +62,7 @@ For each old code -> new code mapping, in reverse order of date
   version of the prescribing data.  (If this command ever needs
   running again, some time could be saved by applying this only to
   prescribing data downloaded since the last this command was run)
+  The price-per-unit bins derived from it are updated in the same way.
 
 * Iterate over all known BNF codes, sections, paragraphs etc, looking
   for codes which have never been prescribed, and mark these as not
@@ -89,13 +90,15 @@ we've been told mappings only happen this frequently.  And in theory,
 
 """
 
+from functools import partial
+from multiprocessing.pool import ThreadPool
 import csv
 import glob
 import logging
 import re
 import tempfile
+import uuid
 
-from django.conf import settings
 from django.core.management.base import BaseCommand
 from django.core.management.base import CommandError
 from django.db import connection
@@ -104,6 +107,7 @@ from django.db import transaction
 from google.cloud.exceptions import Conflict
 
 from frontend.models import Chemical
+from frontend.models import PPUBin
 from frontend.models import Presentation
 from frontend.models import Product
 from frontend.models import Section
@@ -119,6 +123,14 @@ BNF_MAP_SCHEMA = build_schema(
     ('current_bnf_code', 'STRING'),
 )
 
+# Prefix of the table of replaced presentation codes and their current
+# versions, used to update the prescribing partitions.  Each run gets its
+# own table, so that concurrent runs don't overwrite each other's mapping.
+MAPPING_TABLE_PREFIX = 'tmp_presentation_replacements_'
+
+# Number of connections to update prescribing partitions on in parallel
+UPDATE_WORKERS = 4
+
 
 def create_code_mapping(filenames):
     """Given a list of filenames containing tab-delimited old->new BNF
@@ -180,8 +192,9 @@ def create_bigquery_table():
     # output a row for each presentation and its ultimate replacement
     with tempfile.NamedTemporaryFile(mode='r+b') as csv_file:
         writer = csv.writer(csv_file)
-        for p in Presentation.objects.filter(replaced_by__isnull=False):
-            writer.writerow([p.bnf_code, p.current_version.bnf_code])
+        writer.writerows(
+            Presentation.objects.filter(replaced_by__isnull=False)
+            .values_list('bnf_code', 'current_version_code'))
         csv_file.seek(0)
         client = Client('hscic')
         table = client.get_or_create_table('bnf_map', BNF_MAP_SCHEMA)
@@ -289,16 +302,18 @@ def cleanup_empty_classes():
                             model.__name__, code))
 
 
-def update_existing_prescribing():
+def update_existing_prescribing(workers=UPDATE_WORKERS):
     """For every child table of the prescribing table, update all the data
     so that the BNF codes are always normalised to the current BNF
     code.
 
+    The mapping from each replaced code to its current version is loaded
+    into a table once, and then each partition is updated with a single
+    UPDATE that joins against it.  Partitions are updated in parallel
+    across `workers` connections.  The price-per-unit bins, which are
+    derived from prescribing, are then updated to match.
+
     """
-    update_sql = """
-        UPDATE %s
-        SET presentation_code = '%s'
-        WHERE presentation_code = '%s'"""
     tables_sql = """
         SELECT
           c.relname AS child
@@ -308,21 +323,138 @@ def update_existing_prescribing():
           ON (inhrelid=c.oid)
         JOIN pg_class AS p
           ON (inhparent=p.oid)
-         WHERE p.relname = 'frontend_prescription'"""
+         WHERE p.relname = 'frontend_prescription'
+         ORDER BY c.relname"""
 
     with connection.cursor() as cursor:
         cursor.execute(tables_sql)
-        for row in cursor.fetchall():
-            table_name = row[0]
-            with transaction.atomic():
-                for p in Presentation.objects.filter(
-                        replaced_by__isnull=False):
-                    cursor.execute(
-                        update_sql % (
-                            table_name,
-                            p.current_version.bnf_code,
-                            p.bnf_code)
-                    )
+        table_names = [row[0] for row in cursor.fetchall()]
+
+    mapping_table = MAPPING_TABLE_PREFIX + uuid.uuid4().hex
+    mapping_count = create_replacement_mapping_table(mapping_table)
+    logger.info("Replacing %s presentation codes in %s partitions" % (
+        mapping_count, len(table_names)))
+    try:
+        if mapping_count == 0:
+            return
+        if connection.in_atomic_block or workers < 2:
+            # Other connections can't see a table created in a transaction
+            # that hasn't yet been committed
+            results = (_update_partition(table_name, mapping_table)
+                       for table_name in table_names)
+            _log_progress(results, len(table_names))
+        elif table_names:
+            pool = ThreadPool(min(workers, len(table_names)))
+            try:
+                results = pool.imap_unordered(
+                    partial(_update_partition_on_new_connection,
+                            mapping_table=mapping_table),
+                    table_names)
+                _log_progress(results, len(table_names))
+            finally:
+                pool.terminate()
+        logger.info(
+            "Updated %s PPU bins" % _update_ppu_bins(mapping_table))
+    finally:
+        with connection.cursor() as cursor:
+            cursor.execute("DROP TABLE IF EXISTS %s" % mapping_table)
+
+
+def create_replacement_mapping_table(mapping_table):
+    """Create a table called `mapping_table` mapping each replaced
+    presentation code to the code of its current version, and return the
+    number of rows in it.
+
+    """
+    rows = [
+        (bnf_code, current_code) for bnf_code, current_code
+        in Presentation.objects.filter(replaced_by__isnull=False)
+        .values_list('bnf_code', 'current_version_code')
+        if current_code != bnf_code  # loops map back to themselves
+    ]
+
+    with connection.cursor() as cursor:
+        cursor.execute(
+            "CREATE UNLOGGED TABLE %s ("
+            "former_code varchar(15) PRIMARY KEY, "
+            "current_code varchar(15) NOT NULL)" % mapping_table)
+        if rows:
+            cursor.executemany(
+                "INSERT INTO %s (former_code, current_code) "
+                "VALUES (%%s, %%s)" % mapping_table, rows)
+        cursor.execute("ANALYZE %s" % mapping_table)
+    return len(rows)
+
+
+def _update_partition(table_name, mapping_table):
+    """Replace every former presentation code in the given partition with
+    its current version, and return the name of the table and the number
+    of rows updated.
+
+    """
+    update_sql = """
+        UPDATE %s AS prescription
+        SET presentation_code = mapping.current_code
+        FROM %s AS mapping
+        WHERE prescription.presentation_code = mapping.former_code"""
+    with connection.cursor() as cursor:
+        cursor.execute(update_sql % (table_name, mapping_table))
+        return table_name, cursor.rowcount
+
+
+def _update_ppu_bins(mapping_table):
+    """Replace every former presentation code in the price-per-unit bins
+    with its current version, merging bins which then coincide with
+    existing bins for the current version, and return the number of
+    bins written.
+
+    """
+    update_sql = """
+        WITH affected AS (
+          DELETE FROM {bins_table} AS bins
+          USING (
+            SELECT former_code AS code FROM {mapping_table}
+            UNION
+            SELECT current_code AS code FROM {mapping_table}
+          ) AS codes
+          WHERE bins.presentation_code = codes.code
+          RETURNING bins.*
+        )
+        INSERT INTO {bins_table}
+          (date, presentation_code, pct_id, price_per_unit, quantity,
+           net_cost)
+        SELECT
+          affected.date,
+          COALESCE(mapping.current_code, affected.presentation_code),
+          affected.pct_id,
+          affected.price_per_unit,
+          SUM(affected.quantity),
+          SUM(affected.net_cost)
+        FROM affected
+        LEFT JOIN {mapping_table} AS mapping
+          ON mapping.former_code = affected.presentation_code
+        GROUP BY 1, 2, 3, 4""".format(
+        bins_table=PPUBin._meta.db_table, mapping_table=mapping_table)
+    with transaction.atomic():
+        with connection.cursor() as cursor:
+            cursor.execute(update_sql)
+            return cursor.rowcount
+
+
+def _update_partition_on_new_connection(table_name, mapping_table):
+    """Update a partition in a worker thread, which gets its own
+    connection."""
+    try:
+        with transaction.atomic():
+            return _update_partition(table_name, mapping_table)
+    finally:
+        connection.close()
+
+
+def _log_progress(results, total):
+    for done, (table_name, row_count) in enumerate(results, 1):
+        logger.info("Updated %s rows in %s (%s/%s partitions)" % (
+            row_count, table_name, done, total))
 
 
 def create_bigquery_views():
@@ -393,6 +525,12 @@ class Command(BaseCommand):
             help='This argument only exists for tests. Normally the command '
             'is expected to work on the contents of `presentation_commands/`'
         )
+        parser.add_argument(
+            '--workers',
+            type=int,
+            default=UPDATE_WORKERS,
+            help='Number of connections to update prescribing on in parallel'
+        )
 
     def handle(self, *args, **options):
         if options['filenames']:
@@ -405,7 +543,8 @@ class Command(BaseCommand):
                 )
             )
         create_code_mapping(filenames)
+        Presentation.objects.refresh_current_versions()
         create_bigquery_table()
         create_bigquery_views()
-        update_existing_prescribing()
+        update_existing_prescribing(workers=options['workers'])
         cleanup_empty_classes()
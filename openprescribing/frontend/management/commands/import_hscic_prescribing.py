@@ -1,8 +1,8 @@
+from multiprocessing.pool import ThreadPool
 import csv
 import datetime
 import logging
 import re
-import tempfile
 
 from dateutil.relativedelta import relativedelta
 
@@ -13,6 +13,7 @@ from django.db import transaction
 from frontend.models import Chemical
 from frontend.models import ImportLog
 from frontend.models import PCT
+from frontend.models import PPUBin
 from frontend.models import Practice
 from frontend.models import PracticeStatistics
 from frontend.models import Prescription
@@ -20,13 +21,30 @@ from frontend.models import Presentation
 from frontend.models import Product
 from frontend.models import Section
 
+from frontend.management.commands.generate_ppu_bins import (
+    generate_ppu_bins)
 from gcutils.bigquery import Client, TableExporter
 
 
 logger = logging.getLogger(__name__)
 
+# The number of connections that indexes are built on at once
+INDEX_WORKERS = 4
+
+# A partition whose rows' presentation codes have at least this
+# correlation with their physical order is not CLUSTERed
+CLUSTERED_CORRELATION = 0.95
+
 
 class Command(BaseCommand):
+    """Import a month of prescribing into its partition of
+    frontend_prescription.
+
+    The month is loaded into a staging table, which is indexed and
+    analysed while the existing partition (if any) goes on serving
+    queries, and then swapped in for it in a short transaction.
+
+    """
     args = ''
     help = 'Import all data from any data files that have been downloaded. '
     help += 'Set DEBUG to False in your settings before running this.'
@@ -48,8 +66,24 @@ class Command(BaseCommand):
             action='store_true',
             help='Download all data from bigquery and make new set of tables'
         )
+        parser.add_argument(
+            '--brin-date-index',
+            action='store_true',
+            help='Index processing_date with a BRIN rather than a btree index'
+        )
+        parser.add_argument(
+            '--index-workers',
+            type=int,
+            default=INDEX_WORKERS,
+            help='Number of connections to build indexes on in parallel'
+        )
+
+    brin_date_index = False
+    index_workers = INDEX_WORKERS
 
     def handle(self, *args, **options):
+        self.brin_date_index = options['brin_date_index']
+        self.index_workers = options['index_workers']
         if options['reimport_all']:
             self.reimport_all()
         else:
@@ -61,11 +95,13 @@ class Command(BaseCommand):
                 self.date = self._date_from_filename(fname)
             if not options['skip_orgs']:
                 self.import_pcts_and_practices(fname)
-            self.drop_partition()
             self.create_partition()
             self.import_prescriptions(fname)
             self.create_partition_indexes()
+            self.swap_partition()
             self.add_parent_trigger()
+            self.log_import(fname)
+            generate_ppu_bins(self.date)
             self.drop_oldest_month()
             self.refresh_class_currency()
         logger.info("Done!")
@@ -86,18 +122,20 @@ class Command(BaseCommand):
             table_name = "prescribing_%s" % date_str.replace('-', '_')
             table = client.get_or_create_table(table_name)
             table.insert_rows_from_query(sql)
-            exporter = TableExporter(table, 'tmp/{}-*'.format(table_name))
+            storage_prefix = 'tmp/{}-'.format(table_name)
+            exporter = TableExporter(table, storage_prefix)
             exporter.export_to_storage()
 
-            with tempfile.NamedTemporaryFile(mode='wb') as tmpfile:
-                logger.info("Importing data for %s" % self.date)
-                exporter.download_from_storage_and_unzip(tmpfile)
-                with transaction.atomic():
-                    self.drop_partition()
-                    self.create_partition()
-                    self.import_prescriptions(tmpfile.name)
-                    self.create_partition_indexes()
-                    self.add_parent_trigger()
+            logger.info("Importing data for %s" % self.date)
+            self.create_partition()
+            self.import_prescriptions(
+                storage_prefix,
+                exporter.stream_from_storage(keep_header=False))
+            self.create_partition_indexes()
+            self.swap_partition()
+            self.add_parent_trigger()
+            self.log_import(storage_prefix)
+            generate_ppu_bins(self.date)
             self.date += relativedelta(months=1)
 
     def refresh_class_currency(self):
@@ -146,13 +184,18 @@ class Command(BaseCommand):
         logger.info("%s Practices created" % practices_created)
 
     def create_partition(self):
+        """Create an empty staging table for the month, with the same
+        columns as frontend_prescription but not yet inheriting from it.
+
+        """
         date = self.date
         sql = ("CREATE TABLE %s ("
+               "  LIKE frontend_prescription INCLUDING DEFAULTS,"
                "  CHECK ( "
                "    processing_date >= DATE '%s' "
                "      AND processing_date < DATE '%s'"
                "  )"
-               ") INHERITS (frontend_prescription);")
+               ");")
         constraint_from = "%s-%s-%s" % (date.year, date.month, "01")
         next_month = (date.month % 12) + 1
         if next_month == 1:
@@ -162,19 +205,52 @@ class Command(BaseCommand):
         constraint_to = "%s-%s-%s" % (
             next_year, str(next_month).zfill(2), "01")
         sql = sql % (
-            self._partition_name(),
+            self._staging_name(),
             constraint_from,
             constraint_to
         )
         with connection.cursor() as cursor:
+            # Left behind if an earlier import failed
+            cursor.execute("DROP TABLE IF EXISTS %s" % self._staging_name())
             cursor.execute(sql)
-        logger.info("Created partition %s" % self._partition_name())
+        logger.info("Created staging table %s" % self._staging_name())
+
+    def swap_partition(self):
+        """Replace the month's partition with the staging table.
+
+        This happens in one transaction, which only holds its locks for
+        as long as it takes to rename the tables and change which of them
+        inherits from frontend_prescription.  The old partition is then
+        dropped.
+
+        """
+        partition_name = self._partition_name()
+        staging_name = self._staging_name()
+        old_name = partition_name + '_old'
+        logger.info('Swapping %s in as %s' % (staging_name, partition_name))
+        with transaction.atomic():
+            with connection.cursor() as cursor:
+                cursor.execute("DROP TABLE IF EXISTS %s" % old_name)
+                cursor.execute(
+                    "SELECT 1 FROM pg_tables WHERE tablename = %s",
+                    [partition_name])
+                if cursor.fetchone():
+                    cursor.execute(
+                        "ALTER TABLE %s NO INHERIT frontend_prescription"
+                        % partition_name)
+                    _rename_table(cursor, partition_name, old_name)
+                _rename_table(cursor, staging_name, partition_name)
+                cursor.execute(
+                    "ALTER TABLE %s INHERIT frontend_prescription"
+                    % partition_name)
+        self.drop_partition(table_name=old_name)
 
     def drop_oldest_month(self):
         five_years_ago = datetime.date(
             self.date.year - 5, self.date.month, self.date.day)
         self.drop_partition(five_years_ago)
         PracticeStatistics.objects.filter(date__lte=five_years_ago).delete()
+        PPUBin.objects.filter(date__lte=five_years_ago).delete()
 
     def _partition_name(self, date=None):
         if not date:
@@ -182,6 +258,9 @@ class Command(BaseCommand):
         return "frontend_prescription_%s%s" % (
             date.year, str(date.month).zfill(2))
 
+    def _staging_name(self):
+        return self._partition_name() + '_staging'
+
     def add_parent_trigger(self):
         """A trigger to prevent accidental adding of data to the parent table
 
@@ -205,47 +284,96 @@ class Command(BaseCommand):
             cursor.execute(trigger)
 
     def create_partition_indexes(self):
-        indexes = [
-            ("CREATE INDEX idx_%s_presentation "
-             "ON %s (presentation_code varchar_pattern_ops)"),
-            ("CREATE INDEX idx_%s_practice_id "
-             "ON %s "
+        """Cluster the staging table if necessary, and then build its
+        indexes and constraints.
+
+        The input has normally been sorted by presentation_code already
+        (see convert_hscic_prescribing), in which case there is no need to
+        CLUSTER it.  The indexes are built in parallel, on separate
+        connections, unless we are inside a transaction, when other
+        connections cannot see the table.
+
+        """
+        table_name = self._staging_name()
+        with connection.cursor() as cursor:
+            cursor.execute("ANALYZE %s" % table_name)
+            correlation = _correlation(cursor, table_name, 'presentation_code')
+        presentation_index = (
+            "CREATE INDEX idx_{0}_presentation "
+            "ON {0} (presentation_code varchar_pattern_ops)")
+        if correlation is not None and \
+           abs(correlation) >= CLUSTERED_CORRELATION:
+            logger.info("%s is already ordered by presentation_code "
+                        "(correlation %.3f), not clustering" % (
+                            table_name, correlation))
+            index_sqls = [presentation_index]
+        else:
+            logger.info("Clustering %s" % table_name)
+            with connection.cursor() as cursor:
+                cursor.execute(presentation_index.format(table_name))
+                cursor.execute("CLUSTER {0} USING idx_{0}_presentation"
+                               .format(table_name))
+                cursor.execute("ANALYZE %s" % table_name)
+            index_sqls = []
+
+        if self.brin_date_index:
+            date_index = ("CREATE INDEX idx_{0}_date "
+                          "ON {0} USING brin (processing_date)")
+        else:
+            date_index = ("CREATE INDEX idx_{0}_date "
+                          "ON {0} (processing_date)")
+        index_sqls += [
+            ("CREATE INDEX idx_{0}_practice_id "
+             "ON {0} "
              "USING btree (practice_id)"),
-            ("CREATE INDEX idx_%s_pct_id "
-             "ON %s (pct_id)"),
-            ("CREATE INDEX idx_%s_date "
-             "ON %s (processing_date)"),
-            ("CLUSTER %s USING idx_%s_presentation"),
+            ("CREATE INDEX idx_{0}_pct_id "
+             "ON {0} (pct_id)"),
+            date_index,
+            # Built separately from its constraint so that it can be built
+            # alongside the other indexes
+            ("CREATE UNIQUE INDEX cnstrt_{0}_pkey "
+             "ON {0} (id)"),
         ]
+        index_sqls = [sql.format(table_name) for sql in index_sqls]
+        logger.info("Building %s indexes on %s" % (
+            len(index_sqls), table_name))
+        if connection.in_atomic_block or self.index_workers < 2:
+            with connection.cursor() as cursor:
+                for sql in index_sqls:
+                    cursor.execute(sql)
+        else:
+            pool = ThreadPool(min(self.index_workers, len(index_sqls)))
+            try:
+                pool.map(_execute_on_new_connection, index_sqls)
+            finally:
+                pool.terminate()
+
         constraints = [
-            ("ALTER TABLE %s ADD CONSTRAINT "
-             "cnstrt_%s_pkey "
-             "PRIMARY KEY (id)"),
-            ("ALTER TABLE %s ADD CONSTRAINT "
-             "cnstrt_%s__practice_code "
+            ("ALTER TABLE {0} ADD CONSTRAINT "
+             "cnstrt_{0}_pkey "
+             "PRIMARY KEY USING INDEX cnstrt_{0}_pkey"),
+            ("ALTER TABLE {0} ADD CONSTRAINT "
+             "cnstrt_{0}__practice_code "
              "FOREIGN KEY (practice_id) REFERENCES frontend_practice(code) "
              "DEFERRABLE INITIALLY DEFERRED"),
-            ("ALTER TABLE %s ADD CONSTRAINT "
-             "cnstrt_%s__pct_code "
+            ("ALTER TABLE {0} ADD CONSTRAINT "
+             "cnstrt_{0}__pct_code "
              "FOREIGN KEY (pct_id) REFERENCES frontend_pct(code) "
              "DEFERRABLE INITIALLY DEFERRED"),
             ]
-        partition_name = self._partition_name()
         with connection.cursor() as cursor:
-            for index_sql in indexes:
-                cursor.execute(index_sql % (
-                    partition_name, partition_name))
             for constraint_sql in constraints:
-                cursor.execute(constraint_sql % (
-                    partition_name, partition_name))
+                cursor.execute(constraint_sql.format(table_name))
 
-    def drop_partition(self, date=None):
-        logger.info('Dropping partition %s' % self._partition_name(date=date))
-        sql = "DROP TABLE IF EXISTS %s" % self._partition_name(date=date)
+    def drop_partition(self, date=None, table_name=None):
+        if table_name is None:
+            table_name = self._partition_name(date=date)
+        logger.info('Dropping partition %s' % table_name)
+        sql = "DROP TABLE IF EXISTS %s" % table_name
         with connection.cursor() as cursor:
             cursor.execute(sql)
 
-    def import_prescriptions(self, filename):
+    def import_prescriptions(self, filename, file_obj=None):
         logger.info('Importing Prescriptions from %s' % filename)
         # start = time.clock()
         copy_str = "COPY %s(pct_id,"
@@ -253,14 +381,17 @@ class Command(BaseCommand):
         copy_str += "total_items,net_cost,actual_cost,"
         copy_str += "quantity,processing_date) FROM STDIN "
         copy_str += "WITH (FORMAT CSV)"
-        file_obj = open(filename)
+        if file_obj is None:
+            file_obj = open(filename)
         with connection.cursor() as cursor:
-            cursor.copy_expert(copy_str % self._partition_name(), file_obj)
-            ImportLog.objects.create(
-                current_at=self.date,
-                filename=filename,
-                category='prescribing'
-            )
+            cursor.copy_expert(copy_str % self._staging_name(), file_obj)
+
+    def log_import(self, filename):
+        ImportLog.objects.create(
+            current_at=self.date,
+            filename=filename,
+            category='prescribing'
+        )
 
     def _date_from_filename(self, filename):
         new_style = re.match(r'.*/([0-9]{4}_[0-9]{2})/', filename)
@@ -271,3 +402,48 @@ class Command(BaseCommand):
             file_str = filename.replace('T', '').split('/')[-1].split('.')[0]
             date = datetime.date(int(file_str[0:4]), int(file_str[4:6]), 1)
         return date
+
+
+def _rename_table(cursor, old_name, new_name):
+    """Rename a table, along with those of its constraints and indexes
+    whose names include the table's name.
+
+    """
+    cursor.execute("ALTER TABLE %s RENAME TO %s" % (old_name, new_name))
+    # Renaming a constraint that has an index renames the index too
+    cursor.execute(
+        "SELECT conname FROM pg_constraint WHERE conrelid = %s::regclass",
+        [new_name])
+    for (name,) in cursor.fetchall():
+        if old_name in name:
+            cursor.execute("ALTER TABLE %s RENAME CONSTRAINT %s TO %s" % (
+                new_name, name, name.replace(old_name, new_name)))
+    cursor.execute(
+        "SELECT indexname FROM pg_indexes WHERE tablename = %s", [new_name])
+    for (name,) in cursor.fetchall():
+        if old_name in name:
+            cursor.execute("ALTER INDEX %s RENAME TO %s" % (
+                name, name.replace(old_name, new_name)))
+
+
+def _correlation(cursor, table_name, column):
+    """Return the correlation between the order of the values of
+    `column` and the physical order of rows, estimated by the last
+    ANALYZE, or None if there are no statistics."""
+    cursor.execute(
+        "SELECT correlation FROM pg_stats "
+        "WHERE tablename = %s AND attname = %s",
+        [table_name, column])
+    row = cursor.fetchone()
+    if row is None:
+        return None
+    return row[0]
+
+
+def _execute_on_new_connection(sql):
+    """Execute SQL in a worker thread, which gets its own connection."""
+    try:
+        with connection.cursor() as cursor:
+            cursor.execute(sql)
+    finally:
+        connection.close()
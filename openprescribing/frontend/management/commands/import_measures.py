@@ -6,33 +6,99 @@ the alternative, which is looping over thousands of practices
 individually with a custom SQL query. However, the tradeoff is that
 most of the logic now lives in SQL which is harder to read and test
 clearly.
+
+Measures can also be calculated without BigQuery, by passing `--engine
+local`.  `LocalMeasureCalculation` reads numerators and denominators
+from the prescribing and list size tables in the local database, and
+repeats the steps in `measure_sql/` with pandas.  This is much quicker
+for a single measure during development, but only works for measures
+whose definitions are valid in Postgres.
 """
 
 from collections import OrderedDict
 from contextlib import contextmanager
-import csv
+from multiprocessing.pool import ThreadPool
 import datetime
 import glob
+import hashlib
 import json
 import logging
+import math
 import os
 import re
-import tempfile
+
+from dateutil.relativedelta import relativedelta
+import numpy as np
+import pandas as pd
 
 from django.core.exceptions import ObjectDoesNotExist
 from django.core.management.base import BaseCommand, CommandError
+from django.db import DatabaseError
 from django.db import connection
 from django.db import transaction
+from django.db.models import Max
 
 from gcutils.bigquery import Client
 
 from common import utils
+from common.utils import ChunkReader
+from common.utils import csv_chunks
 from frontend.models import MeasureGlobal, MeasureValue, Measure, ImportLog
 
 logger = logging.getLogger(__name__)
 
 CENTILES = [10, 20, 30, 40, 50, 60, 70, 80, 90]
 
+# Number of measures whose BigQuery jobs are run at once
+MEASURE_WORKERS = 8
+
+# Columns of the tables that measures are written to
+MEASURE_VALUE_FIELDS = [
+    'pct_id', 'measure_id', 'num_items', 'numerator', 'denominator', 'month',
+    'percentile', 'calc_value', 'denom_items', 'denom_quantity', 'denom_cost',
+    'num_cost', 'num_quantity', 'practice_id', 'cost_savings']
+MEASURE_GLOBAL_FIELDS = [
+    'measure_id', 'month', 'numerator', 'denominator', 'calc_value',
+    'num_items', 'denom_items', 'num_cost', 'denom_cost', 'num_quantity',
+    'denom_quantity', 'cost_per_num', 'cost_per_denom', 'percentiles',
+    'cost_savings']
+INTEGER_FIELDS = ['num_items', 'denom_items']
+
+# References to the practice data of a measure (or of a view defined in
+# `measure_sql/` over the practice data of several measures)
+PRACTICE_DATA_RE = re.compile(r'\{measures\}\.practice_data_(\w+)')
+
+# Aggregate functions used in measure definitions' SELECT columns
+AGGREGATE_RE = re.compile(r'\b(SUM|MAX|MIN|AVG|COUNT)\s*\(', re.IGNORECASE)
+
+# Equivalents in the local database of the BigQuery tables that measure
+# definitions select from, for `LocalMeasureCalculation`
+PRESCRIBING_SOURCE = """
+    SELECT
+      rx.processing_date AS month,
+      rx.practice_id AS practice,
+      rx.pct_id AS pct,
+      rx.presentation_code AS bnf_code,
+      pn.name AS bnf_name,
+      rx.total_items AS items,
+      rx.net_cost,
+      rx.actual_cost,
+      rx.quantity
+    FROM frontend_prescription rx
+    LEFT JOIN frontend_presentation pn
+    ON pn.bnf_code = rx.presentation_code"""
+PRACTICE_STATISTICS_SOURCE = """
+    SELECT
+      ps.*,
+      ps.date AS month,
+      ps.practice_id AS practice
+    FROM frontend_practicestatistics ps"""
+LOCAL_SOURCES = {
+    '{hscic}.normalised_prescribing_standard': PRESCRIBING_SOURCE,
+    '{measures}.normalised_prescribing_legacy': PRESCRIBING_SOURCE,
+    '{hscic}.practice_statistics': PRACTICE_STATISTICS_SOURCE,
+}
+
 
 class Command(BaseCommand):
     '''Supply either --end_date to load data for all months
@@ -53,33 +119,104 @@ class Command(BaseCommand):
         start_date = options['start_date']
         end_date = options['end_date']
         verbose = options['verbosity'] > 1
+        window = default_window()
+        if options['engine'] == 'local':
+            calculation_class = LocalMeasureCalculation
+        else:
+            calculation_class = MeasureCalculation
         with conditional_constraint_and_index_reconstructor(options):
+            start_dates = OrderedDict()
+            measures = {}
+            fingerprints = {}
             for measure_id in options['measure_ids']:
                 logger.info('Updating measure: %s' % measure_id)
-                measure = create_or_update_measure(measure_id)
-                measure_start = datetime.datetime.now()
-
-                calcuation = MeasureCalculation(
-                    measure, start_date=start_date, end_date=end_date,
-                    verbose=verbose
-                )
-                if options['definitions_only']:
+                measures[measure_id] = create_or_update_measure(measure_id)
+                fingerprints[measure_id] = measure_fingerprint(measure_id)
+                if options['incremental']:
+                    start_dates[measure_id] = incremental_start_date(
+                        measures[measure_id], fingerprints[measure_id],
+                        start_date)
+                else:
+                    start_dates[measure_id] = start_date
+            start_dates = with_source_start_dates(start_dates, end_date)
+            calculations = []
+            for measure_id, measure_start_date in start_dates.items():
+                if measure_start_date > end_date:
+                    logger.info('Measure %s is up to date' % measure_id)
+                    continue
+                if measure_id not in measures:
+                    logger.info('Updating source measure: %s' % measure_id)
+                    measures[measure_id] = create_or_update_measure(
+                        measure_id)
+                    fingerprints[measure_id] = measure_fingerprint(
+                        measure_id)
+                try:
+                    calculation = calculation_class(
+                        measures[measure_id], start_date=measure_start_date,
+                        end_date=end_date, verbose=verbose
+                    )
+                except CommandError as e:
+                    # The local engine can't calculate every measure, so
+                    # unless measures were asked for by name, skip those
+                    # it can't
+                    if options.get('measure'):
+                        raise
+                    logger.warning("Skipping measure %s: %s" % (
+                        measure_id, e))
                     continue
+                calculation.fingerprint = fingerprints[measure_id]
+                calculations.append(calculation)
+            if options['definitions_only']:
+                calculations = []
+
+            if options['engine'] == 'local':
+                # This reads from the database, so has to happen in this
+                # thread
+                calculated = calculate_locally(calculations)
+            else:
+                # The BigQuery jobs for several measures are run at once,
+                # but each measure's results are written to the database
+                # by this thread, one measure at a time
+                calculated = calculate_in_bigquery(
+                    calculations, options['workers'])
+            for calculation in calculated:
+                measure = calculation.measure
 
                 # Delete any existing measures data relating to the
                 # current month(s)
-                MeasureValue.objects.filter(month__gte=start_date)\
+                measure_start_date = calculation.start_date
+                MeasureValue.objects.filter(month__gte=measure_start_date)\
                                     .filter(month__lte=end_date)\
                                     .filter(measure=measure).delete()
-                MeasureGlobal.objects.filter(month__gte=start_date)\
+                MeasureGlobal.objects.filter(month__gte=measure_start_date)\
                                      .filter(month__lte=end_date)\
                                      .filter(measure=measure).delete()
 
-                # Compute the measures
-                calcuation.calculate()
-                elapsed = datetime.datetime.now() - measure_start
+                calculation.write_to_database()
+                if window and calculation.start_date <= window[0] and \
+                   calculation.end_date >= window[1]:
+                    # Only values for the whole window are known to come
+                    # from the current definition
+                    Measure.objects.filter(pk=measure.pk).update(
+                        definition_fingerprint=calculation.fingerprint)
+                elapsed = datetime.datetime.now() - calculation.start
                 logger.warning("Elapsed time for %s: %s seconds" % (
-                    measure_id, elapsed.seconds))
+                    measure.id, elapsed.seconds))
+
+            if options['incremental'] and not options['definitions_only']:
+                # Drop months that have fallen out of the window
+                MeasureValue.objects.filter(
+                    measure_id__in=list(start_dates),
+                    month__lt=start_date).delete()
+                MeasureGlobal.objects.filter(
+                    measure_id__in=list(start_dates),
+                    month__lt=start_date).delete()
+        if not options['definitions_only']:
+            # Cached measure API responses are keyed on this
+            ImportLog.objects.create(
+                current_at=end_date,
+                category='measures'
+            )
         logger.warning("Total elapsed time: %s" % (
             datetime.datetime.now() - start))
 
@@ -90,6 +227,20 @@ class Command(BaseCommand):
         parser.add_argument('--end_date')
         parser.add_argument('--measure')
         parser.add_argument('--definitions_only', action='store_true')
+        parser.add_argument(
+            '--full_rebuild', action='store_true',
+            help='Recalculate every month, even for measures whose '
+            'definitions are unchanged')
+        parser.add_argument(
+            '--workers', type=int, default=MEASURE_WORKERS,
+            help='Number of measures to calculate in BigQuery at once')
+        parser.add_argument(
+            '--engine', choices=['bigquery', 'local'], default='bigquery',
+            help='Calculate measures in BigQuery, or with pandas from the '
+            'prescribing data in the local database.  The local engine is '
+            'meant for single measures, or a --measure list of measures '
+            'whose definitions are valid in Postgres; other measures are '
+            'rejected if named, and otherwise skipped')
 
     def parse_options(self, options):
         """Parse command line options
@@ -103,6 +254,7 @@ class Command(BaseCommand):
             options['measure_ids'] = [
                 k for k, v in parse_measures().items() if 'skip' not in v]
         options['months'] = []
+        options['incremental'] = False
         if 'month' in options and options['month']:
             options['start_date'] = options['end_date'] = options['month']
         elif 'month_from_prescribing_filename' in options \
@@ -114,16 +266,240 @@ class Command(BaseCommand):
             options['start_date'] = options['end_date'] = \
                 month.strftime('%Y-%m-01')
         else:
-            l = ImportLog.objects.latest_in_category('prescribing')
-            options['start_date'] = "%s-%02d-%02d" % (
-                l.current_at.year - 5, l.current_at.month, l.current_at.day)
-            options['end_date'] = l.current_at.strftime('%Y-%m-%d')
+            options['start_date'], options['end_date'] = default_window()
+            # When calculating the whole window, measures which have
+            # already been calculated with their current definitions only
+            # need calculating for the months since they were last run
+            options['incremental'] = not options.get('full_rebuild')
         # validate the date format
         datetime.datetime.strptime(options['start_date'], "%Y-%m-%d")
         datetime.datetime.strptime(options['end_date'], "%Y-%m-%d")
         return options
 
 
+def default_window():
+    """Return the first and last months of the five years of prescribing
+    that measures are calculated for by default, or None if there is no
+    prescribing.
+
+    """
+    l = ImportLog.objects.latest_in_category('prescribing')
+    if l is None:
+        return None
+    return (
+        "%s-%02d-%02d" % (
+            l.current_at.year - 5, l.current_at.month, l.current_at.day),
+        l.current_at.strftime('%Y-%m-%d'))
+
+
+def calculate_in_bigquery(calculations, workers=MEASURE_WORKERS):
+    """Run the BigQuery jobs for each of the given MeasureCalculations,
+    with up to `workers` measures at once, and yield each calculation as
+    its jobs complete.
+
+    The numerators and denominators of all the measures are computed
+    first, with one scan of each table that they select from.  Measures
+    which select from the results of other measures are calculated once
+    those measures are complete.
+
+    """
+    for batch in dependency_batches(calculations):
+        # All the sums must be complete before any of the measures'
+        # ratios can be calculated
+        list(_imap_unordered(
+            _calculate_source_sums, group_by_source(batch), workers))
+        for calculation in _imap_unordered(
+                _calculate_in_bigquery, batch, workers):
+            yield calculation
+
+
+def _imap_unordered(func, items, workers):
+    if workers < 2 or len(items) < 2:
+        for item in items:
+            yield func(item)
+        return
+    pool = ThreadPool(min(workers, len(items)))
+    try:
+        for result in pool.imap_unordered(func, items):
+            yield result
+    finally:
+        pool.terminate()
+
+
+def _calculate_in_bigquery(calculation):
+    calculation.start = datetime.datetime.now()
+    calculation.calculate_in_bigquery()
+    return calculation
+
+
+def _calculate_source_sums(source_sums):
+    source_sums.calculate()
+    return source_sums
+
+
+def dependency_batches(calculations):
+    """Split calculations into batches, so that measures which select
+    from the practice data of other measures (such as lpzomnibus) are in
+    a later batch than any of those measures that are being calculated.
+
+    """
+    by_id = OrderedDict((c.measure.id, c) for c in calculations)
+    remaining = OrderedDict(
+        (measure_id, source_measure_ids([
+            calculation.measure.numerator_from,
+            calculation.measure.denominator_from]) & set(by_id))
+        for measure_id, calculation in by_id.items())
+    batches = []
+    while remaining:
+        batch = [measure_id for measure_id, sources in remaining.items()
+                 if not sources & set(remaining)]
+        if not batch:
+            raise CommandError(
+                "Circular dependency between measures %s" %
+                ', '.join(remaining))
+        for measure_id in batch:
+            del remaining[measure_id]
+        batches.append([by_id[measure_id] for measure_id in batch])
+    return batches
+
+
+def source_measure_ids(from_tables):
+    """Return the ids of the measures whose practice data the given
+    `numerator_from` and `denominator_from` clauses select from,
+    following any views defined in `measure_sql/`.
+
+    """
+    measure_ids = set()
+    fpath = os.path.dirname(__file__)
+    for from_table in from_tables:
+        for name in PRACTICE_DATA_RE.findall(from_table):
+            view_path = os.path.join(
+                fpath, 'measure_sql', 'practice_data_%s.sql' % name)
+            if os.path.exists(view_path):
+                with open(view_path) as f:
+                    measure_ids |= source_measure_ids([f.read()])
+            else:
+                measure_ids.add(name)
+    return measure_ids
+
+
+def group_by_source(calculations):
+    """Return a SourceSums for each table that the numerators and
+    denominators of the given calculations select from.
+
+    """
+    sources = OrderedDict()
+    for calculation in calculations:
+        for num_or_denom in ['numerator', 'denominator']:
+            from_table = ' '.join(
+                getattr(calculation.measure, num_or_denom + '_from').split())
+            if from_table not in sources:
+                sources[from_table] = SourceSums(from_table)
+            sources[from_table].add(calculation, num_or_denom)
+    return sources.values()
+
+
+def calculate_locally(calculations):
+    """Calculate each of the given LocalMeasureCalculations in turn, and
+    yield each one as it completes.
+
+    """
+    for calculation in calculations:
+        calculation.start = datetime.datetime.now()
+        calculation.calculate_locally()
+        yield calculation
+
+
+def set_global_calc_value(d):
+    """Set calc_value on a dict of MeasureGlobal values, as
+    MeasureGlobal.save() does.
+
+    """
+    denominator = float_or_null(d.get('denominator'))
+    numerator = float_or_null(d.get('numerator'))
+    d['denominator'] = denominator
+    d['numerator'] = numerator
+    if denominator:
+        if numerator:
+            d['calc_value'] = numerator / denominator
+        else:
+            d['calc_value'] = numerator
+
+
+def measure_fingerprint(measure_id, measures=None):
+    """Return a hash of a measure's definition, of the SQL used to
+    calculate all measures, and of the fingerprints of any measures whose
+    practice data it selects from.
+
+    Values calculated for a month don't depend on other months, so if a
+    measure's fingerprint hasn't changed since it was last calculated,
+    only the months since then need calculating.
+
+    """
+    if measures is None:
+        measures = parse_measures()
+    definition = measures[measure_id]
+    h = hashlib.sha1()
+    h.update(json.dumps(definition, sort_keys=True))
+    fpath = os.path.dirname(__file__)
+    for fname in sorted(glob.glob(os.path.join(fpath, 'measure_sql/*.sql'))):
+        with open(fname) as f:
+            h.update(f.read())
+    source_ids = source_measure_ids(
+        [definition['numerator_from'], definition['denominator_from']])
+    for source_id in sorted(source_ids):
+        h.update(measure_fingerprint(source_id, measures))
+    return h.hexdigest()
+
+
+def with_source_start_dates(start_dates, end_date):
+    """Given an OrderedDict of the first month to calculate for each
+    measure, return a copy in which each measure whose practice data
+    another measure selects from is calculated from at least as early
+    as that measure, adding it if necessary.
+
+    A measure's practice data in BigQuery only holds the months that it
+    was last calculated for, so a measure which selects from it (such as
+    lpzomnibus) needs the same months recalculated there.
+
+    """
+    start_dates = OrderedDict(start_dates)
+    measures = parse_measures()
+    changed = True
+    while changed:
+        changed = False
+        for measure_id, measure_start_date in list(start_dates.items()):
+            if measure_start_date > end_date:
+                continue
+            definition = measures[measure_id]
+            source_ids = source_measure_ids([
+                definition['numerator_from'],
+                definition['denominator_from']])
+            for source_id in sorted(source_ids):
+                source_start_date = start_dates.get(source_id)
+                if source_start_date is None or \
+                   source_start_date > measure_start_date:
+                    start_dates[source_id] = measure_start_date
+                    changed = True
+    return start_dates
+
+
+def incremental_start_date(measure, fingerprint, start_date):
+    """Return the first month that needs calculating for the given
+    measure, if values from `start_date` onwards are wanted.
+
+    """
+    if measure.definition_fingerprint != fingerprint:
+        return start_date
+    latest_month = MeasureGlobal.objects.filter(
+        measure=measure, month__gte=start_date
+    ).aggregate(Max('month'))['month__max']
+    if latest_month is None:
+        return start_date
+    next_month = latest_month + relativedelta(months=1)
+    return next_month.strftime('%Y-%m-%d')
+
+
 def parse_measures():
     """Deserialise JSON measures definition into dict
     """
@@ -143,6 +519,54 @@ def parse_measures():
     return measures
 
 
+def conditional_aggregates(columns, condition):
+    """Rewrite the aggregate functions in the given SELECT columns so
+    that they only aggregate rows matching `condition`.
+
+    >>> conditional_aggregates('SUM(items) AS numerator', 'x > 1')
+    'SUM(IF(x > 1, items, NULL)) AS numerator'
+
+    """
+    result = ''
+    pos = 0
+    for match in AGGREGATE_RE.finditer(columns):
+        if match.start() < pos:
+            continue
+        end = _closing_paren(columns, match.end())
+        arg = columns[match.end():end]
+        result += columns[pos:match.start()]
+        if arg.strip() == '*':
+            result += 'COUNTIF(%s)' % condition
+        else:
+            result += '%s(IF(%s, %s, NULL))' % (
+                match.group(1), condition, arg)
+        pos = end + 1
+    return result + columns[pos:]
+
+
+def _closing_paren(sql, start):
+    """Return the position of the parenthesis closing the one just
+    before `start`, ignoring any in string literals.
+
+    """
+    depth = 1
+    quote = None
+    for i in range(start, len(sql)):
+        c = sql[i]
+        if quote:
+            if c == quote:
+                quote = None
+        elif c in '\'"':
+            quote = c
+        elif c == '(':
+            depth += 1
+        elif c == ')':
+            depth -= 1
+            if depth == 0:
+                return i
+    raise ValueError("Unbalanced parentheses in %s" % sql)
+
+
 # Utility methods
 
 def float_or_null(v):
@@ -272,6 +696,44 @@ def create_or_update_measure(measure_id):
     return measure
 
 
+class SourceSums(object):
+    """The numerators and denominators of all the measures which select
+    from one table, which are computed with a single scan of that table.
+
+    Each measure's columns in the resulting table are prefixed with the
+    measure's id, and `num_` or `denom_`.
+
+    """
+
+    def __init__(self, from_table):
+        self.from_table = from_table
+        self.table_name = 'sums_' + re.sub(
+            r'\W+', '_', from_table).strip('_').lower()
+        self.parts = []
+
+    def add(self, calculation, num_or_denom):
+        self.parts.append((calculation, num_or_denom))
+        calculation.sums_tables[num_or_denom] = self.table_name
+
+    def calculate(self):
+        columns = ''
+        for calculation, num_or_denom in self.parts:
+            columns += calculation.get_conditional_columns(num_or_denom)
+        context = {
+            'from_table': self.from_table,
+            'columns': columns,
+            'start_date': min(c.start_date for c, _ in self.parts),
+            'end_date': max(c.end_date for c, _ in self.parts),
+        }
+        query_path = os.path.join(
+            os.path.dirname(__file__), 'measure_sql', 'shared_sums.sql')
+        with open(query_path) as f:
+            sql = f.read()
+        client = Client('measures')
+        client.get_table(self.table_name).insert_rows_from_query(
+            sql, substitutions=context)
+
+
 class MeasureCalculation(object):
     """Logic for measure calculations in BQ."""
 
@@ -284,21 +746,45 @@ class MeasureCalculation(object):
         self.globals_table_name = "global_data_%s" % self.measure.id
         self.ccg_table_name = "ccg_data_%s" % self.measure.id
         self.practice_table_name = "practice_data_%s" % self.measure.id
+        # Names of the tables holding the measure's numerators and
+        # denominators, as computed by SourceSums
+        self.sums_tables = {}
 
     def calculate(self):
+        self.calculate_in_bigquery()
+        self.write_to_database()
+
+    def calculate_in_bigquery(self):
+        """Run the BigQuery jobs that compute the measure, in order.  This
+        doesn't touch the database, so can be run in a separate thread.
+
+        """
+        if not self.sums_tables:
+            for source_sums in group_by_source([self]):
+                source_sums.calculate()
+        self.calculate_practices()
+        self.calculate_ccgs()
+        self.calculate_global()
+
+    def write_to_database(self):
+        """Copy the results of `calculate_in_bigquery()` to the database.
+
+        """
         number_rows_written = 0
-        number_rows_written += self.calculate_practices()
-        number_rows_written += self.calculate_ccgs()
+        self.log("Writing practice ratios to postgres")
+        number_rows_written += self.write_practice_ratios_to_database()
+        self.log("Writing CCG data to postgres")
+        number_rows_written += self.write_ccg_ratios_to_database()
 
         if number_rows_written == 0:
             raise CommandError(
-                "No rows generated by measure %s" % self.measure_id)
+                "No rows generated by measure %s" % self.measure.id)
 
-        self.calculate_global()
+        self.write_global_centiles_to_database()
 
     def calculate_practices(self):
         """Calculate ratios, centiles and (optionally) cost savings at a
-        practice level, and write these to the database.
+        practice level.
 
         """
         self.log("Calculating practice ratios")
@@ -310,18 +796,15 @@ class MeasureCalculation(object):
         if self.measure.is_cost_based:
             self.log("Calculating cost savings for practices")
             self.calculate_cost_savings_for_practices()
-        self.log("Writing practice ratios to postgres")
-        number_rows_written = self.write_practice_ratios_to_database()
-        return number_rows_written
 
     def calculate_practice_ratios(self):
         """Given a measure defition, construct a BigQuery query which computes
-        numerator/denominator ratios for practices.
+        numerator/denominator ratios for practices, from the sums computed
+        by SourceSums.
 
         See also comments in SQL.
 
         """
-        m = self.measure
         numerator_aliases = ''
         denominator_aliases = ''
         aliased_numerators = ''
@@ -334,12 +817,13 @@ class MeasureCalculation(object):
             aliased_numerators += ", num_%s" % col
 
         context = {
-            'numerator_from': m.numerator_from,
-            'numerator_where': m.numerator_where,
-            'numerator_columns': m.columns_for_select('numerator'),
-            'denominator_columns': m.columns_for_select('denominator'),
-            'denominator_from': m.denominator_from,
-            'denominator_where': m.denominator_where,
+            'numerator_sums_table': self.sums_tables['numerator'],
+            'numerator_columns': self._get_sums_columns('numerator'),
+            'numerator_rows': self._get_sums_prefix('numerator') + 'rows',
+            'denominator_sums_table': self.sums_tables['denominator'],
+            'denominator_columns': self._get_sums_columns('denominator'),
+            'denominator_rows': (
+                self._get_sums_prefix('denominator') + 'rows'),
             'numerator_aliases': numerator_aliases,
             'denominator_aliases': denominator_aliases,
             'aliased_denominators': aliased_denominators,
@@ -355,6 +839,18 @@ class MeasureCalculation(object):
             context
         )
 
+    def get_conditional_columns(self, num_or_denom):
+        """Return the measure's numerator or denominator columns, for
+        selecting alongside those of other measures in shared_sums.sql.
+
+        """
+        prefix = self._get_sums_prefix(num_or_denom)
+        condition = "(%s)" % getattr(self.measure, num_or_denom + '_where')
+        columns = self.measure.columns_for_select(num_or_denom)
+        columns = re.sub(r"AS ([a-z0-9_]+)", r"AS %s\1" % prefix, columns)
+        columns = conditional_aggregates(columns.strip(), condition)
+        return ", %s, COUNTIF(%s) AS %srows" % (columns, condition, prefix)
+
     def add_practice_percent_rank(self):
         """Add a percentile rank to the ratios table
         """
@@ -411,42 +907,24 @@ class MeasureCalculation(object):
 
         Returns number of rows written.
 
-        Uses COPY command via a CSV file for performance as this can
-        be a very large number, especially when computing many months'
-        data at once.  We drop and then recreate indexes to improve
-        load time performance.
-
         """
-        fieldnames = ['pct_id', 'measure_id', 'num_items', 'numerator',
-                      'denominator', 'month',
-                      'percentile', 'calc_value', 'denom_items',
-                      'denom_quantity', 'denom_cost', 'num_cost',
-                      'num_quantity', 'practice_id', 'cost_savings']
-        f = tempfile.TemporaryFile(mode='r+')
-        writer = csv.DictWriter(f, fieldnames=fieldnames)
-        c = 0
-        # Write the data we want to load into a file
-        for datum in self.get_rows_as_dicts(self.practice_table_name):
-            datum['measure_id'] = self.measure.id
-            if self.measure.is_cost_based:
-                datum['cost_savings'] = json.dumps(convertSavingsToDict(datum))
-            datum['percentile'] = normalisePercentile(datum['percentile'])
-            writer.writerow(datum)
-            c += 1
-        # load data
-        copy_str = "COPY frontend_measurevalue(%s) FROM STDIN "
-        copy_str += "WITH (FORMAT CSV)"
-        self.log(copy_str % ", ".join(fieldnames))
-        f.seek(0)
-        with connection.cursor() as cursor:
-            cursor.copy_expert(copy_str % ", ".join(fieldnames), f)
-        f.close()
+        def rows():
+            for datum in self.get_rows_as_dicts(self.practice_table_name):
+                datum['measure_id'] = self.measure.id
+                if self.measure.is_cost_based:
+                    datum['cost_savings'] = json.dumps(
+                        convertSavingsToDict(datum))
+                datum['percentile'] = normalisePercentile(datum['percentile'])
+                yield datum
+
+        c = self.copy_rows_to_database(
+            'frontend_measurevalue', MEASURE_VALUE_FIELDS, rows())
         self.log("Wrote %s values" % c)
         return c
 
     def calculate_ccgs(self):
         """Calculate ratios, centiles and (optionally) cost savings at a
-        CCG level, and write these to the database.
+        CCG level.
 
         """
         self.log("Calculating CCG ratios")
@@ -458,9 +936,6 @@ class MeasureCalculation(object):
         if self.measure.is_cost_based:
             self.log("Calculating CCG cost savings")
             self.calculate_cost_savings_for_ccgs()
-        self.log("Writing CCG data to postgres")
-        number_rows_written = self.write_ccg_ratios_to_database()
-        return number_rows_written
 
     def calculate_ccg_ratios(self):
         """Sums all the fields in the per-practice table, grouped by
@@ -538,22 +1013,23 @@ class MeasureCalculation(object):
         Retuns number of rows written.
 
         """
-        with transaction.atomic():
-            c = 0
+        def rows():
             for datum in self.get_rows_as_dicts(self.ccg_table_name):
                 datum['measure_id'] = self.measure.id
                 if self.measure.is_cost_based:
-                    datum['cost_savings'] = convertSavingsToDict(datum)
+                    datum['cost_savings'] = json.dumps(
+                        convertSavingsToDict(datum))
                 datum['percentile'] = normalisePercentile(datum['percentile'])
-                MeasureValue.objects.create(**datum)
-                c += 1
+                yield datum
+
+        c = self.copy_rows_to_database(
+            'frontend_measurevalue', MEASURE_VALUE_FIELDS, rows())
         self.log("Wrote %s CCG measures" % c)
         return c
 
     def calculate_global(self):
         if self.measure.is_cost_based:
             self.calculate_global_cost_savings()
-        self.write_global_centiles_to_database()
 
     def calculate_global_cost_savings(self):
         """Sum cost savings at practice and CCG levels.
@@ -572,46 +1048,62 @@ class MeasureCalculation(object):
         """
         self.log("Writing global centiles from %s to database"
                  % self.globals_table_name)
-        count = 0
-        for d in self.get_rows_as_dicts(self.globals_table_name):
-            ccg_deciles = {}
-            practice_deciles = {}
-            ccg_cost_savings = {}
-            practice_cost_savings = {}
-            d['measure_id'] = self.measure.id
-            # The cost-savings calculations prepend columns with
-            # global_. There is probably a better way of contstructing
-            # the query so this clean-up doesn't have to happen...
-            new_d = {}
-            for attr, value in d.iteritems():
-                new_d[attr.replace('global_', '')] = value
-            d = new_d
-
-            mg, _ = MeasureGlobal.objects.get_or_create(
-                measure_id=self.measure.id,
-                month=d['month']
-            )
 
-            # Coerce decile-based values into JSON objects
-            if self.measure.is_cost_based:
-                practice_cost_savings = convertSavingsToDict(
-                    d, prefix='practice')
-                ccg_cost_savings = convertSavingsToDict(
-                    d, prefix='ccg')
-                mg.cost_savings = {'ccg': ccg_cost_savings,
-                                   'practice': practice_cost_savings}
-            practice_deciles = convertDecilesToDict(d, prefix='practice')
-            ccg_deciles = convertDecilesToDict(d, prefix='ccg')
-            mg.percentiles = {'ccg': ccg_deciles, 'practice': practice_deciles}
-
-            # Set the rest of the data returned from bigquery directly
-            # on the model
-            for attr, value in d.iteritems():
-                setattr(mg, attr, value)
-            mg.save()
-            count += 1
+        def rows():
+            for d in self.get_rows_as_dicts(self.globals_table_name):
+                # The cost-savings calculations prepend columns with
+                # global_. There is probably a better way of contstructing
+                # the query so this clean-up doesn't have to happen...
+                new_d = {}
+                for attr, value in d.iteritems():
+                    new_d[attr.replace('global_', '')] = value
+                d = new_d
+                d['measure_id'] = self.measure.id
+
+                # Coerce decile-based values into JSON objects
+                if self.measure.is_cost_based:
+                    practice_cost_savings = convertSavingsToDict(
+                        d, prefix='practice')
+                    ccg_cost_savings = convertSavingsToDict(
+                        d, prefix='ccg')
+                    d['cost_savings'] = json.dumps(
+                        {'ccg': ccg_cost_savings,
+                         'practice': practice_cost_savings})
+                practice_deciles = convertDecilesToDict(d, prefix='practice')
+                ccg_deciles = convertDecilesToDict(d, prefix='ccg')
+                d['percentiles'] = json.dumps(
+                    {'ccg': ccg_deciles, 'practice': practice_deciles})
+                set_global_calc_value(d)
+                yield d
+
+        count = self.copy_rows_to_database(
+            'frontend_measureglobal', MEASURE_GLOBAL_FIELDS, rows())
         self.log("Created %s measureglobals" % count)
 
+    def copy_rows_to_database(self, table_name, fieldnames, rows):
+        """Stream the given dicts into the given table with COPY, without
+        writing them to a file first.
+
+        Returns number of rows written.
+
+        """
+        counter = {'rows': 0}
+
+        def values():
+            for row in rows:
+                counter['rows'] += 1
+                for field in INTEGER_FIELDS:
+                    if row.get(field) is not None:
+                        row[field] = int(row[field])
+                yield [row.get(field) for field in fieldnames]
+
+        copy_str = "COPY %s(%s) FROM STDIN WITH (FORMAT CSV)" % (
+            table_name, ", ".join(fieldnames))
+        self.log(copy_str)
+        with connection.cursor() as cursor:
+            cursor.copy_expert(copy_str, ChunkReader(csv_chunks(values())))
+        return counter['rows']
+
     def insert_rows_from_query(self, query_id, table_name, ctx, legacy=False):
         """Interpolate values from ctx into SQL identified by query_id, and
         insert results into given table.
@@ -645,6 +1137,22 @@ class MeasureCalculation(object):
         else:
             logger.info(message)
 
+    def _get_sums_prefix(self, num_or_denom):
+        if num_or_denom == 'numerator':
+            return "%s_num_" % self.measure.id
+        return "%s_denom_" % self.measure.id
+
+    def _get_sums_columns(self, num_or_denom):
+        """Return SQL selecting the measure's numerator or denominator
+        columns from its SourceSums table, with their original names.
+
+        """
+        prefix = self._get_sums_prefix(num_or_denom)
+        aliases = re.findall(
+            r"AS ([a-z0-9_]+)", self.measure.columns_for_select(num_or_denom))
+        return ", ".join(
+            "%s%s AS %s" % (prefix, alias, alias) for alias in aliases)
+
     def _get_col_aliases(self, num_or_denom=None):
         """Return column names referred to in measure definitions for both
         numerator or denominator.
@@ -661,6 +1169,311 @@ class MeasureCalculation(object):
         return [x for x in aliases if x not in num_or_denom]
 
 
+class LocalMeasureCalculation(MeasureCalculation):
+    """Logic for measure calculations with pandas, from the prescribing
+    data in the local database.
+
+    Each step matches the corresponding query in `measure_sql/`, and
+    produces a DataFrame with the same columns as the BigQuery table
+    that the query writes to, so that the same code can write the
+    results to the database.
+
+    """
+
+    def __init__(self, *args, **kwargs):
+        super(LocalMeasureCalculation, self).__init__(*args, **kwargs)
+        for num_or_denom in ['numerator', 'denominator']:
+            from_table = getattr(self.measure, num_or_denom + '_from')
+            if from_table.strip() not in LOCAL_SOURCES:
+                raise CommandError(
+                    "Measure %s can't be calculated locally, because its "
+                    "%s is selected from %s" % (
+                        self.measure.id, num_or_denom, from_table.strip()))
+        for num_or_denom in ['numerator', 'denominator']:
+            self.check_sums_sql(num_or_denom)
+        self.tables = {}
+
+    def check_sums_sql(self, num_or_denom):
+        """Raise a CommandError if the measure's numerator or denominator
+        query isn't valid in Postgres (for instance because it uses
+        BigQuery functions), so that such measures are rejected before
+        any results are written.
+
+        """
+        try:
+            with transaction.atomic():
+                with connection.cursor() as cursor:
+                    cursor.execute(
+                        'EXPLAIN ' + self.get_sums_sql(num_or_denom),
+                        {'start_date': self.start_date,
+                         'end_date': self.end_date})
+        except DatabaseError as e:
+            raise CommandError(
+                "Measure %s can't be calculated locally, because its %s "
+                "isn't valid in Postgres: %s" % (
+                    self.measure.id, num_or_denom, str(e).strip()))
+
+    def calculate(self):
+        self.calculate_locally()
+        self.write_to_database()
+
+    def calculate_locally(self):
+        """Compute the practice, CCG and global tables, in the same order
+        as `calculate_in_bigquery()`.
+
+        """
+        self.log("Calculating practice ratios locally")
+        practices = self.calculate_practice_ratios()
+        practices['percentile'] = percent_rank(practices)
+        globals_ = self.calculate_global_sums(practices)
+        globals_ = globals_.join(deciles(practices, 'practice'))
+
+        self.log("Calculating CCG ratios locally")
+        ccgs = self.calculate_ccg_ratios(practices)
+        ccgs['percentile'] = percent_rank(ccgs)
+        globals_ = globals_.join(deciles(ccgs, 'ccg'))
+        globals_ = globals_.reset_index()
+
+        if self.measure.is_cost_based:
+            self.log("Calculating cost savings locally")
+            add_cost_savings(practices, globals_, 'practice')
+            add_cost_savings(ccgs, globals_, 'ccg')
+            for prefix, df in [('practice', practices), ('ccg', ccgs)]:
+                savings = total_cost_savings(df, prefix)
+                # Months without any savings at either level are
+                # dropped, as by the JOINs in global_cost_savings.sql
+                globals_ = globals_.merge(
+                    savings, left_on='month', right_index=True)
+
+        self.tables = {
+            self.practice_table_name: practices,
+            self.ccg_table_name: ccgs,
+            self.globals_table_name: globals_,
+        }
+
+    def calculate_practice_ratios(self):
+        """Return a row for every standard practice in every month, with
+        the practice's numerator, denominator and ratio.
+
+        """
+        denominator_from = LOCAL_SOURCES[self.measure.denominator_from.strip()]
+        params = {'start_date': self.start_date, 'end_date': self.end_date}
+        practices = query_frame(
+            "SELECT code AS practice_id, ccg_id AS pct_id "
+            "FROM frontend_practice WHERE setting = 4")
+        months = query_frame(
+            "SELECT DISTINCT month FROM (%s) source "
+            "WHERE month >= %%(start_date)s AND month <= %%(end_date)s" % (
+                denominator_from), params)
+        practices['key'] = months['key'] = 1
+        df = practices.merge(months, on='key').drop('key', axis=1)
+
+        # As in practice_ratios.sql, a numerator is only counted where
+        # there is also a denominator
+        num = self.get_sums('numerator')
+        denom = self.get_sums('denominator')
+        sums = denom.merge(num, on=['practice', 'month'], how='left')
+        sums = sums.rename(columns={'practice': 'practice_id'})
+        df = df.merge(sums, on=['practice_id', 'month'], how='left')
+        df['numerator'] = df['numerator'].fillna(0)
+        df['denominator'] = df['denominator'].fillna(0)
+        df['calc_value'] = ieee_divide(df['numerator'], df['denominator'])
+        df.loc[np.isinf(df['calc_value']), 'calc_value'] = np.nan
+        return df
+
+    def get_sums_sql(self, num_or_denom):
+        """Return the measure's numerator or denominator query against the
+        local database, with `start_date` and `end_date` parameters.
+
+        """
+        m = self.measure
+        source = LOCAL_SOURCES[getattr(m, num_or_denom + '_from').strip()]
+        return (
+            "SELECT month, practice, {columns} "
+            "FROM ({source}) source "
+            "WHERE month >= %(start_date)s AND month <= %(end_date)s "
+            "AND ({where}) "
+            "GROUP BY practice, month").format(
+                columns=escape_percent(m.columns_for_select(num_or_denom)),
+                source=source,
+                where=escape_percent(getattr(m, num_or_denom + '_where')))
+
+    def get_sums(self, num_or_denom):
+        """Run the measure's numerator or denominator query against the
+        local database, returning the sums for each practice in each month,
+        with aliased columns prefixed as in practice_ratios.sql.
+
+        """
+        df = query_frame(
+            self.get_sums_sql(num_or_denom),
+            {'start_date': self.start_date, 'end_date': self.end_date})
+        prefix = 'num_' if num_or_denom == 'numerator' else 'denom_'
+        aliases = self._get_col_aliases(num_or_denom)
+        df = df[['month', 'practice', num_or_denom] + aliases]
+        df = df.rename(columns=dict((col, prefix + col) for col in aliases))
+        for col in df.columns[2:]:
+            df[col] = df[col].astype(float)
+        return df
+
+    def calculate_global_sums(self, practices):
+        """Return the totals across all practices for each month, as in
+        global_deciles_practices.sql.
+
+        """
+        extra_fields = self._get_extra_fields()
+        grouped = practices.groupby('month')
+        df = grouped[['denominator', 'numerator']].sum()
+        df = df.join(sum_or_null(grouped, extra_fields))
+        if self.measure.is_cost_based:
+            df['cost_per_denom'] = ieee_divide(
+                df['denom_cost'] - df['num_cost'],
+                df['denom_quantity'] - df['num_quantity'])
+            df['cost_per_num'] = ieee_divide(
+                df['num_cost'], df['num_quantity'])
+            for col in ['cost_per_denom', 'cost_per_num']:
+                df.loc[np.isinf(df[col]), col] = np.nan
+        return df
+
+    def calculate_ccg_ratios(self, practices):
+        """Sum the practice ratios for each CCG, as in ccg_ratios.sql.
+
+        """
+        ccgs = query_frame(
+            "SELECT code AS pct_id FROM frontend_pct WHERE org_type = 'CCG'")
+        df = practices.merge(ccgs, on='pct_id')
+        grouped = df.groupby(['pct_id', 'month'])
+        extra_fields = self._get_extra_fields()
+        df = grouped[['numerator', 'denominator']].sum()
+        df = df.join(sum_or_null(grouped, extra_fields)).reset_index()
+        # Unlike for practices, infinite and NaN ratios are kept
+        df['calc_value'] = ieee_divide(df['numerator'], df['denominator'])
+        return df
+
+    def get_rows_as_dicts(self, table_name):
+        """Iterate over the specified table computed by
+        `calculate_locally()`, returning a dict for each row of data.
+
+        """
+        df = self.tables[table_name]
+        # These are NaN rather than NULL in BigQuery
+        nan_fields = []
+        if table_name == self.ccg_table_name:
+            nan_fields = ['calc_value']
+        columns = list(df.columns)
+        for values in df.itertuples(index=False):
+            d = dict(zip(columns, values))
+            for k, v in d.items():
+                if isinstance(v, float) and math.isnan(v) \
+                   and k not in nan_fields:
+                    d[k] = None
+            yield d
+
+    def _get_extra_fields(self):
+        return (
+            ["num_" + col for col in self._get_col_aliases('numerator')] +
+            ["denom_" + col for col in self._get_col_aliases('denominator')])
+
+
+def query_frame(sql, params=None):
+    """Return the results of the given query as a DataFrame."""
+    with connection.cursor() as cursor:
+        cursor.execute(sql, params)
+        columns = [col[0] for col in cursor.description]
+        return pd.DataFrame.from_records(cursor.fetchall(), columns=columns)
+
+
+def escape_percent(sql):
+    """Escape SQL from a measure definition for use with query
+    parameters.
+
+    Definitions use both `%` and `%%` as wildcards, since BigQuery
+    queries aren't interpolated.
+
+    """
+    return re.sub(r'%+', '%%', sql)
+
+
+def ieee_divide(numerator, denominator):
+    """Divide one Series by another, as BigQuery's IEEE_DIVIDE does.
+
+    Dividing by zero gives infinity or NaN rather than an error.
+
+    """
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return numerator / denominator
+
+
+def sum_or_null(grouped, columns):
+    """Sum the given columns of a GroupBy, giving NaN rather than zero
+    where a group has no values, as SQL's SUM() does.
+
+    """
+    sums = grouped[columns].sum()
+    return sums.where(grouped[columns].count() > 0)
+
+
+def percent_rank(df):
+    """Return the PERCENT_RANK() of each calc_value within its month, or
+    NaN where calc_value is NaN.
+
+    """
+    grouped = df[df['calc_value'].notnull()].groupby('month')['calc_value']
+    rank = grouped.rank(method='min')
+    count = grouped.transform('count')
+    percentile = ((rank - 1) / (count - 1)).where(count > 1, 0.0)
+    return percentile.reindex(df.index)
+
+
+def deciles(df, prefix):
+    """Return the PERCENTILE_CONT() of calc_value for each of CENTILES,
+    for each month.
+
+    """
+    grouped = df[df['calc_value'].notnull()].groupby('month')['calc_value']
+    return pd.DataFrame(dict(
+        ("%s_%sth" % (prefix, centile), grouped.quantile(centile / 100.0))
+        for centile in CENTILES))
+
+
+def add_cost_savings(df, globals_, prefix):
+    """Add cost_savings_N columns for each of CENTILES to the given
+    practice or CCG ratios, as in practice_cost_savings.sql.
+
+    """
+    merged = df[['month']].merge(globals_, on='month', how='left')
+    num_quantity = df['num_quantity'].fillna(0)
+    num_cost = df['num_cost'].fillna(0)
+    other_quantity = df['denom_quantity'] - num_quantity
+    with np.errstate(divide='ignore', invalid='ignore'):
+        cost_per_num = np.where(
+            df['num_quantity'] > 0,
+            df['num_cost'] / df['num_quantity'],
+            merged['cost_per_num'])
+        cost_per_denom = np.where(
+            other_quantity == 0,
+            merged['cost_per_denom'],
+            (df['denom_cost'] - num_cost) / other_quantity)
+    for centile in CENTILES:
+        target = merged["%s_%sth" % (prefix, centile)].values
+        df['cost_savings_%s' % centile] = df['denom_cost'] - (
+            target * df['denom_quantity'] * cost_per_num +
+            (df['denom_quantity'] - df['denom_quantity'] * target) *
+            cost_per_denom)
+
+
+def total_cost_savings(df, prefix):
+    """Return the sum of the positive cost savings for each month, as in
+    global_cost_savings.sql.
+
+    """
+    columns = ['cost_savings_%s' % centile for centile in CENTILES]
+    savings = df[columns].fillna(0).clip(lower=0)
+    savings['month'] = df['month']
+    savings = savings.groupby('month').sum()
+    return savings.rename(
+        columns=dict((col, "%s_%s" % (prefix, col)) for col in columns))
+
+
 @contextmanager
 def conditional_constraint_and_index_reconstructor(options):
     if 'measure' in options and options['measure']:
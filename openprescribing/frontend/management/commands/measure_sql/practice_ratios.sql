@@ -39,27 +39,22 @@ FROM (
         {numerator_aliases}
         {denominator_aliases}
       FROM (
+        -- sums for each measure are computed by shared_sums.sql
         SELECT month, practice, {numerator_columns}
         FROM
-          {numerator_from}
+          {measures}.{numerator_sums_table}
         WHERE
           DATE(month) >= '{start_date}' AND DATE(month) <= '{end_date}'
           AND
-            {numerator_where}
-        GROUP BY
-          practice,
-          month) num
+            {numerator_rows} > 0) num
       RIGHT JOIN (
         SELECT month, practice, {denominator_columns}
         FROM
-          {denominator_from}
+          {measures}.{denominator_sums_table}
         WHERE
           DATE(month) >= '{start_date}' AND DATE(month) <= '{end_date}'
           AND
-            {denominator_where}
-        GROUP BY
-          practice,
-          month) denom
+            {denominator_rows} > 0) denom
       ON
         (num.practice=denom.practice
           AND num.month=denom.month)
@@ -73,7 +68,7 @@ FROM (
             FROM {hscic}.practices AS practices
             CROSS JOIN (
               SELECT month
-              FROM {denominator_from}
+              FROM {measures}.{denominator_sums_table}
               GROUP BY month) prescribing
             WHERE
               practices.setting = 4 AND
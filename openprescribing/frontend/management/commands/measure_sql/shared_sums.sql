@@ -0,0 +1,17 @@
+-- Computes the numerators and denominators of every measure that
+-- selects from the same table, with a single scan of that table.  Each
+-- measure's aggregates only include rows matching that measure's WHERE
+-- clause, and the matching rows are counted so that practice_ratios.sql
+-- can ignore practices which had none, as if the clause had been applied
+-- to the whole query.
+SELECT
+  month,
+  practice
+  {columns}
+FROM
+  {from_table}
+WHERE
+  DATE(month) >= '{start_date}' AND DATE(month) <= '{end_date}'
+GROUP BY
+  practice,
+  month
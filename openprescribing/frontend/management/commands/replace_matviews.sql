@@ -14,6 +14,18 @@ CREATE TABLE IF NOT EXISTS vw__presentation_summary (
 CREATE INDEX IF NOT EXISTS vw__idx_presentation_summary
   ON vw__presentation_summary(presentation_code varchar_pattern_ops);
 
+DROP TABLE IF EXISTS vw__bnf_rollup;
+CREATE TABLE IF NOT EXISTS vw__bnf_rollup (
+  processing_date date,
+  bnf_code character varying(15),
+  items bigint,
+  quantity bigint,
+  actual_cost double precision,
+  net_cost double precision);
+
+CREATE INDEX IF NOT EXISTS vw__idx_bnf_rollup
+  ON vw__bnf_rollup(bnf_code, processing_date);
+
 DROP TABLE IF EXISTS vw__presentation_summary_by_ccg;
 CREATE TABLE IF NOT EXISTS vw__presentation_summary_by_ccg (
   processing_date date,
@@ -47,6 +59,7 @@ DROP TABLE IF EXISTS vw__chemical_summary_by_practice;
 CREATE TABLE IF NOT EXISTS vw__chemical_summary_by_practice (
   processing_date date,
   practice_id character varying(6),
+  pct_id character varying(3),
   chemical_id character varying(9),
   items bigint,
   cost double precision,
@@ -58,16 +71,20 @@ CREATE INDEX IF NOT EXISTS vw__idx_chem_by_practice
   ON vw__chemical_summary_by_practice (practice_id, chemical_id varchar_pattern_ops);
 CREATE INDEX IF NOT EXISTS idx_chem_by_practice_bydate
   ON vw__chemical_summary_by_practice (chemical_id varchar_pattern_ops, processing_date);
+CREATE INDEX IF NOT EXISTS vw__idx_chem_by_practice_by_ccg
+  ON vw__chemical_summary_by_practice (pct_id, chemical_id varchar_pattern_ops);
 
 DROP TABLE IF EXISTS vw__practice_summary;
 CREATE TABLE IF NOT EXISTS vw__practice_summary (
   processing_date date,
   practice_id character varying(6),
+  pct_id character varying(3),
   items bigint,
   cost double precision,
   quantity bigint);
 
 CREATE INDEX IF NOT EXISTS vw__practice_summary_prac_id ON vw__practice_summary(practice_id);
+CREATE INDEX IF NOT EXISTS vw__practice_summary_pct_id ON vw__practice_summary(pct_id);
 
 
 DROP TABLE IF EXISTS vw__ccgstatistics;
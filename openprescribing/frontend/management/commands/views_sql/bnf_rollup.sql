@@ -0,0 +1,32 @@
+-- National totals for every node of the BNF hierarchy (chapter,
+-- section, paragraph, subparagraph, chemical, product and presentation)
+-- for every month, so that spending on any of them can be looked up
+-- directly.  Months with no prescribing of a node have no row; queries
+-- pad these with zeros themselves.
+WITH prescribing AS (
+  SELECT
+    month,
+    SUBSTR(bnf_code, 1, code_length) AS bnf_code,
+    items,
+    quantity,
+    actual_cost,
+    net_cost
+  FROM
+    {hscic}.normalised_prescribing_standard
+  CROSS JOIN
+    UNNEST([2, 4, 6, 7, 9, 11, 15]) AS code_length
+  WHERE month > TIMESTAMP(DATE_SUB(DATE "{{this_month}}", INTERVAL 5 YEAR))
+    AND {{months_filter}}
+)
+SELECT
+  month AS processing_date,
+  bnf_code,
+  SUM(items) AS items,
+  CAST(SUM(quantity) AS INT64) AS quantity,
+  SUM(actual_cost) AS actual_cost,
+  SUM(net_cost) AS net_cost
+FROM
+  prescribing
+GROUP BY
+  month,
+  bnf_code
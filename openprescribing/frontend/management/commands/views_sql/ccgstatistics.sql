@@ -21,6 +21,7 @@ FROM
 JOIN {hscic}.ccgs ccgs
 ON (statistics.pct_id = ccgs.code AND ccgs.org_type = 'CCG')
 WHERE month > TIMESTAMP(DATE_SUB(DATE "{{this_month}}", INTERVAL 5 YEAR))
+  AND {{months_filter}}
 GROUP BY
   month,
   pct_id,
@@ -1,6 +1,7 @@
 SELECT
   month AS processing_date,
   practice AS practice_id,
+  pct AS pct_id,
   SUBSTR(bnf_code, 1, 9) AS chemical_id,
   SUM(items) AS items,
   SUM(actual_cost) AS cost,
@@ -8,7 +9,9 @@ SELECT
 FROM
   {hscic}.normalised_prescribing_standard
 WHERE month > TIMESTAMP(DATE_SUB(DATE "{{this_month}}", INTERVAL 5 YEAR))
+  AND {{months_filter}}
 GROUP BY
   processing_date,
   practice_id,
+  pct_id,
   chemical_id
@@ -1,12 +1,15 @@
 SELECT
   month AS processing_date,
   practice AS practice_id,
+  pct AS pct_id,
   SUM(items) AS items,
   SUM(actual_cost) AS cost,
   CAST(SUM(quantity) AS INT64) AS quantity
 FROM
   {hscic}.normalised_prescribing_standard
 WHERE month > TIMESTAMP(DATE_SUB(DATE "{{this_month}}", INTERVAL 5 YEAR))
+  AND {{months_filter}}
 GROUP BY
   processing_date,
-  practice_id
+  practice_id,
+  pct_id
@@ -9,6 +9,7 @@ SELECT
 FROM
   {hscic}.normalised_prescribing_standard
 WHERE month > TIMESTAMP(DATE_SUB(DATE "{{this_month}}", INTERVAL 5 YEAR))
+  AND {{months_filter}}
 GROUP BY
   processing_date,
   pct_id,
@@ -0,0 +1,143 @@
+import hashlib
+import json
+import logging
+import re
+import time
+
+from django.conf import settings
+from django.db import DatabaseError
+from django.db import connection
+from django.db import transaction
+
+
+ledger = logging.getLogger('frontend.slow_requests')
+
+# Patterns for literal values in SQL, replaced by `?` when normalising
+_STRING_LITERAL = re.compile(r"'(?:[^']|'')*'")
+_NUMBER_LITERAL = re.compile(r'\b\d+(?:\.\d+)?\b')
+_LIST_OF_PLACEHOLDERS = re.compile(r'\?(?:\s*,\s*\?)+')
+_WHITESPACE = re.compile(r'\s+')
+
+# Calls to functions with side effects, such as taking advisory locks,
+# which statements must not make to be explained
+_SIDE_EFFECT_FUNCTION = re.compile(
+    r'\b(pg_\w+|set_config|nextval|setval|lo_\w+|dblink\w*)\s*\(',
+    re.IGNORECASE)
+
+
+class QueryProfilingMiddleware(object):
+    """Record the SQL run by each request, and report it in a
+    `Server-Timing` header.
+
+    The header gives the number of statements and total time spent
+    in the database, the time spent rendering the response (for DRF
+    and template responses, which are rendered after the view
+    returns), the total time, and the time and fingerprint of the
+    slowest statement.
+
+    Requests which take longer than SLOW_REQUEST_THRESHOLD_MS are
+    logged to the `frontend.slow_requests` ledger, along with their
+    slowest statement and its `EXPLAIN` output.
+
+    Queries run while a streaming response is being consumed happen
+    after this middleware has finished, and so are not counted.
+
+    """
+    def process_request(self, request):
+        request._profiling_start = time.time()
+        request._profiling_rendered = None
+        request._profiling_force_debug_cursor = connection.force_debug_cursor
+        connection.force_debug_cursor = True
+
+    def process_template_response(self, request, response):
+        # Called after the view returns and before the response is
+        # rendered
+        request._profiling_rendered = time.time()
+        return response
+
+    def process_response(self, request, response):
+        if not hasattr(request, '_profiling_start'):
+            # An earlier middleware returned a response before ours ran
+            return response
+        end = time.time()
+        connection.force_debug_cursor = \
+            request._profiling_force_debug_cursor
+
+        queries = connection.queries
+        db_time = sum(float(query['time']) for query in queries)
+        slowest = None
+        if queries:
+            slowest = max(queries, key=lambda query: float(query['time']))
+        total_time = end - request._profiling_start
+        if request._profiling_rendered:
+            render_time = end - request._profiling_rendered
+        else:
+            render_time = 0
+
+        timings = [
+            'db;dur=%.1f;desc="%s queries"' % (db_time * 1000, len(queries)),
+            'render;dur=%.1f' % (render_time * 1000),
+            'total;dur=%.1f' % (total_time * 1000),
+        ]
+        if slowest:
+            normalised = normalise_sql(slowest['sql'])
+            timings.append('slowest-query;dur=%.1f;desc="%s"' % (
+                float(slowest['time']) * 1000, fingerprint(normalised)))
+        response['Server-Timing'] = ', '.join(timings)
+
+        if total_time * 1000 > settings.SLOW_REQUEST_THRESHOLD_MS:
+            entry = {
+                'path': request.path,
+                'query_string': request.META.get('QUERY_STRING', ''),
+                'status': response.status_code,
+                'total_ms': round(total_time * 1000, 1),
+                'db_ms': round(db_time * 1000, 1),
+                'render_ms': round(render_time * 1000, 1),
+                'queries': len(queries),
+            }
+            if slowest:
+                entry['slowest_query'] = {
+                    'ms': round(float(slowest['time']) * 1000, 1),
+                    'fingerprint': fingerprint(normalised),
+                    'sql': normalised,
+                    'explain': explain(slowest['sql']),
+                }
+            ledger.warning(json.dumps(entry))
+        return response
+
+
+def normalise_sql(sql):
+    """Strip literal values out of a statement, so that statements which
+    differ only in their parameters look the same.
+
+    """
+    sql = _STRING_LITERAL.sub('?', sql)
+    sql = _NUMBER_LITERAL.sub('?', sql)
+    sql = _LIST_OF_PLACEHOLDERS.sub('?, ...', sql)
+    return _WHITESPACE.sub(' ', sql).strip()
+
+
+def fingerprint(normalised_sql):
+    return hashlib.md5(normalised_sql.encode('utf-8')).hexdigest()[:8]
+
+
+def explain(sql):
+    """Return the output of `EXPLAIN` for a statement, or None if it
+    might modify data or call functions with side effects.
+
+    The statement is only planned, not run again, so this doesn't add
+    the statement's own time to requests that are already slow.
+
+    """
+    if not re.match(r'\s*(SELECT|WITH)\b', sql, re.IGNORECASE) or \
+       re.search(r'\b(INSERT|UPDATE|DELETE)\b', sql, re.IGNORECASE) or \
+       _SIDE_EFFECT_FUNCTION.search(sql):
+        return None
+    try:
+        with transaction.atomic():
+            with connection.cursor() as cursor:
+                cursor.execute('EXPLAIN ' + sql)
+                plan = '\n'.join(row[0] for row in cursor.fetchall())
+    except DatabaseError as e:
+        plan = 'EXPLAIN failed: %s' % e
+    return plan
@@ -0,0 +1,36 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import django.core.validators
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('frontend', '0031_auto_20171004_1330'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PPUBin',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('date', models.DateField()),
+                ('presentation_code', models.CharField(max_length=15, validators=[django.core.validators.RegexValidator(b'^[\\w]*$', code=b'Invalid name', message=b'name must be alphanumeric')])),
+                ('price_per_unit', models.DecimalField(decimal_places=2, max_digits=16, null=True)),
+                ('quantity', models.FloatField()),
+                ('net_cost', models.FloatField(null=True)),
+                ('pct', models.ForeignKey(db_constraint=False, null=True, on_delete=django.db.models.deletion.CASCADE, to='frontend.PCT')),
+            ],
+        ),
+        # The bubble chart selects bins by month and by ranges of
+        # presentation codes (see api/code_filters.py), which needs
+        # varchar_pattern_ops
+        migrations.RunSQL(
+            "CREATE INDEX frontend_ppubin_date_presentation_code "
+            "ON frontend_ppubin (date, presentation_code varchar_pattern_ops)",
+            "DROP INDEX frontend_ppubin_date_presentation_code"
+        ),
+    ]
@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('frontend', '0032_ppubin'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='presentation',
+            name='current_version_code',
+            field=models.CharField(blank=True, max_length=15, null=True),
+        ),
+    ]
@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('frontend', '0033_presentation_current_version_code'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='measure',
+            name='definition_fingerprint',
+            field=models.CharField(blank=True, max_length=40, null=True),
+        ),
+    ]
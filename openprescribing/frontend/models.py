@@ -1,3 +1,4 @@
+from collections import defaultdict
 import cPickle
 import json
 import re
@@ -8,6 +9,7 @@ from django.contrib.postgres.fields import JSONField
 from django.contrib.postgres.fields import ArrayField
 from django.contrib.auth.models import User
 from django.core.urlresolvers import reverse
+from django.db import transaction
 
 from anymail.signals import EventType
 
@@ -304,6 +306,40 @@ class PresentationManager(models.Manager):
     def current(self):
         return self.filter(replaced_by__isnull=True)
 
+    def refresh_current_versions(self):
+        """Set `current_version_code` on every presentation that has been
+        replaced, following each chain of replacements in memory.
+
+        Returns a dict mapping the code of each replaced presentation to
+        the code of its current version.
+        """
+        replacements = dict(
+            self.filter(replaced_by__isnull=False)
+            .values_list('bnf_code', 'replaced_by_id'))
+        mapping = {}
+        for bnf_code in replacements:
+            version = bnf_code
+            next_version = replacements[bnf_code]
+            seen = set()
+            while next_version:
+                if next_version in seen:
+                    break  # avoid loops
+                seen.add(next_version)
+                version = next_version
+                next_version = replacements.get(version)
+            mapping[bnf_code] = version
+
+        by_current_code = defaultdict(list)
+        for bnf_code, current_code in mapping.items():
+            by_current_code[current_code].append(bnf_code)
+        with transaction.atomic():
+            self.exclude(current_version_code__isnull=True).update(
+                current_version_code=None)
+            for current_code, bnf_codes in by_current_code.items():
+                self.filter(bnf_code__in=bnf_codes).update(
+                    current_version_code=current_code)
+        return mapping
+
 
 class Presentation(models.Model):
     '''GP prescribing products. Import from BNF codes file from BSA.
@@ -323,6 +359,10 @@ class Presentation(models.Model):
     is_current = models.BooleanField(default=True)
     percent_of_adq = models.FloatField(null=True, blank=True)
     replaced_by = models.ForeignKey('self', null=True, blank=True)
+    # The end of the chain of `replaced_by`, denormalised by
+    # `Presentation.objects.refresh_current_versions()`
+    current_version_code = models.CharField(
+        max_length=15, null=True, blank=True)
 
     objects = PresentationManager()
 
@@ -344,14 +384,18 @@ class Presentation(models.Model):
 
         Return the most recent version the code.
         """
+        if self.current_version_code == self.bnf_code:
+            return self
+        elif self.current_version_code:
+            return Presentation.objects.get(pk=self.current_version_code)
         version = self
         next_version = self.replaced_by
-        seen = []
+        seen = set()
         while next_version:
             if next_version in seen:
                 break  # avoid loops
             else:
-                seen.append(next_version)
+                seen.add(next_version)
                 version = next_version
                 next_version = version.replaced_by
         return version
@@ -435,6 +479,10 @@ class Measure(models.Model):
     is_percentage = models.NullBooleanField()
     is_cost_based = models.NullBooleanField()
     low_is_good = models.NullBooleanField()
+    # Identifies the definition (and calculation SQL) that the stored
+    # values were calculated with; see `import_measures`
+    definition_fingerprint = models.CharField(
+        max_length=40, null=True, blank=True)
 
     def __str__(self):
         return self.name
@@ -649,7 +697,10 @@ class OrgBookmark(models.Model):
 
 class ImportLogManager(models.Manager):
     def latest_in_category(self, category):
-        return self.filter(category=category).first()
+        # Re-imports of a month share its current_at, so break ties on
+        # when they were imported
+        return self.filter(category=category).order_by(
+            '-current_at', '-imported_at').first()
 
 
 class ImportLog(models.Model):
@@ -816,3 +867,24 @@ class PPUSaving(models.Model):
     pct = models.ForeignKey(PCT, null=True, blank=True, db_index=True)
     practice = models.ForeignKey(
         Practice, null=True, blank=True, db_index=True)
+
+
+class PPUBin(models.Model):
+    """The total quantity and net cost of a presentation prescribed by
+    standard practices in a CCG in a month, at a given price per unit
+    (rounded to the nearest penny).
+
+    These are generated from prescriptions after each import (see
+    `generate_ppu_bins`), so that the price-per-unit bubble chart can
+    be drawn without aggregating the month's prescriptions.
+
+    """
+    date = models.DateField()
+    presentation_code = models.CharField(
+        max_length=15, validators=[isAlphaNumeric])
+    pct = models.ForeignKey(PCT, db_constraint=False, null=True)
+    # Null where the quantity prescribed was zero
+    price_per_unit = models.DecimalField(
+        max_digits=16, decimal_places=2, null=True)
+    quantity = models.FloatField()
+    net_cost = models.FloatField(null=True)
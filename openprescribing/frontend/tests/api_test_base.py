@@ -32,7 +32,11 @@ class ApiTestBase(TransactionTestCase):
         response = self.client.get(url, follow=True)
         if response.status_code == 404:
             raise Http404("URL %s does not exist" % url)
-        reader = csv.DictReader(response.content.splitlines())
+        if response.streaming:
+            content = ''.join(response.streaming_content)
+        else:
+            content = response.content
+        reader = csv.DictReader(content.splitlines())
         rows = []
         for row in reader:
             rows.append(row)
@@ -1,3 +1,4 @@
+import datetime
 import os
 
 from django.core.management import call_command
@@ -109,9 +110,10 @@ class CommandsTestCase(SimpleTestCase):
             results = c.fetchall()
             self.assertEqual(len(results), 2)
             self.assertEqual(results[1][1], 'P87629')
-            self.assertEqual(results[1][2], 385)
-            self.assertEqual(results[1][3], 6000)
-            self.assertEqual(results[1][4], 38500)
+            self.assertEqual(results[1][2], '03V')
+            self.assertEqual(results[1][3], 385)
+            self.assertEqual(results[1][4], 6000)
+            self.assertEqual(results[1][5], 38500)
 
             cmd = 'SELECT * FROM vw__presentation_summary '
             cmd += 'ORDER BY processing_date, presentation_code'
@@ -151,10 +153,11 @@ class CommandsTestCase(SimpleTestCase):
             results = c.fetchall()
             self.assertEqual(len(results), 2)
             self.assertEqual(results[0][1], 'N84014')
-            self.assertEqual(results[0][2], '0703021Q0')
-            self.assertEqual(results[0][3], 1110)
-            self.assertEqual(results[0][4], 84000)
-            self.assertEqual(results[0][5], 111000)
+            self.assertEqual(results[0][2], '03Q')
+            self.assertEqual(results[0][3], '0703021Q0')
+            self.assertEqual(results[0][4], 1110)
+            self.assertEqual(results[0][5], 84000)
+            self.assertEqual(results[0][6], 111000)
 
             cmd = 'SELECT * FROM vw__ccgstatistics '
             cmd += 'ORDER BY date, pct_id'
@@ -165,18 +168,56 @@ class CommandsTestCase(SimpleTestCase):
             self.assertEqual(results[0][5], 489.7)
             self.assertEqual(results[0][6]['oral_antibacterials_item'], 10)
 
-    def test_generate_sort_cmd(self):
-        cmd = create_views.generate_sort_cmd(
-            'vw__chemical_summary_by_ccg',
-            ['processing_date', 'pct_id', 'chemical_id', 'items', 'cost', 'quantity'],
-            '/tmp/vw__chemical_summary_by_ccg-2018-01-01-raw.csv',
-            '/tmp/vw__chemical_summary_by_ccg-2018-01-01-sorted.csv',
-        )
-        exp_cmd = 'tail -n +2 {} | ionice -c 2 nice -n 10 sort {} -t, >> {}'.\
-            format(
-                '/tmp/vw__chemical_summary_by_ccg-2018-01-01-raw.csv',
-                '-k3,3 -k2,2',
-                '/tmp/vw__chemical_summary_by_ccg-2018-01-01-sorted.csv',
-            )
+    def test_incremental_create_views(self):
+        call_command('create_views')
+        with connection.cursor() as c:
+            # A row for a month that has since been restated, and one for
+            # a month that has fallen out of the window
+            c.execute(
+                "INSERT INTO vw__practice_summary "
+                "(processing_date, practice_id, pct_id, items, cost, "
+                "quantity) VALUES "
+                "('2015-10-01', 'XXXXXX', '03V', 1, 1, 1), "
+                "('2010-10-01', 'P87629', '03V', 1, 1, 1)")
+        log = ImportLog.objects.create(
+            category='prescribing', current_at='2015-10-01')
+
+        call_command('create_views', incremental=True)
+        log.delete()
 
-        self.assertEqual(cmd, exp_cmd)
+        with connection.cursor() as c:
+            c.execute(
+                'SELECT processing_date, practice_id, items '
+                'FROM vw__practice_summary '
+                'ORDER BY processing_date, practice_id')
+            results = c.fetchall()
+        self.assertEqual(len(results), 2)
+        self.assertEqual(str(results[0][0]), '2015-09-01')
+        self.assertEqual(str(results[1][0]), '2015-10-01')
+        self.assertEqual(results[1][1], 'P87629')
+        self.assertEqual(results[1][2], 385)
+
+    def test_incremental_refresh_of_statistics(self):
+        call_command('create_views')
+        with connection.cursor() as c:
+            c.execute("UPDATE vw__ccgstatistics SET total_list_size = 0")
+
+        # Nothing has been imported, but list sizes may have been
+        call_command('create_views', incremental=True)
+
+        with connection.cursor() as c:
+            c.execute("SELECT SUM(total_list_size) FROM vw__ccgstatistics")
+            self.assertGreater(c.fetchone()[0], 0)
+
+    def test_single_view_is_not_logged_as_refresh(self):
+        logs = ImportLog.objects.filter(category='views')
+        count = logs.count()
+        call_command('create_views', view='ccgstatistics')
+        self.assertEqual(logs.count(), count)
+
+    def test_months_filter_sql(self):
+        self.assertEqual(create_views.months_filter_sql(None), 'TRUE')
+        self.assertEqual(
+            create_views.months_filter_sql(
+                [datetime.date(2015, 9, 1), datetime.date(2015, 10, 1)]),
+            'month IN (TIMESTAMP("2015-09-01"), TIMESTAMP("2015-10-01"))')
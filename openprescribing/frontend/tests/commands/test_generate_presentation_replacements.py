@@ -1,6 +1,11 @@
+import datetime
+
 from django.core.management import call_command
+from django.db import connection
 from django.test import TestCase
+from django.test import TransactionTestCase
 from frontend.models import Chemical
+from frontend.models import PPUBin
 from frontend.models import Presentation
 from frontend.models import Product
 from frontend.models import Section
@@ -8,13 +13,7 @@ from frontend.models import Section
 from mock import patch
 
 
-@patch('frontend.management.commands.generate_presentation_replacements'
-       '.cleanup_empty_classes')
-@patch('frontend.management.commands.generate_presentation_replacements'
-       '.create_bigquery_table')
-@patch('frontend.management.commands.generate_presentation_replacements'
-       '.create_bigquery_views')
-class CommandsTestCase(TestCase):
+class ReplacementsMixin(object):
     def setUp(self):
         Section.objects.create(bnf_id='0000',
                                name='Subsection 0.0',
@@ -59,6 +58,38 @@ class CommandsTestCase(TestCase):
             fixtures_dir + 'presentation_replacements_2016.txt']
         self.opts = {}
 
+    def create_prescribing_partition(self):
+        with connection.cursor() as cursor:
+            cursor.execute(
+                "CREATE TABLE frontend_prescription_201701 ("
+                "CHECK (processing_date = DATE '2017-01-01')) "
+                "INHERITS (frontend_prescription)")
+            cursor.execute(
+                "INSERT INTO frontend_prescription_201701 "
+                "(presentation_code, total_items, actual_cost, quantity, "
+                "processing_date) VALUES "
+                "('YYYYYYYYYYYYYYY', 1, 1, 1, '2017-01-01'), "
+                "('777777777777777', 1, 1, 1, '2017-01-01'), "
+                "('MMMMMMMMMMMMMMM', 1, 1, 1, '2017-01-01')")
+
+    def assert_prescribing_partition_updated(self):
+        with connection.cursor() as cursor:
+            cursor.execute(
+                "SELECT presentation_code FROM frontend_prescription_201701 "
+                "ORDER BY presentation_code")
+            codes = [row[0] for row in cursor.fetchall()]
+        self.assertEqual(
+            codes,
+            ['999999999999999', 'MMMMMMMMMMMMMMM', 'ZZZZZZZZZZZZZZZ'])
+
+
+@patch('frontend.management.commands.generate_presentation_replacements'
+       '.cleanup_empty_classes')
+@patch('frontend.management.commands.generate_presentation_replacements'
+       '.create_bigquery_table')
+@patch('frontend.management.commands.generate_presentation_replacements'
+       '.create_bigquery_views')
+class CommandsTestCase(ReplacementsMixin, TestCase):
     def test_replacements(
             self,
             mock_create_view,
@@ -107,3 +138,75 @@ class CommandsTestCase(TestCase):
             Product.objects.get(pk='44444444444').is_current, False)
         self.assertEqual(
             Product.objects.get(pk='33333333333').is_current, True)
+
+    def test_existing_prescribing_updated(
+            self,
+            mock_create_view,
+            mock_loader,
+            mock_empty_class_csv_getter):
+        self.create_prescribing_partition()
+        call_command(
+            'generate_presentation_replacements', *self.args, **self.opts)
+        self.assert_prescribing_partition_updated()
+
+    def test_ppu_bins_updated(
+            self,
+            mock_create_view,
+            mock_loader,
+            mock_empty_class_csv_getter):
+        date = datetime.date(2017, 1, 1)
+        for code, ppu, quantity in [
+                ('YYYYYYYYYYYYYYY', '0.10', 10),
+                ('ZZZZZZZZZZZZZZZ', '0.10', 5),
+                ('ZZZZZZZZZZZZZZZ', '0.20', 1),
+                ('MMMMMMMMMMMMMMM', '0.30', 1)]:
+            PPUBin.objects.create(
+                date=date, presentation_code=code, pct_id='03V',
+                price_per_unit=ppu, quantity=quantity, net_cost=quantity)
+        call_command(
+            'generate_presentation_replacements', *self.args, **self.opts)
+        bins = PPUBin.objects.order_by('presentation_code', 'price_per_unit')
+        self.assertEqual(
+            [(b.presentation_code, str(b.price_per_unit), b.quantity)
+             for b in bins],
+            [('MMMMMMMMMMMMMMM', '0.30', 1),
+             ('ZZZZZZZZZZZZZZZ', '0.10', 15),
+             ('ZZZZZZZZZZZZZZZ', '0.20', 1)])
+
+
+@patch('frontend.management.commands.generate_presentation_replacements'
+       '.cleanup_empty_classes')
+@patch('frontend.management.commands.generate_presentation_replacements'
+       '.create_bigquery_table')
+@patch('frontend.management.commands.generate_presentation_replacements'
+       '.create_bigquery_views')
+class ParallelUpdateTestCase(ReplacementsMixin, TransactionTestCase):
+    # Partitions are updated on one connection per worker, which can't see
+    # data written in a TestCase's transaction
+
+    def tearDown(self):
+        with connection.cursor() as cursor:
+            cursor.execute(
+                "DROP TABLE IF EXISTS frontend_prescription_201701, "
+                "frontend_prescription_201702")
+        super(ParallelUpdateTestCase, self).tearDown()
+
+    def test_existing_prescribing_updated_in_parallel(
+            self,
+            mock_create_view,
+            mock_loader,
+            mock_empty_class_csv_getter):
+        self.create_prescribing_partition()
+        with connection.cursor() as cursor:
+            cursor.execute(
+                "CREATE TABLE frontend_prescription_201702 ("
+                "CHECK (processing_date = DATE '2017-02-01')) "
+                "INHERITS (frontend_prescription)")
+        call_command(
+            'generate_presentation_replacements', *self.args, workers=2)
+        self.assert_prescribing_partition_updated()
+        with connection.cursor() as cursor:
+            cursor.execute(
+                "SELECT COUNT(*) FROM pg_tables "
+                "WHERE tablename LIKE 'tmp_presentation_replacements%'")
+            self.assertEqual(cursor.fetchone()[0], 0)
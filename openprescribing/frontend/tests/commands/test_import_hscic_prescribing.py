@@ -5,6 +5,7 @@ from mock import patch
 
 from django.core.management import call_command
 from django.db import InternalError
+from django.db import connection
 from django.test import TestCase
 
 from common import utils
@@ -110,6 +111,41 @@ class ImportTestCase(TestCase):
         self.assertEqual(Prescription.objects.count(), 15)
         self.assertEqual(PracticeStatistics.objects.count(), 0)
 
+    def test_import_swaps_in_partition(self):
+        with self.env:
+            call_command('import_hscic_prescribing', **self.new_opts)
+        with connection.cursor() as cursor:
+            cursor.execute(
+                "SELECT tablename FROM pg_tables "
+                "WHERE tablename LIKE 'frontend_prescription_2%'")
+            self.assertEqual(
+                [row[0] for row in cursor.fetchall()],
+                ['frontend_prescription_201304'])
+            cursor.execute(
+                "SELECT indexname FROM pg_indexes "
+                "WHERE tablename = 'frontend_prescription_201304' "
+                "ORDER BY indexname")
+            self.assertEqual([row[0] for row in cursor.fetchall()], [
+                'cnstrt_frontend_prescription_201304_pkey',
+                'idx_frontend_prescription_201304_date',
+                'idx_frontend_prescription_201304_pct_id',
+                'idx_frontend_prescription_201304_practice_id',
+                'idx_frontend_prescription_201304_presentation',
+            ])
+
+    def test_import_with_brin_date_index(self):
+        with self.env:
+            call_command('import_hscic_prescribing', brin_date_index=True,
+                         **self.new_opts)
+        with connection.cursor() as cursor:
+            cursor.execute(
+                "SELECT indexdef FROM pg_indexes "
+                "WHERE indexname = 'idx_frontend_prescription_201304_date'")
+            self.assertIn('USING brin', cursor.fetchone()[0])
+        self.assertEqual(
+            Prescription.objects.filter(processing_date='2013-04-01').count(),
+            15)
+
     def test_inserts_fail(self):
         with self.assertRaises(InternalError):
             Prescription.objects.create(
@@ -1,14 +1,18 @@
 from numbers import Number
 import argparse
+import csv
 import json
 import os
 
 from gcutils.bigquery import Client
 from mock import patch
 from mock import MagicMock
+import numpy as np
+import pandas as pd
 
 from django.conf import settings
 from django.core.management import call_command
+from django.db import connection
 from django.test import TestCase
 
 from frontend.bq_schemas import CCG_SCHEMA, PRACTICE_SCHEMA, PRESCRIBING_SCHEMA
@@ -84,6 +88,152 @@ class UnitTests(TestCase):
                     .return_value.execute.mock_calls
         self.assertGreater(calls, 0)
 
+    def test_incremental_start_date(self):
+        from frontend.management.commands.import_measures \
+            import incremental_start_date, measure_fingerprint
+        measure = Measure.objects.get(id='cerazette')
+        fingerprint = measure_fingerprint('cerazette')
+
+        # Never calculated with this definition
+        self.assertEqual(
+            incremental_start_date(measure, fingerprint, '2012-10-01'),
+            '2012-10-01')
+
+        measure.definition_fingerprint = fingerprint
+        measure.save()
+        self.assertEqual(
+            incremental_start_date(measure, fingerprint, '2012-10-01'),
+            '2012-10-01')
+
+        MeasureGlobal.objects.create(measure=measure, month='2017-09-01')
+        self.assertEqual(
+            incremental_start_date(measure, fingerprint, '2012-10-01'),
+            '2017-10-01')
+
+        # The definition has changed since
+        self.assertEqual(
+            incremental_start_date(measure, 'x' * 40, '2012-10-01'),
+            '2012-10-01')
+
+    def test_conditional_aggregates(self):
+        from frontend.management.commands.import_measures \
+            import conditional_aggregates
+        columns = ("SUM(quantity) AS numerator, COUNT(*) AS n, "
+                   "(max(a) + MAX(b)) / 1000.0 AS denominator, "
+                   "SUM(CASE WHEN bnf_name LIKE '%(%' THEN 1 END) AS c")
+        self.assertEqual(
+            conditional_aggregates(columns, "(x > 1)"),
+            "SUM(IF((x > 1), quantity, NULL)) AS numerator, "
+            "COUNTIF((x > 1)) AS n, "
+            "(max(IF((x > 1), a, NULL)) + MAX(IF((x > 1), b, NULL))) "
+            "/ 1000.0 AS denominator, "
+            "SUM(IF((x > 1), CASE WHEN bnf_name LIKE '%(%' THEN 1 END, "
+            "NULL)) AS c")
+
+    def test_group_by_source(self):
+        from frontend.management.commands.import_measures \
+            import MeasureCalculation, group_by_source
+        prescribing = '{hscic}.normalised_prescribing_standard'
+        list_sizes = '{hscic}.practice_statistics'
+        calculations = [
+            MeasureCalculation(Measure(
+                id='one', numerator_from=prescribing,
+                denominator_from=prescribing + ' ')),
+            MeasureCalculation(Measure(
+                id='two', numerator_from=prescribing,
+                denominator_from=list_sizes)),
+        ]
+        sources = group_by_source(calculations)
+        self.assertEqual(
+            [source.table_name for source in sources],
+            ['sums_hscic_normalised_prescribing_standard',
+             'sums_hscic_practice_statistics'])
+        self.assertEqual(len(sources[0].parts), 3)
+        self.assertEqual(calculations[1].sums_tables, {
+            'numerator': 'sums_hscic_normalised_prescribing_standard',
+            'denominator': 'sums_hscic_practice_statistics'})
+
+    def test_dependency_batches(self):
+        from frontend.management.commands.import_measures \
+            import MeasureCalculation, dependency_batches
+        prescribing = '{hscic}.normalised_prescribing_standard'
+        omnibus = '{measures}.practice_data_all_low_priority'
+        calculations = [
+            MeasureCalculation(Measure(
+                id='lpzomnibus', numerator_from=omnibus,
+                denominator_from=omnibus)),
+            MeasureCalculation(Measure(
+                id='lpcoprox', numerator_from=prescribing,
+                denominator_from=prescribing)),
+            MeasureCalculation(Measure(
+                id='cerazette', numerator_from=prescribing,
+                denominator_from=prescribing)),
+        ]
+        batches = dependency_batches(calculations)
+        self.assertEqual(
+            [[c.measure.id for c in batch] for batch in batches],
+            [['lpcoprox', 'cerazette'], ['lpzomnibus']])
+
+        # lpzomnibus doesn't need to wait for measures that aren't being
+        # calculated
+        batches = dependency_batches(calculations[:1])
+        self.assertEqual(
+            [[c.measure.id for c in batch] for batch in batches],
+            [['lpzomnibus']])
+
+    def test_source_measure_ids(self):
+        from frontend.management.commands.import_measures \
+            import source_measure_ids
+        self.assertEqual(
+            source_measure_ids(['{hscic}.normalised_prescribing_standard']),
+            set())
+        self.assertEqual(
+            source_measure_ids(['{measures}.practice_data_cerazette ']),
+            {'cerazette'})
+        sources = source_measure_ids(
+            ['{measures}.practice_data_all_low_priority'])
+        self.assertIn('lpcoprox', sources)
+        self.assertIn('lptrimipramine', sources)
+        self.assertNotIn('lpzomnibus', sources)
+
+    def test_local_engine_rejects_bigquery_sql(self):
+        from django.core.management.base import CommandError
+        from frontend.management.commands.import_measures \
+            import LocalMeasureCalculation
+        prescribing = '{hscic}.normalised_prescribing_standard'
+        list_sizes = '{hscic}.practice_statistics'
+        measure = Measure(
+            id='bigquery_only', numerator_from=prescribing,
+            numerator_columns='SUM(items) AS numerator',
+            numerator_where='1 = 1',
+            denominator_from=list_sizes,
+            denominator_columns=(
+                "CAST(JSON_EXTRACT(MAX(star_pu), '$.x') AS FLOAT64) "
+                "AS denominator"),
+            denominator_where='1 = 1')
+        with self.assertRaisesRegexp(CommandError, 'denominator'):
+            LocalMeasureCalculation(
+                measure, start_date='2015-09-01', end_date='2015-09-01')
+
+    def test_percent_rank_and_deciles(self):
+        from frontend.management.commands.import_measures \
+            import deciles, percent_rank
+        df = pd.DataFrame({
+            'month': ['2017-01-01'] * 5 + ['2017-02-01'],
+            'calc_value': [0.5, 0.1, np.nan, 0.1, 1.0, 0.3]})
+
+        percentiles = percent_rank(df)
+        self.assertEqual(
+            [round(x, 4) for x in percentiles[[0, 1, 3, 4, 5]]],
+            [0.6667, 0.0, 0.0, 1.0, 0.0])
+        self.assertTrue(np.isnan(percentiles[2]))
+
+        df = deciles(df, 'practice')
+        self.assertAlmostEqual(df['practice_10th']['2017-01-01'], 0.1)
+        self.assertAlmostEqual(df['practice_50th']['2017-01-01'], 0.3)
+        self.assertAlmostEqual(df['practice_90th']['2017-01-01'], 0.85)
+        self.assertAlmostEqual(df['practice_90th']['2017-02-01'], 0.3)
+
 
 class BigqueryFunctionalTests(TestCase):
     @classmethod
@@ -340,6 +490,47 @@ class BigqueryFunctionalTests(TestCase):
         }
         self._assertExpectedMeasureValue(measure, month, expected)
 
+    def test_local_engine_matches_bigquery(self):
+        bigquery_values = self._getMeasureValues()
+
+        fixture_path = os.path.join(
+            'frontend', 'tests', 'fixtures', 'commands',
+            'prescribing_bigquery_fixture.csv')
+        with connection.cursor() as cursor:
+            for month in ['2015-09-01', '2015-10-01']:
+                cursor.execute(
+                    "CREATE TABLE frontend_prescription_%s ("
+                    "CHECK (processing_date = DATE '%s')) "
+                    "INHERITS (frontend_prescription)" % (
+                        month[:7].replace('-', ''), month))
+            with open(fixture_path) as f:
+                for row in csv.reader(f):
+                    cursor.execute(
+                        "INSERT INTO frontend_prescription_%s "
+                        "(pct_id, practice_id, presentation_code, "
+                        "total_items, net_cost, actual_cost, quantity, "
+                        "processing_date) "
+                        "VALUES (%%s, %%s, %%s, %%s, %%s, %%s, %%s, %%s)" % (
+                            row[9][:7].replace('-', '')),
+                        row[1:4] + row[5:9] + [row[9][:10]])
+        # This practice isn't in the BigQuery practices fixture
+        Practice.objects.filter(code='B82008').delete()
+
+        opts = {
+            'month': '2015-09-01',
+            'measure': 'cerazette',
+            'engine': 'local',
+        }
+        with patch('frontend.management.commands.import_measures'
+                   '.parse_measures',
+                   new=MagicMock(return_value=test_measures())):
+            call_command('import_measures', **opts)
+        local_values = self._getMeasureValues()
+
+        self.assertEqual(len(local_values), len(bigquery_values))
+        for actual, expected in zip(local_values, bigquery_values):
+            self._assertClose(actual, expected)
+
     @classmethod
     def _createData(cls):
         bassetlaw = PCT.objects.create(code='02Q', org_type='CCG')
@@ -426,6 +617,29 @@ class BigqueryFunctionalTests(TestCase):
                    new=MagicMock(return_value=test_measures())):
             call_command('import_measures', *args, **opts)
 
+    def _getMeasureValues(self):
+        measure_values = MeasureValue.objects.filter(
+            measure_id='cerazette'
+        ).order_by('month', 'pct_id', 'practice_id').values()
+        measure_globals = MeasureGlobal.objects.filter(
+            measure_id='cerazette').order_by('month').values()
+        values = list(measure_values) + list(measure_globals)
+        for value in values:
+            del value['id']
+        return values
+
+    def _assertClose(self, actual, expected, identifier=''):
+        if isinstance(expected, dict):
+            self.assertEqual(sorted(actual), sorted(expected), identifier)
+            for k in expected:
+                self._assertClose(
+                    actual[k], expected[k], "%s[%s]" % (identifier, k))
+        else:
+            self.assert_(
+                isclose(actual, expected),
+                "got %s for %s, expected ~ %s" % (
+                    actual, identifier, expected))
+
     def _walk(self, mv, data):
         for k, v in data.items():
             if '.' in k:
@@ -492,3 +706,29 @@ class TestParseMeasures(TestCase):
         lptrimipramine_ix = list(measures).index('lptrimipramine')
 
         self.assertTrue(lptrimipramine_ix < lpzomnibus_ix)
+
+    def test_source_fingerprints_are_included(self):
+        from frontend.management.commands.import_measures \
+            import measure_fingerprint
+        measures = parse_measures()
+        fingerprint = measure_fingerprint('lpzomnibus', measures)
+        measures['lpcoprox'] = dict(measures['lpcoprox'], name='Changed')
+        self.assertNotEqual(
+            measure_fingerprint('lpzomnibus', measures), fingerprint)
+
+    def test_with_source_start_dates(self):
+        from collections import OrderedDict
+        from frontend.management.commands.import_measures \
+            import with_source_start_dates
+        start_dates = with_source_start_dates(OrderedDict([
+            ('lpzomnibus', '2012-10-01'),
+            ('lpcoprox', '2017-10-01'),
+            ('ace', '2017-10-01')]), '2017-10-01')
+        self.assertEqual(start_dates['lpcoprox'], '2012-10-01')
+        self.assertEqual(start_dates['lptrimipramine'], '2012-10-01')
+        self.assertEqual(start_dates['ace'], '2017-10-01')
+
+        # Sources aren't recalculated for up to date measures
+        start_dates = with_source_start_dates(OrderedDict([
+            ('lpzomnibus', '2017-11-01')]), '2017-10-01')
+        self.assertEqual(list(start_dates), ['lpzomnibus'])
@@ -12,29 +12,29 @@ INSERT INTO vw__chemical_summary_by_ccg VALUES('2014-10-01'::date,'03Q','0202010
 INSERT INTO vw__chemical_summary_by_ccg VALUES('2014-09-01'::date,'03Q','0202010F0',1,11.99,128);
 INSERT INTO vw__chemical_summary_by_ccg VALUES('2014-11-01'::date,'03V','0202010B0',62,54.26,2788);
 INSERT INTO vw__chemical_summary_by_ccg VALUES('2013-04-01'::date,'03Q','0202010F0',2,3.05,56);
-INSERT INTO vw__chemical_summary_by_practice VALUES('2013-04-01'::date,'N84014','0202010F0',2,3.05,56);
-INSERT INTO vw__chemical_summary_by_practice VALUES('2014-09-01'::date,'N84014','0202010F0',1,11.99,128);
-INSERT INTO vw__chemical_summary_by_practice VALUES('2014-11-01'::date,'P87629','0202010B0',38,42.13,1399);
-INSERT INTO vw__chemical_summary_by_practice VALUES('2014-11-01'::date,'K83059','0204000I0',16,14.15,1154);
-INSERT INTO vw__chemical_summary_by_practice VALUES('2013-08-01'::date,'N84014','0202010F0',1,1.53,28);
-INSERT INTO vw__chemical_summary_by_practice VALUES('2014-10-01'::date,'N84014','0202010B0',50,58.08,1953);
-INSERT INTO vw__chemical_summary_by_practice VALUES('2014-09-01'::date,'P87629','0202010F0',1,1.99,32);
-INSERT INTO vw__chemical_summary_by_practice VALUES('2013-08-01'::date,'P87629','0202010B0',1,1.69,23);
-INSERT INTO vw__chemical_summary_by_practice VALUES('2014-11-01'::date,'K83059','0202010B0',24,12.13,1389);
-INSERT INTO vw__chemical_summary_by_practice VALUES('2014-09-01'::date,'P87629','0202010B0',40,36.29,1209);
-INSERT INTO vw__chemical_summary_by_practice VALUES('2014-11-01'::date,'P87629','0204000I0',17,22.13,1200);
-INSERT INTO vw__chemical_summary_by_practice VALUES('2013-10-01'::date,'P87629','0202010B0',1,1.62,24);
-INSERT INTO vw__chemical_summary_by_practice VALUES('2013-04-01'::date,'P87629','0202010B0',1,1.56,26);
-INSERT INTO vw__practice_summary VALUES('2013-04-01'::date,'N84014',2,3.05,56);
-INSERT INTO vw__practice_summary VALUES('2014-09-01'::date,'N84014',1,11.99,128);
-INSERT INTO vw__practice_summary VALUES('2014-10-01'::date,'N84014',50,58.08,1953);
-INSERT INTO vw__practice_summary VALUES('2013-08-01'::date,'N84014',1,1.53,28);
-INSERT INTO vw__practice_summary VALUES('2014-09-01'::date,'P87629',41,38.28,1241);
-INSERT INTO vw__practice_summary VALUES('2013-08-01'::date,'P87629',1,1.69,23);
-INSERT INTO vw__practice_summary VALUES('2014-11-01'::date,'K83059',40,26.28,2543);
-INSERT INTO vw__practice_summary VALUES('2013-04-01'::date,'P87629',1,1.56,26);
-INSERT INTO vw__practice_summary VALUES('2013-10-01'::date,'P87629',1,1.62,24);
-INSERT INTO vw__practice_summary VALUES('2014-11-01'::date,'P87629',55,64.26,2599);
+INSERT INTO vw__chemical_summary_by_practice VALUES('2013-04-01'::date,'N84014','03Q','0202010F0',2,3.05,56);
+INSERT INTO vw__chemical_summary_by_practice VALUES('2014-09-01'::date,'N84014','03Q','0202010F0',1,11.99,128);
+INSERT INTO vw__chemical_summary_by_practice VALUES('2014-11-01'::date,'P87629','03V','0202010B0',38,42.13,1399);
+INSERT INTO vw__chemical_summary_by_practice VALUES('2014-11-01'::date,'K83059','03V','0204000I0',16,14.15,1154);
+INSERT INTO vw__chemical_summary_by_practice VALUES('2013-08-01'::date,'N84014','03Q','0202010F0',1,1.53,28);
+INSERT INTO vw__chemical_summary_by_practice VALUES('2014-10-01'::date,'N84014','03Q','0202010B0',50,58.08,1953);
+INSERT INTO vw__chemical_summary_by_practice VALUES('2014-09-01'::date,'P87629','03V','0202010F0',1,1.99,32);
+INSERT INTO vw__chemical_summary_by_practice VALUES('2013-08-01'::date,'P87629','03V','0202010B0',1,1.69,23);
+INSERT INTO vw__chemical_summary_by_practice VALUES('2014-11-01'::date,'K83059','03V','0202010B0',24,12.13,1389);
+INSERT INTO vw__chemical_summary_by_practice VALUES('2014-09-01'::date,'P87629','03V','0202010B0',40,36.29,1209);
+INSERT INTO vw__chemical_summary_by_practice VALUES('2014-11-01'::date,'P87629','03V','0204000I0',17,22.13,1200);
+INSERT INTO vw__chemical_summary_by_practice VALUES('2013-10-01'::date,'P87629','03V','0202010B0',1,1.62,24);
+INSERT INTO vw__chemical_summary_by_practice VALUES('2013-04-01'::date,'P87629','03V','0202010B0',1,1.56,26);
+INSERT INTO vw__practice_summary VALUES('2013-04-01'::date,'N84014','03Q',2,3.05,56);
+INSERT INTO vw__practice_summary VALUES('2014-09-01'::date,'N84014','03Q',1,11.99,128);
+INSERT INTO vw__practice_summary VALUES('2014-10-01'::date,'N84014','03Q',50,58.08,1953);
+INSERT INTO vw__practice_summary VALUES('2013-08-01'::date,'N84014','03Q',1,1.53,28);
+INSERT INTO vw__practice_summary VALUES('2014-09-01'::date,'P87629','03V',41,38.28,1241);
+INSERT INTO vw__practice_summary VALUES('2013-08-01'::date,'P87629','03V',1,1.69,23);
+INSERT INTO vw__practice_summary VALUES('2014-11-01'::date,'K83059','03V',40,26.28,2543);
+INSERT INTO vw__practice_summary VALUES('2013-04-01'::date,'P87629','03V',1,1.56,26);
+INSERT INTO vw__practice_summary VALUES('2013-10-01'::date,'P87629','03V',1,1.62,24);
+INSERT INTO vw__practice_summary VALUES('2014-11-01'::date,'P87629','03V',55,64.26,2599);
 INSERT INTO vw__presentation_summary VALUES('2014-11-01'::date,'0202010B0AAABAB',62,54.26,2788);
 INSERT INTO vw__presentation_summary VALUES('2014-11-01'::date,'0204000I0BCAAAB',29,32.26,2350);
 INSERT INTO vw__presentation_summary VALUES('2014-10-01'::date,'0202010B0AAABAB',50,58.08,1953);
@@ -58,3 +58,9 @@ INSERT INTO vw__presentation_summary_by_ccg VALUES('2013-08-01'::date,'03Q','020
 INSERT INTO vw__presentation_summary_by_ccg VALUES('2014-11-01'::date,'03V','0204000I0AAALAL',4,4.02,4);
 INSERT INTO vw__presentation_summary_by_ccg VALUES('2014-09-01'::date,'03Q','0202010F0AAAAAA',1,11.99,128);
 INSERT INTO vw__presentation_summary_by_ccg VALUES('2014-09-01'::date,'03V','0202010B0AAABAB',40,36.29,1209);
+INSERT INTO vw__bnf_rollup
+  SELECT processing_date, SUBSTR(presentation_code, 1, code_length),
+         SUM(items), SUM(quantity), SUM(cost), SUM(cost)
+  FROM vw__presentation_summary,
+       (VALUES (2), (4), (6), (7), (9), (11), (15)) AS lengths(code_length)
+  GROUP BY 1, 2;
@@ -0,0 +1,61 @@
+from django.test import SimpleTestCase
+
+from api.code_filters import code_filter
+
+
+class TestCodeFilter(SimpleTestCase):
+    def test_exact_codes(self):
+        sql, params = code_filter(
+            'presentation_code', ['0202010B0AAABAB', '0202010D0AAAAAA'])
+        self.assertEqual(sql, '(presentation_code = ANY(%s))')
+        self.assertEqual(params, [['0202010B0AAABAB', '0202010D0AAAAAA']])
+
+    def test_prefix_becomes_range(self):
+        sql, params = code_filter('chemical_id', ['0202%'])
+        self.assertEqual(
+            sql, '((chemical_id ~>=~ %s AND chemical_id ~<~ %s))')
+        self.assertEqual(params, ['0202', '0203'])
+
+    def test_range_upper_bound_after_digit(self):
+        _, params = code_filter('chemical_id', ['0209%'])
+        self.assertEqual(params, ['0209', '020:'])
+
+    def test_overlapping_prefixes_are_collapsed(self):
+        sql, params = code_filter(
+            'presentation_code',
+            ['0202010B0%', '0202%', '020201%', '0401%'])
+        self.assertEqual(sql.count('~>=~'), 2)
+        self.assertEqual(params, ['0202', '0203', '0401', '0402'])
+
+    def test_exact_codes_covered_by_prefix_are_dropped(self):
+        sql, params = code_filter(
+            'presentation_code', ['0202%', '0202010B0AAABAB'])
+        self.assertNotIn('ANY', sql)
+        self.assertEqual(params, ['0202', '0203'])
+
+    def test_pattern_with_inner_wildcard(self):
+        sql, params = code_filter('presentation_code', ['0202010B0____AB'])
+        self.assertEqual(
+            sql,
+            '(((presentation_code ~>=~ %s AND presentation_code ~<~ %s) '
+            'AND presentation_code LIKE %s))')
+        self.assertEqual(
+            params, ['0202010B0', '0202010B1', '0202010B0____AB'])
+
+    def test_mixed_patterns_make_single_predicate(self):
+        sql, params = code_filter(
+            'presentation_code',
+            ['0202010B0AAABAB', '0401%', '0202010B0____AB'])
+        self.assertEqual(sql.count('OR'), 2)
+        self.assertEqual(params, [
+            ['0202010B0AAABAB'],
+            '0401', '0402',
+            '0202010B0', '0202010B1', '0202010B0____AB'])
+
+    def test_match_everything(self):
+        sql, params = code_filter('presentation_code', ['%', '0202%'])
+        self.assertEqual(sql, 'presentation_code IS NOT NULL')
+        self.assertEqual(params, [])
+
+    def test_no_patterns(self):
+        self.assertEqual(code_filter('presentation_code', []), ('FALSE', []))
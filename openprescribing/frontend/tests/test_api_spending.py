@@ -2,10 +2,14 @@ import datetime
 import json
 
 from django.db import connection
+from django.test import override_settings
 
 from .api_test_base import ApiTestBase
 
+from frontend.management.commands.generate_ppu_bins import (
+    generate_ppu_bins)
 from frontend.models import ImportLog
+from frontend.models import Prescription
 
 
 def _create_prescribing_tables():
@@ -152,6 +156,26 @@ class TestAPISpendingViews(ApiTestBase):
         self.assertEqual(rows[17]['items'], '40')
         self.assertEqual(rows[17]['quantity'], '1209')
 
+    def test_total_spending_by_presentation(self):
+        _create_prescribing_tables()
+        rows = self._rows_from_api(
+            '/spending?format=csv&code=0202010B0AAABAB')
+        self.assertEqual(len(rows), 60)
+        self.assertEqual(rows[19]['date'], '2014-11-01')
+        self.assertEqual(rows[19]['actual_cost'], '54.26')
+        self.assertEqual(rows[19]['items'], '62')
+        self.assertEqual(rows[19]['quantity'], '2788')
+
+    def test_total_spending_by_code_not_in_rollup(self):
+        # Codes of this length aren't a level of the BNF hierarchy
+        _create_prescribing_tables()
+        rows = self._rows_from_api('/spending?format=csv&code=0202010B0A')
+        self.assertEqual(len(rows), 60)
+        self.assertEqual(rows[19]['date'], '2014-11-01')
+        self.assertEqual(rows[19]['actual_cost'], '54.26')
+        self.assertEqual(rows[19]['items'], '62')
+        self.assertEqual(rows[19]['quantity'], '2788')
+
     ########################################
     # Total spending by CCG.
     ########################################
@@ -307,6 +331,20 @@ class TestAPISpendingViews(ApiTestBase):
         self.assertEqual(rows[0]['items'], '40')
         self.assertEqual(rows[0]['quantity'], '2543')
 
+    def test_total_spending_by_practices_in_ccg_with_date(self):
+        url = '/spending_by_practice'
+        url += '?format=csv&org=03V&date=2014-11-01'
+        rows = self._rows_from_api(url)
+        self.assertEqual(len(rows), 2)
+        self.assertEqual(rows[0]['row_id'], 'K83059')
+        self.assertEqual(rows[0]['ccg'], '03V')
+        self.assertEqual(rows[0]['actual_cost'], '26.28')
+        self.assertEqual(rows[1]['row_id'], 'P87629')
+        self.assertEqual(rows[1]['date'], '2014-11-01')
+        self.assertEqual(rows[1]['actual_cost'], '64.26')
+        self.assertEqual(rows[1]['items'], '55')
+        self.assertEqual(rows[1]['quantity'], '2599')
+
     def test_spending_by_practice_on_chemical(self):
         url = '/spending_by_practice'
         url += '?format=csv&code=0204000I0&date=2014-11-01'
@@ -346,6 +384,28 @@ class TestAPISpendingViews(ApiTestBase):
         self.assertEqual(rows[-1]['items'], '55')
         self.assertEqual(rows[-1]['quantity'], '2599')
 
+    def test_spending_by_one_practice_as_json_lines(self):
+        url = self.api_prefix
+        url += '/spending_by_practice?format=jsonl&org=P87629'
+        response = self.client.get(url, follow=True)
+        self.assertTrue(response.streaming)
+        lines = ''.join(response.streaming_content).splitlines()
+        rows = [json.loads(line) for line in lines]
+        self.assertEqual(len(rows), 5)
+        self.assertEqual(rows[-1]['row_id'], 'P87629')
+        self.assertEqual(rows[-1]['date'], '2014-11-01')
+        self.assertEqual(rows[-1]['items'], 55)
+        self.assertEqual(rows[-1]['quantity'], 2599)
+
+    def test_spending_by_practice_with_no_rows_has_csv_header(self):
+        url = self.api_prefix
+        url += '/spending_by_practice?format=csv&org=P87629&date=2000-01-01'
+        response = self.client.get(url, follow=True)
+        self.assertTrue(response.streaming)
+        lines = ''.join(response.streaming_content).splitlines()
+        self.assertEqual(len(lines), 1)
+        self.assertIn('row_id', lines[0].split(','))
+
     def test_spending_by_one_practice_on_chemical(self):
         url = '/spending_by_practice'
         url += '?format=csv&code=0202010B0&org=P87629'
@@ -707,6 +767,37 @@ class TestAPISpendingViewsPPUBubble(ApiTestBase):
         )
 
 
+class TestAPISpendingViewsPPUBubbleFromBins(TestAPISpendingViewsPPUBubble):
+    """Run the bubble tests against precomputed PPU bins, rather than
+    against prescriptions.
+
+    """
+    def setUp(self):
+        super(TestAPISpendingViewsPPUBubbleFromBins, self).setUp()
+        dates = Prescription.objects.values_list(
+            'processing_date', flat=True).distinct()
+        for date in dates:
+            generate_ppu_bins(date)
+
+    def test_bins_are_used(self):
+        url = '/bubble?format=json'
+        url += '&bnf_code=0202010F0AAAAAA&date=2014-09-01&highlight=03V'
+        url = self.api_prefix + url
+        data = json.loads(self.client.get(url, follow=True).content)
+        Prescription.objects.all().delete()
+        self.assertEqual(
+            json.loads(self.client.get(url, follow=True).content), data)
+
+    def test_highlight_practice(self):
+        url = '/bubble?format=json'
+        url += '&bnf_code=0204000I0BCAAAB&date=2014-11-01&highlight=P87629'
+        url = self.api_prefix + url
+        response = self.client.get(url, follow=True)
+        data = json.loads(response.content)
+        self.assertEqual(len(data['series']), 1)
+        self.assertEqual(data['plotline'], 0.0325)
+
+
 class TestAPISpendingViewsPPUWithGenericMapping(ApiTestBase):
     fixtures = ApiTestBase.fixtures + ['importlog', 'genericcodemapping']
 
@@ -728,3 +819,52 @@ class TestAPISpendingViewsPPUWithGenericMapping(ApiTestBase):
         response = self.client.get(url, follow=True)
         data = json.loads(response.content)
         self.assertEqual(data['plotline'], 0.0325)
+
+
+@override_settings(CACHES={
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    'api': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'api',
+    },
+})
+class TestAPISpendingViewsCache(ApiTestBase):
+    def setUp(self):
+        super(TestAPISpendingViewsCache, self).setUp()
+        ImportLog.objects.create(
+            current_at=datetime.date(2014, 11, 1), category='prescribing')
+
+    def _update_summary_table(self):
+        with connection.cursor() as cursor:
+            cursor.execute(
+                "UPDATE vw__chemical_summary_by_ccg SET items = items + 1")
+
+    def test_repeated_request_is_cached(self):
+        url = '/spending_by_ccg?format=csv&org=03V'
+        rows = self._rows_from_api(url)
+        self._update_summary_table()
+        self.assertEqual(self._rows_from_api(url), rows)
+
+    def test_query_string_is_normalised(self):
+        rows = self._rows_from_api('/spending_by_ccg?format=csv&org=03V')
+        self._update_summary_table()
+        self.assertEqual(
+            self._rows_from_api('/spending_by_ccg?org=03V&format=csv'), rows)
+
+    def test_new_import_invalidates_cache(self):
+        url = '/spending_by_ccg?format=csv&org=03V'
+        rows = self._rows_from_api(url)
+        self._update_summary_table()
+        ImportLog.objects.create(
+            current_at=datetime.date(2014, 12, 1), category='prescribing')
+        self.assertNotEqual(self._rows_from_api(url), rows)
+
+    def test_reimport_of_same_month_invalidates_cache(self):
+        url = '/spending_by_ccg?format=csv&org=03V'
+        rows = self._rows_from_api(url)
+        self._update_summary_table()
+        ImportLog.objects.create(
+            current_at=datetime.date(2014, 11, 1), category='prescribing')
+        self.assertNotEqual(self._rows_from_api(url), rows)
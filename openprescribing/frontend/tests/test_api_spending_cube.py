@@ -0,0 +1,157 @@
+import datetime
+import shutil
+import tempfile
+
+from django.test import SimpleTestCase
+
+from .api_test_base import ApiTestBase
+
+from api import spending_cube
+from frontend.models import ImportLog
+
+
+def _row(date, pct_id, chemical_id, items, quantity, actual_cost):
+    return {
+        'processing_date': date,
+        'pct_id': pct_id,
+        'chemical_id': chemical_id,
+        'items': items,
+        'quantity': quantity,
+        'actual_cost': actual_cost,
+    }
+
+
+class TestSpendingCube(SimpleTestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        nov = datetime.date(2014, 11, 1)
+        october = datetime.date(2014, 10, 1)
+        too_old = datetime.date(2009, 11, 1)
+        rows = [
+            _row(nov, '03V', '0202010B0', 62, 2788, 54.26),
+            _row(nov, '03V', '0204000I0', 33, 2354, 36.28),
+            _row(october, '03Q', '0202010B0', 50, 1953, 58.08),
+            _row(nov, '03Q', '0202010F0', 1, 128, 11.99),
+            _row(nov, None, '0202010F0', 4, 100, 10.0),
+            _row(too_old, '03V', '0202010B0', 1, 1, 1.0),
+        ]
+        spending_cube.write(
+            self.path, nov,
+            ['0204000I0', '0202010F0', '0202010B0'],
+            [('03V', 'NHS Corby'), ('03Q', 'NHS Vale of York')],
+            [rows[:3], rows[3:]])
+        self.cube = spending_cube.SpendingCube(self.path)
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def test_covers_codes_up_to_chemicals(self):
+        self.assertTrue(self.cube.covers([]))
+        self.assertTrue(self.cube.covers(['02', '0202010B0']))
+        self.assertFalse(self.cube.covers(['0202010B0AA']))
+
+    def test_total_spending(self):
+        rows = self.cube.total_spending([])
+        self.assertEqual(len(rows), 60)
+        self.assertEqual(rows[0]['date'], datetime.date(2009, 12, 1))
+        self.assertEqual(rows[-1], {
+            'date': datetime.date(2014, 11, 1),
+            'items': 100,
+            'quantity': 5370,
+            'actual_cost': 112.53,
+        })
+        self.assertEqual(rows[-2]['items'], 50)
+        self.assertEqual(rows[-3]['items'], 0)
+
+    def test_total_spending_by_section(self):
+        rows = self.cube.total_spending(['020201'])
+        self.assertEqual(rows[-1]['items'], 67)
+        self.assertEqual(rows[-1]['actual_cost'], 76.25)
+
+    def test_total_spending_by_overlapping_codes(self):
+        rows = self.cube.total_spending(['0202', '0202010B0'])
+        self.assertEqual(rows[-1]['items'], 67)
+
+    def test_total_spending_by_code_without_data(self):
+        rows = self.cube.total_spending(['0301'])
+        self.assertEqual(rows[-1]['items'], 0)
+        self.assertEqual(rows[-1]['actual_cost'], 0)
+
+    def test_spending_by_ccg(self):
+        rows = self.cube.spending_by_ccg(['0202010B0', '0202010F0'], [])
+        self.assertEqual(rows, [
+            {'row_id': '03Q', 'row_name': 'NHS Vale of York',
+             'date': datetime.date(2014, 10, 1),
+             'items': 50, 'quantity': 1953, 'actual_cost': 58.08},
+            {'row_id': '03Q', 'row_name': 'NHS Vale of York',
+             'date': datetime.date(2014, 11, 1),
+             'items': 1, 'quantity': 128, 'actual_cost': 11.99},
+            {'row_id': '03V', 'row_name': 'NHS Corby',
+             'date': datetime.date(2014, 11, 1),
+             'items': 62, 'quantity': 2788, 'actual_cost': 54.26},
+        ])
+
+    def test_spending_by_one_ccg(self):
+        rows = self.cube.spending_by_ccg([], ['03V', 'ZZZ'])
+        self.assertEqual(len(rows), 1)
+        self.assertEqual(rows[0]['row_id'], '03V')
+        self.assertEqual(rows[0]['items'], 95)
+
+
+class TestAPISpendingViewsWithCube(ApiTestBase):
+    """Check that the spending store gives the same results as the
+    summary tables it is built from.
+
+    """
+    def setUp(self):
+        super(TestAPISpendingViewsWithCube, self).setUp()
+        ImportLog.objects.create(
+            current_at=datetime.date(2014, 11, 1), category='prescribing')
+        self.path = tempfile.mkdtemp()
+        with self.settings(SPENDING_CUBE_DIR=self.path):
+            spending_cube.build(datetime.date(2014, 11, 1))
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+        super(TestAPISpendingViewsWithCube, self).tearDown()
+
+    def _assert_same_rows(self, url):
+        expected = self._rows_from_api(url)
+        with self.settings(SPENDING_CUBE_DIR=self.path):
+            self.assertIsNotNone(spending_cube.get_cube())
+            rows = self._rows_from_api(url)
+        self.assertEqual(len(rows), len(expected))
+        for row, expected_row in zip(rows, expected):
+            self.assertEqual(sorted(row.keys()), sorted(expected_row.keys()))
+            for key, value in row.items():
+                if key in ['items', 'quantity', 'actual_cost']:
+                    self.assertAlmostEqual(
+                        float(value), float(expected_row[key]), places=2)
+                else:
+                    self.assertEqual(value, expected_row[key])
+
+    def test_total_spending(self):
+        self._assert_same_rows('/spending?format=csv')
+
+    def test_total_spending_by_bnf_section(self):
+        self._assert_same_rows('/spending?format=csv&code=0202')
+
+    def test_total_spending_by_chemicals(self):
+        self._assert_same_rows(
+            '/spending?format=csv&code=0202010B0,0204000I0')
+
+    def test_spending_by_all_ccgs(self):
+        self._assert_same_rows('/spending_by_ccg?format=csv')
+
+    def test_spending_by_one_ccg_on_chemical(self):
+        self._assert_same_rows(
+            '/spending_by_ccg?format=csv&code=0202010B0&org=03V')
+
+    def test_spending_by_all_ccgs_on_multiple_bnf_sections(self):
+        self._assert_same_rows('/spending_by_ccg?format=csv&code=0202,0204')
+
+    def test_store_not_used_after_new_import(self):
+        ImportLog.objects.create(
+            current_at=datetime.date(2014, 12, 1), category='prescribing')
+        with self.settings(SPENDING_CUBE_DIR=self.path):
+            self.assertIsNone(spending_cube.get_cube())
@@ -1,5 +1,13 @@
+import threading
+import time
+
 from django.test import TestCase
+from django.test import TransactionTestCase
+from django.test import override_settings
 from django.db import OperationalError
+from django.db import connection
+
+from mock import patch
 
 
 class ApiTestUtils(TestCase):
@@ -12,3 +20,109 @@ class ApiTestUtils(TestCase):
                 cursor = connection.cursor()
                 cursor.execute("select pg_sleep(0.01);")
         self.assertRaises(OperationalError, do_long_running_query)
+
+
+@override_settings(CACHES={
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    'single_flight': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'single_flight',
+    },
+})
+class ApiTestSingleFlight(TransactionTestCase):
+    def _in_thread(self, results, name, func):
+        from api.view_utils import single_flight
+
+        def target():
+            try:
+                results[name] = single_flight('key', func)
+            finally:
+                connection.close()
+        thread = threading.Thread(target=target)
+        thread.start()
+        return thread
+
+    def _wait_for_lock_waiter(self):
+        with connection.cursor() as cursor:
+            for _ in range(500):
+                cursor.execute(
+                    "SELECT COUNT(*) FROM pg_locks "
+                    "WHERE locktype = 'advisory' AND NOT granted")
+                if cursor.fetchone()[0]:
+                    return
+                time.sleep(0.01)
+        self.fail("Nothing waited on the lock")
+
+    def test_returns_result(self):
+        from api.view_utils import single_flight
+        self.assertEqual(single_flight('key', lambda: 1), 1)
+        self.assertEqual(single_flight('key', lambda: 2), 2)
+
+    def test_result_not_cached_without_waiters(self):
+        from django.core.cache import caches
+        from api.view_utils import single_flight
+        cache = caches['single_flight']
+        with patch.object(cache, 'set') as cache_set:
+            self.assertEqual(single_flight('key', lambda: 1), 1)
+        self.assertFalse(cache_set.called)
+
+    def test_concurrent_call_waits_for_result(self):
+        results = {}
+        started = threading.Event()
+        finish = threading.Event()
+
+        def slow():
+            started.set()
+            finish.wait()
+            return 'first'
+
+        first = self._in_thread(results, 'first', slow)
+        started.wait()
+        second = self._in_thread(results, 'second', lambda: 'second')
+        self._wait_for_lock_waiter()
+        finish.set()
+        first.join()
+        second.join()
+        self.assertEqual(results, {'first': 'first', 'second': 'first'})
+
+    def test_call_after_import_does_not_wait_for_earlier_call(self):
+        from frontend.models import ImportLog
+        results = {}
+        started = threading.Event()
+        finish = threading.Event()
+
+        def slow():
+            started.set()
+            finish.wait()
+            return 'first'
+
+        first = self._in_thread(results, 'first', slow)
+        started.wait()
+        ImportLog.objects.create(
+            current_at='2017-10-01', category='prescribing')
+        second = self._in_thread(results, 'second', lambda: 'second')
+        second.join()
+        finish.set()
+        first.join()
+        self.assertEqual(results, {'first': 'first', 'second': 'second'})
+
+    def test_concurrent_call_runs_if_first_call_fails(self):
+        results = {}
+        started = threading.Event()
+        finish = threading.Event()
+
+        def failing():
+            started.set()
+            finish.wait()
+            raise ValueError
+
+        first = self._in_thread(results, 'first', failing)
+        started.wait()
+        second = self._in_thread(results, 'second', lambda: 'second')
+        self._wait_for_lock_waiter()
+        finish.set()
+        first.join()
+        second.join()
+        self.assertEqual(results, {'second': 'second'})
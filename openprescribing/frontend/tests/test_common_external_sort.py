@@ -0,0 +1,68 @@
+from StringIO import StringIO
+import csv
+import random
+
+from django.test import SimpleTestCase
+
+from common.external_sort import sort_csv
+
+
+FIELD_NAMES = ['pct_id', 'presentation_code', 'items']
+
+
+def _to_csv(rows):
+    f = StringIO()
+    csv.writer(f, lineterminator='\n').writerows(rows)
+    f.seek(0)
+    return f
+
+
+class SortCSVTests(SimpleTestCase):
+    def setUp(self):
+        rng = random.Random(1)
+        self.rows = [
+            [rng.choice(['03Q', '03V', '99P']),
+             '0202010B0AAA{}A{}'.format(rng.randint(0, 9), rng.randint(0, 9)),
+             str(ix)]
+            for ix in range(2000)
+        ]
+
+    def _sort(self, rows, sort_keys, **kwargs):
+        result = sort_csv(_to_csv(rows), FIELD_NAMES, sort_keys, **kwargs)
+        return list(csv.reader(StringIO(result.read())))
+
+    def _expected(self, rows, sort_keys):
+        ixs = [FIELD_NAMES.index(key) for key in sort_keys]
+        return sorted(rows, key=lambda row: [row[ix] for ix in ixs])
+
+    def test_sort_in_memory(self):
+        sort_keys = ['presentation_code', 'pct_id']
+        rows = self._sort(self.rows, sort_keys)
+        self.assertEqual(rows, self._expected(self.rows, sort_keys))
+
+    def test_sort_in_runs(self):
+        sort_keys = ['presentation_code', 'pct_id']
+        # About 20 runs
+        rows = self._sort(self.rows, sort_keys, memory_mb=0.02, workers=2)
+        expected = self._expected(self.rows, sort_keys)
+
+        def key(row):
+            return row[:2]
+
+        self.assertEqual(map(key, rows), map(key, expected))
+        self.assertEqual(sorted(rows), sorted(self.rows))
+
+    def test_sort_quoted_fields(self):
+        rows = [
+            ['03V', 'b,"c"', '1'],
+            ['03Q', 'a,b', '2'],
+            ['03V', 'a\nb', '3'],
+        ]
+        self.assertEqual(self._sort(rows, ['presentation_code']), [
+            ['03V', 'a\nb', '3'],
+            ['03Q', 'a,b', '2'],
+            ['03V', 'b,"c"', '1'],
+        ])
+
+    def test_sort_empty(self):
+        self.assertEqual(self._sort([], ['pct_id']), [])
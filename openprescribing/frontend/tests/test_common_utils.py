@@ -105,3 +105,35 @@ class FunctionalTests(TestCase):
             )
             self.assertEqual(cursor.fetchone()[0], 2)
             self.assertEqual(_cluster_count(cursor), 1)
+
+
+class ChunkReaderTest(SimpleTestCase):
+    def test_read(self):
+        from common.utils import ChunkReader
+        reader = ChunkReader(['ab', '', 'c\nde\n', 'f'])
+        self.assertEqual(reader.read(2), 'ab')
+        self.assertEqual(reader.read(3), 'c\nd')
+        self.assertEqual(reader.read(), 'e\nf')
+        self.assertEqual(reader.read(), '')
+
+    def test_readline(self):
+        from common.utils import ChunkReader
+        reader = ChunkReader(['ab', 'c\nde\n', 'f'])
+        self.assertEqual(reader.readline(), 'abc\n')
+        self.assertEqual(reader.readline(), 'de\n')
+        self.assertEqual(reader.readline(), 'f')
+        self.assertEqual(reader.readline(), '')
+
+    def test_iter(self):
+        from common.utils import ChunkReader
+        reader = ChunkReader(['ab', 'c\nde\n', 'f'])
+        self.assertEqual(list(reader), ['abc\n', 'de\n', 'f'])
+
+
+class CsvChunksTest(SimpleTestCase):
+    def test_csv_chunks(self):
+        from common.utils import csv_chunks
+        rows = [['a', 1, None], ['b,c', 2.5, '']]
+        chunks = list(csv_chunks(rows, chunk_size=5))
+        self.assertEqual(chunks, ['a,1,\n', '"b,c",2.5,\n'])
+        self.assertEqual(list(csv_chunks([])), [])
@@ -0,0 +1,61 @@
+import json
+
+from django.test import SimpleTestCase
+from django.test import TestCase
+from django.test import override_settings
+from mock import patch
+
+from frontend.middleware import explain
+from frontend.middleware import normalise_sql
+
+
+class TestQueryProfilingMiddleware(TestCase):
+    url = '/api/1.0/bnf_code/?q=lor&format=json'
+
+    def test_server_timing_header(self):
+        response = self.client.get(self.url)
+        timings = response['Server-Timing'].split(', ')
+        self.assertRegexpMatches(
+            timings[0], r'^db;dur=[\d.]+;desc="\d+ queries"$')
+        self.assertRegexpMatches(timings[1], r'^render;dur=[\d.]+$')
+        self.assertRegexpMatches(timings[2], r'^total;dur=[\d.]+$')
+        self.assertRegexpMatches(
+            timings[3], r'^slowest-query;dur=[\d.]+;desc="[0-9a-f]{8}"$')
+
+    @patch('frontend.middleware.ledger')
+    def test_fast_requests_are_not_logged(self, ledger):
+        self.client.get(self.url)
+        self.assertFalse(ledger.warning.called)
+
+    @override_settings(SLOW_REQUEST_THRESHOLD_MS=-1)
+    @patch('frontend.middleware.ledger')
+    def test_slow_requests_are_logged(self, ledger):
+        self.client.get(self.url)
+        entry = json.loads(ledger.warning.call_args[0][0])
+        self.assertEqual(entry['path'], '/api/1.0/bnf_code/')
+        self.assertEqual(entry['query_string'], 'q=lor&format=json')
+        self.assertGreater(entry['queries'], 0)
+        self.assertIn('?', entry['slowest_query']['sql'])
+        self.assertNotIn('lor', entry['slowest_query']['sql'])
+        self.assertIn('cost=', entry['slowest_query']['explain'])
+        self.assertNotIn('actual time', entry['slowest_query']['explain'])
+
+
+class TestExplain(TestCase):
+    def test_statements_calling_functions_are_not_explained(self):
+        self.assertIsNone(explain("SELECT pg_advisory_lock(1)"))
+        self.assertIsNone(explain("SELECT PG_SLEEP(1)"))
+
+    def test_writes_are_not_explained(self):
+        self.assertIsNone(
+            explain("WITH x AS (DELETE FROM t RETURNING *) SELECT 1"))
+
+
+class TestNormaliseSQL(SimpleTestCase):
+    def test_literals_are_replaced(self):
+        self.assertEqual(
+            normalise_sql(
+                "SELECT * FROM t\n  WHERE code IN ('a', 'b''c', 'd') "
+                "AND n > 1.5 AND t.id_2 = 7"),
+            "SELECT * FROM t WHERE code IN (?, ...) "
+            "AND n > ? AND t.id_2 = ?")
@@ -167,6 +167,27 @@ class PresentationTestCase(TestCase):
         to_make_not_current.save()
         self.assertEqual(len(Presentation.objects.current()), old_count - 1)
 
+    def test_refresh_current_versions(self):
+        a, b, c, d = Presentation.objects.all()[:4]
+        # a -> b -> c, and d replaced by itself
+        a.replaced_by = b
+        a.save()
+        b.replaced_by = c
+        b.save()
+        d.replaced_by = d
+        d.save()
+        mapping = Presentation.objects.refresh_current_versions()
+        self.assertEqual(mapping, {
+            a.bnf_code: c.bnf_code,
+            b.bnf_code: c.bnf_code,
+            d.bnf_code: d.bnf_code,
+        })
+        a = Presentation.objects.get(pk=a.pk)
+        self.assertEqual(a.current_version_code, c.bnf_code)
+        self.assertEqual(a.current_version, c)
+        d = Presentation.objects.get(pk=d.pk)
+        self.assertEqual(d.current_version, d)
+
     def test_dmd_product_which_exists(self):
         p = Presentation.objects.get(pk='0202010F0AAAAAA')
         self.assertEqual(p.dmd_product.vpid, 318248001)
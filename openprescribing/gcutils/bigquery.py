@@ -1,7 +1,11 @@
 from __future__ import print_function
 
+from multiprocessing.pool import ThreadPool
+import Queue
+import gzip
+import itertools
+import shutil
 import string
-import subprocess
 import tempfile
 
 from google.cloud import bigquery as gcbq
@@ -13,6 +17,7 @@ from django.conf import settings
 from django.db.models import fields as model_fields
 from django.db.models.fields import related as related_fields
 
+from common.utils import ChunkReader
 from gcutils.storage import Client as StorageClient
 from gcutils.table_dumper import TableDumper
 
@@ -31,6 +36,14 @@ except AttributeError:
     pass
 
 
+# The number of shards TableExporter downloads at once.  No more than
+# this many are downloaded ahead of the one being read.
+DOWNLOAD_THREADS = 4
+
+# The size of the blocks in which shards are decompressed
+CHUNK_SIZE = 1024 * 1024
+
+
 class Client(object):
     def __init__(self, dataset_key=None):
         self.project = settings.BQ_PROJECT
@@ -356,32 +369,99 @@ class TableExporter(object):
         for blob in self.bucket.list_blobs(prefix=self.storage_prefix):
             yield blob
 
-    def download_from_storage(self):
-        for blob in self.storage_blobs():
-            with tempfile.NamedTemporaryFile(mode='rb+') as f:
-                blob.download_to_file(f)
-                f.flush()
-                f.seek(0)
-                yield f
-
-    def download_from_storage_and_unzip(self, f_out):
-        for i, f_zipped in enumerate(self.download_from_storage()):
-            # Unzip
-            if i == 0:
-                cmd = "gunzip -c -f %s >> %s"
-            else:
-                # When the file is split into several shards in GCS, it
-                # puts a header on every file, so we have to skip that
-                # header on all except the first shard.
-                cmd = "gunzip -c -f %s | tail -n +2 >> %s"
-            subprocess.check_call(
-                cmd % (f_zipped.name, f_out.name), shell=True)
+    def download_from_storage(self, threads=DOWNLOAD_THREADS):
+        '''Download shards concurrently, yielding each as an open temporary
+        file as soon as it has been downloaded.
+
+        A new download is only started when a downloaded shard is taken,
+        so besides the one being read, at most `threads` shards are
+        downloading or waiting, however slowly they are consumed.'''
+        blobs = list(self.storage_blobs())
+        if not blobs:
+            return
+        downloaded = Queue.Queue()
+        pool = ThreadPool(min(threads, len(blobs)))
+        try:
+            pending = iter(blobs)
+            in_flight = 0
+            for blob in itertools.islice(pending, threads):
+                pool.apply_async(_download_blob_to_queue, [blob, downloaded])
+                in_flight += 1
+            while in_flight:
+                f, error = downloaded.get()
+                in_flight -= 1
+                if error is not None:
+                    raise error
+                for blob in itertools.islice(pending, 1):
+                    pool.apply_async(
+                        _download_blob_to_queue, [blob, downloaded])
+                    in_flight += 1
+                with f:
+                    yield f
+        finally:
+            pool.terminate()
+
+    def stream_from_storage(self, has_headers=True, keep_header=True,
+                            threads=DOWNLOAD_THREADS):
+        '''Return a file-like object from which the decompressed contents of
+        all shards can be read, for passing to `cursor.copy_expert()`.
+
+        When the table is split into several shards in GCS, it puts a
+        header on every file (unless exported with print_header=False, in
+        which case `has_headers` should be False).  Only the first of these
+        is kept, and only if `keep_header` is True.
+
+        Shards are read in the order they finish downloading, so the order
+        of rows is not preserved.
+        '''
+        return ChunkReader(
+            self._iter_chunks(has_headers, keep_header, threads))
+
+    def _iter_chunks(self, has_headers, keep_header, threads):
+        for i, f_zipped in enumerate(self.download_from_storage(threads)):
+            f = gzip.GzipFile(fileobj=f_zipped, mode='rb')
+            if has_headers:
+                header = f.readline()
+                if keep_header and i == 0:
+                    yield header
+            while True:
+                chunk = f.read(CHUNK_SIZE)
+                if not chunk:
+                    break
+                yield chunk
+
+    def download_from_storage_and_unzip(self, f_out, has_headers=True):
+        shutil.copyfileobj(
+            self.stream_from_storage(has_headers=has_headers), f_out,
+            CHUNK_SIZE)
+        f_out.flush()
 
     def delete_from_storage(self):
         for blob in self.storage_blobs():
             blob.delete()
 
 
+def _download_blob_to_queue(blob, queue):
+    '''Download a blob, and put the file, or the error raised, on the
+    given queue.'''
+    try:
+        queue.put((_download_blob(blob), None))
+    except Exception as e:
+        queue.put((None, e))
+
+
+def _download_blob(blob):
+    f = tempfile.NamedTemporaryFile(mode='rb+')
+    try:
+        blob.download_to_file(f)
+        f.flush()
+        f.seek(0)
+    except Exception:
+        f.close()
+        raise
+    return f
+
+
 def row_to_dict(row, field_names):
     """Convert a row from bigquery into a dictionary, and convert NaN to
     None
@@ -1,19 +1,100 @@
+import os
+import shutil
+
 from google.cloud import storage as gcs
 
 from django.conf import settings
 
 
 class Client(object):
-    '''A dumb proxy for gcs.Client'''
+    '''A dumb proxy for gcs.Client
+
+    If settings.STORAGE_LOCAL_DIR is set, buckets are instead backed by
+    directories below it, so that code which reads from and writes to
+    storage can be run offline.
+    '''
 
     def __init__(self):
-        self.gcs_client = gcs.Client(project=settings.BQ_PROJECT)
+        self.local_dir = getattr(settings, 'STORAGE_LOCAL_DIR', None)
+        if self.local_dir:
+            self.gcs_client = None
+        else:
+            self.gcs_client = gcs.Client(project=settings.BQ_PROJECT)
 
     def bucket(self):
+        if self.local_dir:
+            return LocalBucket(self.local_dir, settings.BQ_PROJECT)
         return self.gcs_client.bucket(settings.BQ_PROJECT)
 
     def get_bucket(self):
+        if self.local_dir:
+            return LocalBucket(self.local_dir, settings.BQ_PROJECT)
         return self.gcs_client.get_bucket(settings.BQ_PROJECT)
 
     def __getattr__(self, name):
         return getattr(self.gcs_client, name)
+
+
+class LocalBucket(object):
+    '''A stand-in for gcs.Bucket, which stores each blob as a file in a
+    local directory.'''
+
+    def __init__(self, base_dir, name):
+        self.name = name
+        self.path = os.path.join(base_dir, name)
+
+    def blob(self, blob_name):
+        return LocalBlob(self, blob_name)
+
+    def list_blobs(self, prefix=''):
+        blob_names = []
+        for dir_path, _, filenames in os.walk(self.path):
+            for filename in filenames:
+                path = os.path.join(dir_path, filename)
+                blob_name = os.path.relpath(path, self.path)
+                if blob_name.startswith(prefix):
+                    blob_names.append(blob_name)
+        for blob_name in sorted(blob_names):
+            yield self.blob(blob_name)
+
+
+class LocalBlob(object):
+    '''A stand-in for gcs.Blob, for blobs in a LocalBucket.'''
+
+    def __init__(self, bucket, name):
+        self.bucket = bucket
+        self.name = name
+        self.path = os.path.join(bucket.path, name)
+
+    def exists(self):
+        return os.path.isfile(self.path)
+
+    def delete(self):
+        os.remove(self.path)
+
+    def download_to_file(self, file_obj):
+        with open(self.path, 'rb') as f:
+            shutil.copyfileobj(f, file_obj)
+
+    def download_as_string(self):
+        with open(self.path, 'rb') as f:
+            return f.read()
+
+    def upload_from_file(self, file_obj, **kwargs):
+        self._make_dirs()
+        with open(self.path, 'wb') as f:
+            shutil.copyfileobj(file_obj, f)
+
+    def upload_from_filename(self, filename, **kwargs):
+        self._make_dirs()
+        shutil.copyfile(filename, self.path)
+
+    def upload_from_string(self, data, **kwargs):
+        self._make_dirs()
+        with open(self.path, 'wb') as f:
+            f.write(data)
+
+    def _make_dirs(self):
+        dir_path = os.path.dirname(self.path)
+        if not os.path.isdir(dir_path):
+            os.makedirs(dir_path)
@@ -0,0 +1,86 @@
+from StringIO import StringIO
+import gzip
+import shutil
+import tempfile
+
+from django.test import SimpleTestCase, override_settings
+
+from common.external_sort import sort_csv
+from gcutils.bigquery import TableExporter
+from gcutils.storage import Client as StorageClient
+
+
+class LocalStorageTest(SimpleTestCase):
+    def setUp(self):
+        self.local_dir = tempfile.mkdtemp()
+        self.override = override_settings(STORAGE_LOCAL_DIR=self.local_dir)
+        self.override.enable()
+        self.bucket = StorageClient().bucket()
+
+    def tearDown(self):
+        self.override.disable()
+        shutil.rmtree(self.local_dir)
+
+    def upload_shard(self, name, lines):
+        buf = StringIO()
+        f = gzip.GzipFile(fileobj=buf, mode='wb')
+        f.write(''.join(lines))
+        f.close()
+        self.bucket.blob(name).upload_from_string(buf.getvalue())
+
+    def test_blobs(self):
+        blob = self.bucket.blob('test/a/1.csv')
+        self.assertFalse(blob.exists())
+        blob.upload_from_string('1,2\n')
+        self.bucket.blob('test/b.csv').upload_from_string('3,4\n')
+        self.bucket.blob('other.csv').upload_from_string('5,6\n')
+
+        blobs = list(self.bucket.list_blobs(prefix='test/'))
+        self.assertEqual(
+            [b.name for b in blobs], ['test/a/1.csv', 'test/b.csv'])
+        self.assertEqual(blobs[0].download_as_string(), '1,2\n')
+
+        blobs[0].delete()
+        self.assertFalse(blob.exists())
+
+    def test_stream_from_storage(self):
+        for ix in range(3):
+            self.upload_shard(
+                'views/test-00000000000{}.csv.gz'.format(ix),
+                ['a,b\n', '{},x\n'.format(ix), '{},y\n'.format(ix)])
+        exporter = TableExporter(None, 'views/test-')
+
+        stream = exporter.stream_from_storage()
+        self.assertEqual(stream.readline(), 'a,b\n')
+        rows = stream.read().splitlines()
+        self.assertEqual(sorted(rows), [
+            '0,x', '0,y', '1,x', '1,y', '2,x', '2,y'])
+
+        stream = exporter.stream_from_storage(keep_header=False)
+        self.assertEqual(len(stream.read().splitlines()), 6)
+
+    def test_sort_stream_from_storage(self):
+        for ix in range(3):
+            self.upload_shard(
+                'views/test-00000000000{}.csv.gz'.format(ix),
+                ['a,b\n', '{},x\n'.format(2 - ix), '{},"y,z"\n'.format(ix)])
+        exporter = TableExporter(None, 'views/test-')
+
+        stream = exporter.stream_from_storage(keep_header=False)
+        result = sort_csv(stream, ['a', 'b'], ['a', 'b'], memory_mb=0.0001,
+                          workers=2)
+        self.assertEqual(result.read().splitlines(), [
+            '0,x', '0,"y,z"', '1,x', '1,"y,z"', '2,x', '2,"y,z"'])
+
+    def test_stream_from_storage_without_headers(self):
+        for ix in range(2):
+            self.upload_shard(
+                'views/test-00000000000{}.csv.gz'.format(ix),
+                ['{},x\n'.format(ix), '{},y\n'.format(ix)])
+        exporter = TableExporter(None, 'views/test-')
+
+        with tempfile.NamedTemporaryFile(mode='r+') as f:
+            exporter.download_from_storage_and_unzip(f, has_headers=False)
+            f.seek(0)
+            rows = f.read().splitlines()
+        self.assertEqual(sorted(rows), ['0,x', '0,y', '1,x', '1,y'])
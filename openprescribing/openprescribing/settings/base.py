@@ -158,6 +158,8 @@ TEMPLATES = [
 # MIDDLEWARE CONFIGURATION
 # See: https://docs.djangoproject.com/en/dev/ref/settings/#middleware-classes
 MIDDLEWARE_CLASSES = (
+    # First, so that its timings cover all the other middleware
+    'frontend.middleware.QueryProfilingMiddleware',
     'corsheaders.middleware.CorsMiddleware',
     # Default Django middleware.
     'django.middleware.common.CommonMiddleware',
@@ -168,6 +170,10 @@ MIDDLEWARE_CLASSES = (
     'django.contrib.messages.middleware.MessageMiddleware',
     # 'django.middleware.clickjacking.XFrameOptionsMiddleware',
 )
+
+# Requests taking longer than this are logged to the slow request ledger
+# (see frontend/middleware.py)
+SLOW_REQUEST_THRESHOLD_MS = 5000
 # END MIDDLEWARE CONFIGURATION
 
 
@@ -236,6 +242,44 @@ WSGI_APPLICATION = '%s.wsgi.application' % SITE_NAME
 
 TEST_RUNNER = 'frontend.tests.custom_runner.AssetBuildingTestRunner'
 
+
+# CACHE CONFIGURATION
+# See: https://docs.djangoproject.com/en/dev/ref/settings/#caches
+#
+# The `api` cache holds rendered API responses (see
+# api/view_utils#cache_until_import).  It is file-based so that it is
+# shared between gunicorn workers.  Keys include the latest import
+# dates, so stale entries are never read; they are culled once the
+# cache is full.
+#
+# The `single_flight` cache passes the results of expensive queries to
+# other workers waiting on the same query (see
+# api/view_utils#single_flight), so they only need to live briefly.
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    'api': {
+        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'LOCATION': join(INSTALL_ROOT, 'cache', 'api'),
+        'TIMEOUT': None,
+        'OPTIONS': {
+            'MAX_ENTRIES': 20000,
+        }
+    },
+    'single_flight': {
+        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'LOCATION': join(INSTALL_ROOT, 'cache', 'single_flight'),
+        'TIMEOUT': 60,
+    }
+}
+# END CACHE CONFIGURATION
+
+# Directory holding the memory-mapped spending store used by some API
+# views (see api/spending_cube.py).  Set to None to always query
+# Postgres.
+SPENDING_CUBE_DIR = join(INSTALL_ROOT, 'spending_cube')
+
 CONN_MAX_AGE = 1200
 
 
@@ -244,6 +288,7 @@ REST_FRAMEWORK = {
         'rest_framework.renderers.JSONRenderer',
         'rest_framework.renderers.BrowsableAPIRenderer',
         'rest_framework_csv.renderers.CSVRenderer',
+        'api.renderers.JSONLinesRenderer',
     ),
     'DEFAULT_CONTENT_NEGOTIATION_CLASS':
     'frontend.negotiation.IgnoreAcceptsContentNegotiation',
@@ -285,6 +330,10 @@ BQ_DMD_DATASET = 'dmd'
 BQ_DEFAULT_TABLE_EXPIRATION_MS = None
 BQ_LOCATION = 'EU'
 
+# If set, Cloud Storage buckets are replaced by directories below this
+# path (see gcutils.storage)
+STORAGE_LOCAL_DIR = None
+
 # Use django-anymail through mailgun for sending emails
 EMAIL_BACKEND = "anymail.backends.mailgun.MailgunBackend"
 ANYMAIL = {
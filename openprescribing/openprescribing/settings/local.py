@@ -40,16 +40,6 @@ DATABASES = {
 }
 # END DATABASE CONFIGURATION
 
-
-# CACHE CONFIGURATION
-# See: https://docs.djangoproject.com/en/dev/ref/settings/#caches
-CACHES = {
-    'default': {
-        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
-    }
-}
-# END CACHE CONFIGURATION
-
 INSTALLED_APPS += ('django_extensions',)
 
 # TOOLBAR CONFIGURATION
@@ -40,16 +40,6 @@ DATABASES = {
 }
 # END DATABASE CONFIGURATION
 
-
-# CACHE CONFIGURATION
-# See: https://docs.djangoproject.com/en/dev/ref/settings/#caches
-CACHES = {
-    'default': {
-        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
-    }
-}
-# END CACHE CONFIGURATION
-
 GOOGLE_TRACKING_ID = 'UA-62480003-1'
 GOOGLE_OPTIMIZE_CONTAINER_ID = 'GTM-5PX77GZ'
 
@@ -83,8 +73,15 @@ LOGGING = {
             'formatter': 'verbose',
             'filename': "%s/logs/mail-signals.log" % INSTALL_ROOT,
             'maxBytes': 1024 * 1024 * 100,  # 100 mb
-        }
-
+        },
+        'slow_requests': {
+            'level': 'WARN',
+            'class': 'logging.handlers.RotatingFileHandler',
+            'formatter': 'verbose',
+            'filename': "%s/logs/slow-requests.log" % INSTALL_ROOT,
+            'maxBytes': 1024 * 1024 * 100,  # 100 mb
+            'backupCount': 5,
+        },
     },
     'loggers': {
         'django': {
@@ -102,6 +99,11 @@ LOGGING = {
             'handlers': ['signals'],
             'propagate': False,
         },
+        'frontend.slow_requests': {
+            'level': 'WARN',
+            'handlers': ['slow_requests'],
+            'propagate': False,
+        },
     }
 }
 
@@ -30,16 +30,6 @@ DATABASES = {
 }
 # END DATABASE CONFIGURATION
 
-
-# CACHE CONFIGURATION
-# See: https://docs.djangoproject.com/en/dev/ref/settings/#caches
-CACHES = {
-    'default': {
-        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
-    }
-}
-# END CACHE CONFIGURATION
-
 ANYMAIL["MAILGUN_SENDER_DOMAIN"] = "staging.openprescribing.net",
 SUPPORT_EMAIL = 'feedback@staging.openprescribing.net'
 DEFAULT_FROM_EMAIL = SUPPORT_EMAIL
@@ -70,7 +60,15 @@ LOGGING = {
             'filename':
             "%s/logs/mail-signals.log" % INSTALL_ROOT,
             'maxBytes': 1024 * 1024 * 100,  # 100 mb
-            }
+            },
+        'slow_requests': {
+            'level': 'WARN',
+            'class': 'logging.handlers.RotatingFileHandler',
+            'formatter': 'verbose',
+            'filename': "%s/logs/slow-requests.log" % INSTALL_ROOT,
+            'maxBytes': 1024 * 1024 * 100,  # 100 mb
+            'backupCount': 5,
+        },
     },
     'loggers': {
         'django': {
@@ -88,6 +86,11 @@ LOGGING = {
             'handlers': ['signals'],
             'propagate': False,
         },
+        'frontend.slow_requests': {
+            'level': 'WARN',
+            'handlers': ['slow_requests'],
+            'propagate': False,
+        },
     }
 }
 
@@ -18,8 +18,16 @@ DATABASES = {
 CACHES = {
     'default': {
         'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    'api': {
+        'BACKEND': 'django.core.cache.backends.dummy.DummyCache',
+    },
+    'single_flight': {
+        'BACKEND': 'django.core.cache.backends.dummy.DummyCache',
     }
 }
+# Tests which use the spending store point this at a temporary directory
+SPENDING_CUBE_DIR = None
 INTERNAL_IPS = ('127.0.0.1',)
 ANYMAIL = {
     "MAILGUN_API_KEY": "key-b503fcc6f1c029088f2b3f9b3faa303c",
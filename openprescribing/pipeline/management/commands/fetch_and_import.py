@@ -1,12 +1,16 @@
 from django.core.management import BaseCommand
 
-from ...runner import run_all
+from ...runner import DEFAULT_PROCESSES, run_all
 
 
 class Command(BaseCommand):
     def add_arguments(self, parser):
         parser.add_argument('year', type=int)
         parser.add_argument('month', type=int)
+        parser.add_argument(
+            '--processes', type=int, default=DEFAULT_PROCESSES,
+            help='number of tasks to run at once')
 
     def handle(self, *args, **kwargs):
-        run_all(kwargs['year'], kwargs['month'])
+        run_all(kwargs['year'], kwargs['month'],
+                processes=kwargs['processes'])
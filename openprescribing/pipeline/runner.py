@@ -2,19 +2,23 @@ from __future__ import print_function
 
 from collections import defaultdict
 import datetime
+import fcntl
 import fnmatch
 import glob
 import json
+import multiprocessing
 import os
 import random
 import re
 import shlex
 import textwrap
+import time
 
 import networkx as nx
 
 from django.conf import settings
 from django.core.management import call_command as django_call_command
+from django.db import connections
 
 from gcutils.storage import Client as StorageClient
 from openprescribing.slack import notify_slack
@@ -23,6 +27,18 @@ from openprescribing.utils import find_files
 from .models import TaskLog
 
 
+# The default number of tasks that run_all runs at once
+DEFAULT_PROCESSES = 4
+
+# How often, in seconds, run_tasks checks whether any running task has
+# finished
+POLL_INTERVAL = 0.5
+
+
+class TaskFailed(Exception):
+    pass
+
+
 class Source(object):
     def __init__(self, name, attrs):
         self.name = name
@@ -136,12 +152,18 @@ class Task(object):
     def set_last_imported_path(self, path):
         '''Set the path of the most recently imported data for this source.'''
         now = datetime.datetime.now().replace(microsecond=0).isoformat()
-        records = load_import_records()
-        records[self.source.name].append({
-            'imported_file': path,
-            'imported_at': now,
-        })
-        dump_import_records(records)
+        # Tasks for other sources may be updating the records at the
+        # same time
+        with open(settings.PIPELINE_IMPORT_LOG_PATH, 'r+') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            records = defaultdict(list, json.load(f))
+            records[self.source.name].append({
+                'imported_file': path,
+                'imported_at': now,
+            })
+            f.seek(0)
+            json.dump(records, f, indent=2, separators=(',', ': '))
+            f.truncate()
 
     def unimported_paths(self):
         '''Return list of of paths to input files for task that have not been
@@ -345,11 +367,6 @@ def load_import_records():
     return defaultdict(list, log_data)
 
 
-def dump_import_records(records):
-    with open(settings.PIPELINE_IMPORT_LOG_PATH, 'w') as f:
-        json.dump(records, f, indent=2, separators=(',', ': '))
-
-
 def upload_all_to_storage(tasks):
     for task in tasks.by_type('convert'):
         upload_task_input_files(task)
@@ -414,33 +431,103 @@ def run_task(task, year, month, **kwargs):
         raise
 
 
-def run_all(year, month, under_test=False):
+def run_tasks(tasks, year, month, processes=DEFAULT_PROCESSES, **kwargs):
+    '''Run tasks concurrently, each in its own subprocess, with at most
+    `processes` running at once.
+
+    Each task is started as soon as those of its dependencies that are
+    among `tasks` have succeeded.  If a task fails, no more tasks are
+    started, and once the running tasks have finished, TaskFailed is
+    raised.
+    '''
+    tasks = {task.name: task for task in tasks}
+    waiting_on = {
+        name: set(dep.name for dep in task.dependencies if dep.name in tasks)
+        for name, task in tasks.items()
+    }
+    running = {}
+    failed = []
+
+    # Each subprocess must open its own database connection, rather than
+    # share ours
+    connections.close_all()
+
+    try:
+        while running or (waiting_on and not failed):
+            ready = sorted(
+                name for name, deps in waiting_on.items() if not deps)
+            if not failed:
+                for name in ready[:processes - len(running)]:
+                    del waiting_on[name]
+                    process = multiprocessing.Process(
+                        target=run_task,
+                        args=(tasks[name], year, month),
+                        kwargs=kwargs,
+                        name=name,
+                    )
+                    process.start()
+                    running[name] = process
+
+            if not running:
+                raise TaskFailed('Tasks have circular dependencies: {}'.format(
+                    ', '.join(sorted(waiting_on))))
+
+            name = wait_for_any(running)
+            process = running.pop(name)
+            if process.exitcode == 0:
+                for deps in waiting_on.values():
+                    deps.discard(name)
+            else:
+                failed.append(name)
+    except BaseException:
+        # On Ctrl+C, the running tasks are interrupted too, and should be
+        # allowed to record that they failed
+        for process in running.values():
+            process.join()
+        raise
+
+    if failed:
+        raise TaskFailed('Failed to run {}'.format(', '.join(failed)))
+
+
+def wait_for_any(processes):
+    '''Wait for any of the given processes to finish, and return its
+    key.'''
+    while True:
+        for name, process in sorted(processes.items()):
+            if not process.is_alive():
+                process.join()
+                return name
+        time.sleep(POLL_INTERVAL)
+
+
+def run_all(year, month, under_test=False, processes=DEFAULT_PROCESSES):
     tasks = load_tasks()
 
     if not under_test:
         for task in tasks.by_type('manual_fetch'):
             run_task(task, year, month)
 
-        for task in tasks.by_type('auto_fetch'):
-            run_task(task, year, month)
+        run_tasks(tasks.by_type('auto_fetch'), year, month, processes)
 
     upload_all_to_storage(tasks)
 
-    for task in tasks.by_type('convert').ordered():
-        run_task(task, year, month)
-
-    for task in tasks.by_type('import').ordered():
-        run_task(task, year, month)
+    run_tasks(
+        list(tasks.by_type('convert')) + list(tasks.by_type('import')),
+        year, month, processes
+    )
 
     prescribing_path = tasks['import_hscic_prescribing'].imported_paths()[-1]
     last_imported = re.findall(r'/(\d{4}_\d{2})/', prescribing_path)[0]
 
-    for task in tasks.by_type('post_process').ordered():
-        if under_test and 'smoketest' in task.name:
-            # Smoketests run against live site, so we should skip when running
-            # under test
-            continue
-        run_task(task, year, month, last_imported=last_imported)
+    post_process_tasks = [
+        task for task in tasks.by_type('post_process')
+        # Smoketests run against live site, so we should skip when running
+        # under test
+        if not (under_test and 'smoketest' in task.name)
+    ]
+    run_tasks(post_process_tasks, year, month, processes,
+              last_imported=last_imported)
 
     activity = random.choice([
         'Put the kettle on',
@@ -1,12 +1,14 @@
 import mock
 import os
 import json
+import time
 
 from django.conf import settings
-from django.test import TestCase, override_settings
+from django.test import TestCase, TransactionTestCase, override_settings
 
 from pipeline.models import TaskLog
-from pipeline.runner import load_tasks, run_task
+from pipeline.runner import (AutoFetchTask, ImportTask, TaskFailed,
+                             load_tasks, run_task, run_tasks)
 
 
 class PipelineTests(TestCase):
@@ -404,6 +406,78 @@ The last imported data can be found at:
         self.assertEqual(2, logs.count())
 
 
+class RunTasksTests(TransactionTestCase):
+    # Tasks are run in subprocesses, which can't see data written in a
+    # TestCase's transaction
+
+    def setUp(self):
+        self.tasks = load_tasks()
+
+    def run_import_tasks(self, run):
+        with mock.patch.object(ImportTask, 'run', autospec=True,
+                               side_effect=run):
+            with mock.patch('pipeline.runner.notify_slack'):
+                run_tasks(self.tasks.by_type('import'), 2017, 7)
+
+    def get_log(self, task_name):
+        return TaskLog.objects.get(year=2017, month=7, task_name=task_name)
+
+    def test_run_tasks(self):
+        self.run_import_tasks(lambda task, year, month: None)
+
+        for name1, name2 in [
+            ['import_source_a', 'import_source_b'],
+            ['import_source_b', 'import_source_c1'],
+            ['import_source_c1', 'import_source_c2'],
+        ]:
+            log1 = self.get_log(name1)
+            log2 = self.get_log(name2)
+            self.assertEqual(log1.status, 'successful')
+            self.assertEqual(log2.status, 'successful')
+            self.assertLessEqual(log1.ended_at, log2.started_at)
+
+    def test_run_independent_tasks_concurrently(self):
+        tasks = [self.tasks['fetch_source_b'], self.tasks['import_source_a']]
+
+        def run(task, year, month):
+            time.sleep(1)
+
+        with mock.patch.object(AutoFetchTask, 'run', autospec=True,
+                               side_effect=run):
+            with mock.patch.object(ImportTask, 'run', autospec=True,
+                                   side_effect=run):
+                run_tasks(tasks, 2017, 7)
+
+        log1 = self.get_log('fetch_source_b')
+        log2 = self.get_log('import_source_a')
+        self.assertLess(log1.started_at, log2.ended_at)
+        self.assertLess(log2.started_at, log1.ended_at)
+
+    def test_run_tasks_that_fail(self):
+        def run(task, year, month):
+            if task.name == 'import_source_b':
+                raise ValueError
+
+        with self.assertRaises(TaskFailed):
+            self.run_import_tasks(run)
+
+        self.assertEqual(self.get_log('import_source_a').status, 'successful')
+        log = self.get_log('import_source_b')
+        self.assertEqual(log.status, 'failed')
+        self.assertIn('ValueError', log.formatted_tb)
+        # Tasks depending on the failed task are not run
+        self.assertFalse(TaskLog.objects.filter(
+            task_name__in=['import_source_c1', 'import_source_c2']).exists())
+
+    def test_run_tasks_skips_successful_tasks(self):
+        TaskLog.objects.create(year=2017, month=7, task_name='import_source_a',
+                               status=TaskLog.SUCCESSFUL)
+        self.run_import_tasks(lambda task, year, month: None)
+        self.assertEqual(
+            TaskLog.objects.filter(task_name='import_source_a').count(), 1)
+        self.assertEqual(self.get_log('import_source_c2').status, 'successful')
+
+
 def build_path(source_id, year_and_month, filename):
     return os.path.join(
         settings.PIPELINE_DATA_BASEDIR,